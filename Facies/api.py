@@ -1,16 +1,11 @@
 import os
-from openai import OpenAI
+from llm import complete
 
 extra_body = {"enable_thinking": True}
 
-client = OpenAI(
-    api_key='sk-xxx',
-    base_url="https://api.deepseek.com",
-)
 
-
-def get_result(content: str):
-    response = client.chat.completions.create(
+def get_result(content: str, stats=None, validator=None):
+    request = dict(
         model="deepseek-reasoner",
         messages=[
             {
@@ -35,13 +30,42 @@ Your result for each depth point should be one of the nine categories above.
         response_format={"type": "json_object"},
     )
 
-    think = response.choices[0].message.reasoning_content
-    answer = response.choices[0].message.content
+    think, answer = complete(request, stats, validator)
+    return think, answer
+
+
+def get_batch_result(content: str, stats=None):
+    request = dict(
+        model="deepseek-reasoner",
+        messages=[
+            {
+                "role": "system",
+                "content": """Please give your answer in json in the following format:
+{
+  "answers": {"W1": ["X1", "X2", ...], "W2": [...]}
+}
+with one list per window of the request; X1 means the classification result for each depth point of that window.
+There are only nine categories: 'Nonmarine sandstone', 'Nonmarine coarse siltstone', 'Nonmarine fine siltstone',
+'Marine siltstone and shale', 'Mudstone', 'Wackestone', 'Dolomite', 'Packstone-grainstone', 'Phylloid-algal bafflestone'.
+Your result for each depth point should be one of the nine categories above.
+""",
+            },
+            {
+                "role": "user",
+                "content": content,
+            },
+        ],
+        stream=False,
+        extra_body=extra_body,
+        response_format={"type": "json_object"},
+    )
+
+    think, answer = complete(request, stats)
     return think, answer
 
 
-def get_result_trend(content: str):
-    response = client.chat.completions.create(
+def get_result_trend(content: str, stats=None):
+    request = dict(
         model="deepseek-reasoner",
         messages=[
             {
@@ -53,6 +77,5 @@ def get_result_trend(content: str):
         extra_body=extra_body,
     )
 
-    think = response.choices[0].message.reasoning_content
-    answer = response.choices[0].message.content
+    think, answer = complete(request, stats)
     return think, answer
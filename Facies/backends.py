@@ -0,0 +1,323 @@
+# backends.py
+# Chat-completion backends. Every LLM call site goes through the backend set
+# here, so the live endpoint can be swapped for the offline stand-in when
+# load-testing concurrency, caching and retries without network access.
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from http_client import get_http_client
+from table_format import estimate_tokens
+
+DEFAULT_BASE_URL = "https://api.deepseek.com"
+
+FACIES_LABELS = [
+    "Nonmarine sandstone",
+    "Nonmarine coarse siltstone",
+    "Nonmarine fine siltstone",
+    "Marine siltstone and shale",
+    "Mudstone",
+    "Wackestone",
+    "Dolomite",
+    "Packstone-grainstone",
+    "Phylloid-algal bafflestone",
+]
+
+PLANNER_TOOLS = [
+    "expert_feature_description_tool",
+    "expert_label_description_tool",
+    "classification_suggestions_tool",
+    "trend_analysis_tool",
+    "neighbor_find_tool",
+]
+
+
+class BackendError(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class ChatBackend:
+    name = "base"
+
+    def create(self, request: Dict[str, Any]):
+        raise NotImplementedError
+
+    def stream(self, request: Dict[str, Any]):
+        # 不支持流式的后端：整段回答作为一个增量块返回
+        return response_chunks(self.create(request))
+
+
+def response_chunks(response, piece_chars: Optional[int] = None):
+    # 把完整回答拆成 chat.completion.chunk 形式的增量，最后一块携带 usage
+    message = response.choices[0].message
+    for field in ("reasoning_content", "content"):
+        text = getattr(message, field, None) or ""
+        step = piece_chars or max(1, len(text))
+        for k in range(0, len(text), step):
+            delta = SimpleNamespace(content=None, reasoning_content=None)
+            setattr(delta, field, text[k:k + step])
+            yield SimpleNamespace(id=getattr(response, "id", None), usage=None,
+                                  choices=[SimpleNamespace(index=0, delta=delta, finish_reason=None)])
+    yield SimpleNamespace(id=getattr(response, "id", None), choices=[], usage=response.usage)
+
+
+class OpenAIBackend(ChatBackend):
+    name = "openai"
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None):
+        self.api_key = api_key or os.environ.get("DEEPSEEK_API_KEY", "sk-xxx")
+        self.base_url = base_url or os.environ.get("DEEPSEEK_BASE_URL", DEFAULT_BASE_URL)
+        self._client = None
+        self._http = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # SDK 客户端很轻，底层连接池由 http_client 在进程内共享；连接池重建后随之重建
+        http = get_http_client()
+        if self._client is None or self._http is not http:
+            with self._lock:
+                if self._client is None or self._http is not http:
+                    from openai import OpenAI
+                    # 重试全部交给 CallGovernor：SDK 自带重试会占着并发槽，且 429/5xx 不会传到 AIMD
+                    self._client = OpenAI(api_key=self.api_key, base_url=self.base_url, http_client=http,
+                                          max_retries=0)
+                    self._http = http
+        return self._client
+
+    def create(self, request: Dict[str, Any]):
+        return self.client.chat.completions.create(**request)
+
+    def stream(self, request: Dict[str, Any]):
+        return self.client.chat.completions.create(
+            **{**request, "stream": True, "stream_options": {"include_usage": True}})
+
+
+# =============== 离线替身：确定性的 schema 合法回答 ===============
+
+def _estimate_tokens(text: str) -> int:
+    return estimate_tokens(text)
+
+
+def _stable_int(text: str) -> int:
+    return int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:12], 16)
+
+
+# 表格数据行：行号后跟空白、逗号或制表符，再跟一个数值（delta 格式带符号）
+_WINDOW_RE = re.compile(r"^# Window (W\d+)\b.*$", re.MULTILINE)
+_ROW_RE = re.compile(r"^\s*\d+(?:\s+|,|\t)[-+]?\d")
+_REPAIR_RE = re.compile(r"^Rows to label: ([\d, ]+)$", re.MULTILINE)
+
+
+def _guess_labels(prompt: str) -> List[str]:
+    # 逐行找数据表中的 Predicted_Facies；找不到就按行内容哈希挑一个类别
+    labels: List[str] = []
+    for line in prompt.splitlines():
+        if not _ROW_RE.match(line):
+            continue
+        found = [label for label in FACIES_LABELS if label in line]
+        if found:
+            labels.append(max(found, key=len))
+        else:
+            labels.append(FACIES_LABELS[_stable_int(line) % len(FACIES_LABELS)])
+    return labels or [FACIES_LABELS[_stable_int(prompt) % len(FACIES_LABELS)]] * 16
+
+
+def stub_reply(request: Dict[str, Any]) -> Dict[str, str]:
+    messages = request.get("messages", [])
+    system = "\n".join(m["content"] for m in messages if m.get("role") == "system")
+    user = "\n".join(m["content"] for m in messages if m.get("role") == "user")
+    seed = _stable_int(system + user)
+
+    if "planning agent" in system:
+        k = 1 + seed % len(PLANNER_TOOLS)
+        tools = [{"name": name, "why": "stub plan"} for name in PLANNER_TOOLS[:k]]
+        answer = json.dumps({"tools": tools})
+        think = f"Stub planner selected {k} tools."
+    elif '"answers"' in system:
+        # 批量请求：按 "# Window Wk" 分段逐窗口作答
+        chunks = _WINDOW_RE.split(user)
+        answers = {chunks[k]: _guess_labels(chunks[k + 1]) for k in range(1, len(chunks) - 1, 2)}
+        answer = json.dumps({"answers": answers}, ensure_ascii=False)
+        think = f"Stub classifier answered {len(answers)} batched windows."
+    elif request.get("response_format", {}).get("type") == "json_object" and _REPAIR_RE.search(user):
+        # 行级修复请求：只回答列出的行
+        rows = [int(x) for x in _REPAIR_RE.search(user).group(1).replace(",", " ").split()]
+        labels = _guess_labels(user)
+        answer = json.dumps({"answer": [labels[k % len(labels)] for k in rows]}, ensure_ascii=False)
+        think = f"Stub classifier repaired {len(rows)} rows."
+    elif request.get("response_format", {}).get("type") == "json_object":
+        answer = json.dumps({"answer": _guess_labels(user)}, ensure_ascii=False)
+        think = "Stub classifier echoed the reference predictions."
+    else:
+        answer = (
+            "**Overall Trend Overview:**\nStub trend analysis.\n\n"
+            "**Detailed Feature Analysis:**\n"
+            + "".join(f"- {c} Trend: stable\n" for c in
+                      ["GR", "ILD_log10", "DeltaPHI", "PHIND", "PE", "NM_M", "RELPOS"])
+        )
+        think = "Stub trend reasoning."
+    return {"think": think, "answer": answer, "prompt": system + user}
+
+
+def _sample_latency(latency, rng: random.Random) -> float:
+    if latency is None:
+        return 0.0
+    if callable(latency):
+        return max(0.0, float(latency(rng)))
+    if isinstance(latency, (int, float)):
+        return float(latency)
+
+    kind, *params = latency
+    if kind == "constant":
+        return float(params[0])
+    if kind == "uniform":
+        return rng.uniform(params[0], params[1])
+    if kind == "lognormal":
+        # (median 秒, sigma)
+        median, sigma = params
+        return median * rng.lognormvariate(0.0, sigma)
+    raise ValueError(f"Unknown latency distribution {kind!r}")
+
+
+def _malform(answer: str, rng: random.Random) -> str:
+    # 模拟不合 schema 的输出：某一行给出不存在的类别，或在列表中途跑题
+    try:
+        labels = json.loads(answer)["answer"]
+    except (ValueError, KeyError, TypeError):
+        return answer
+    if not isinstance(labels, list) or not labels:
+        return answer
+    k = rng.randrange(len(labels))
+    if rng.random() < 0.5:
+        labels = labels[:k] + ["Limestone"] + labels[k + 1:]
+        return json.dumps({"answer": labels}, ensure_ascii=False)
+    head = json.dumps({"answer": labels[:k]}, ensure_ascii=False)[:-2]
+    return head + (", " if k else "") + "Let me reconsider the remaining rows. " + "The GR log suggests " * 20
+
+
+PREFIX_UNIT_CHARS = 256  # 约 64 token，对应 DeepSeek 上下文缓存的存储单元
+PREFIX_CACHE_LIMIT = 1_000_000
+
+
+def _prefix_hashes(text: str) -> List[bytes]:
+    h = hashlib.sha256()
+    out = []
+    for end in range(PREFIX_UNIT_CHARS, len(text) + 1, PREFIX_UNIT_CHARS):
+        h.update(text[end - PREFIX_UNIT_CHARS: end].encode("utf-8"))
+        out.append(h.copy().digest())
+    return out
+
+
+class StubBackend(ChatBackend):
+    name = "stub"
+
+    def __init__(self,
+                 latency: Union[None, float, tuple, Callable[[random.Random], float]] = None,
+                 failure_rate: float = 0.0,
+                 failure_status: int = 429,
+                 seed: int = 0,
+                 prefix_cache: bool = True,
+                 malformed_rate: float = 0.0,
+                 stream_chunk_chars: int = 16):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.prefix_cache = prefix_cache
+        self.malformed_rate = malformed_rate
+        self.stream_chunk_chars = stream_chunk_chars
+        self._prefixes = set()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _draw(self):
+        with self._lock:
+            delay, roll = _sample_latency(self.latency, self._rng), self._rng.random()
+            malformed_roll = self._rng.random() if self.malformed_rate else 1.0
+            return delay, roll, malformed_roll
+
+    def _cached_tokens(self, prompt: str, prompt_tokens: int) -> int:
+        # 模拟服务端前缀缓存：与之前请求共享的最长整单元前缀计为命中
+        if not self.prefix_cache:
+            return 0
+        hashes = _prefix_hashes(prompt)
+        with self._lock:
+            hit = 0
+            while hit < len(hashes) and hashes[hit] in self._prefixes:
+                hit += 1
+            if len(self._prefixes) + len(hashes) > PREFIX_CACHE_LIMIT:
+                self._prefixes.clear()
+            self._prefixes.update(hashes)
+        return min(prompt_tokens, _estimate_tokens(prompt[: hit * PREFIX_UNIT_CHARS]) if hit else 0)
+
+    def create(self, request: Dict[str, Any]):
+        delay, roll, malformed_roll = self._draw()
+        if delay:
+            time.sleep(delay)
+        if roll < self.failure_rate:
+            raise BackendError(f"stub backend injected failure ({self.failure_status})",
+                               status_code=self.failure_status)
+
+        reply = stub_reply(request)
+        if malformed_roll < self.malformed_rate and request.get("response_format", {}).get("type") == "json_object":
+            reply["answer"] = _malform(reply["answer"], random.Random(_stable_int(reply["prompt"])))
+        prompt_tokens = _estimate_tokens(reply["prompt"])
+        reasoning_tokens = _estimate_tokens(reply["think"])
+        completion_tokens = _estimate_tokens(reply["answer"]) + reasoning_tokens
+        cached_tokens = self._cached_tokens(reply["prompt"], prompt_tokens)
+
+        message = SimpleNamespace(role="assistant", content=reply["answer"], reasoning_content=reply["think"])
+        usage = SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens,
+            prompt_cache_hit_tokens=cached_tokens,
+            prompt_cache_miss_tokens=prompt_tokens - cached_tokens,
+            completion_tokens_details=SimpleNamespace(reasoning_tokens=reasoning_tokens),
+        )
+        return SimpleNamespace(
+            id=f"stub-{_stable_int(reply['prompt']):x}",
+            model=request.get("model", "stub"),
+            choices=[SimpleNamespace(index=0, message=message, finish_reason="stop")],
+            usage=usage,
+        )
+
+    def stream(self, request: Dict[str, Any]):
+        return response_chunks(self.create(request), self.stream_chunk_chars)
+
+
+_backend: Optional[ChatBackend] = None
+_backend_lock = threading.Lock()
+
+
+def make_backend(name: str = "openai", **kwargs) -> ChatBackend:
+    if name == "openai":
+        return OpenAIBackend(**kwargs)
+    if name == "stub":
+        return StubBackend(**kwargs)
+    raise ValueError(f"Unknown backend {name!r}")
+
+
+def set_backend(backend: Union[ChatBackend, str, None], **kwargs) -> Optional[ChatBackend]:
+    global _backend
+    if isinstance(backend, str):
+        backend = make_backend(backend, **kwargs)
+    _backend = backend
+    return _backend
+
+
+def get_backend() -> ChatBackend:
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = make_backend(os.environ.get("GEODECIDER_BACKEND", "openai"))
+    return _backend
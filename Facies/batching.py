@@ -0,0 +1,80 @@
+# batching.py
+# Micro-batching across concurrently running windows. Callers that share a
+# key (persona style plus static prompt prefix) and arrive within max_wait of
+# each other are packed into one request by the first of them; every caller
+# gets back its own slice, or None when it has to be re-queried on its own
+# (also when the batch fails or does not answer within result_timeout).
+import threading
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+
+class _Batch:
+    def __init__(self):
+        self.items: List[Dict[str, Any]] = []
+        self.full = threading.Event()
+
+
+class MicroBatcher:
+    def __init__(self, max_items: int = 4, max_wait: float = 0.05, result_timeout: Optional[float] = 600.0):
+        self.max_items = max_items
+        self.max_wait = max_wait
+        self.result_timeout = result_timeout
+        self._open: Dict[Hashable, _Batch] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: Hashable, payload: Any,
+               run_batch: Callable[[List[Any]], List[Optional[Any]]]) -> Tuple[Optional[Any], int]:
+        item = {"payload": payload, "done": threading.Event(), "result": None, "size": 1}
+        with self._lock:
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = _Batch()
+                self._open[key] = batch
+            batch.items.append(item)
+            if len(batch.items) >= self.max_items:
+                self._open.pop(key, None)
+                batch.full.set()
+
+        if leader:
+            # 第一个到达者负责发请求：等到批满或超时后关闭该批
+            batch.full.wait(self.max_wait)
+            with self._lock:
+                if self._open.get(key) is batch:
+                    self._open.pop(key)
+            self._run(batch.items, run_batch)
+            return item["result"], item["size"]
+
+        # 跟随者限时等待；批请求迟迟不返回时按单窗口调用处理
+        if not item["done"].wait(self.result_timeout):
+            print(f"Batched request did not return within {self.result_timeout}s; querying this window on its own.")
+            return None, 1
+        return item["result"], item["size"]
+
+    def _run(self, items: List[Dict[str, Any]], run_batch) -> None:
+        results: List[Optional[Any]] = []
+        try:
+            results = run_batch([it["payload"] for it in items])
+        except Exception as e:
+            # 整批失败时各自单独重查
+            print(f"Batched request for {len(items)} windows failed ({e}); re-querying individually.")
+        finally:
+            # KeyboardInterrupt 等也要唤醒跟随者，缺失的结果记为 None
+            for k, it in enumerate(items):
+                it["result"] = results[k] if k < len(results) else None
+                it["size"] = len(items)
+                it["done"].set()
+
+
+_batcher: Optional[MicroBatcher] = None
+
+
+def configure_batching(max_windows: int = 1, max_wait: float = 0.05,
+                       result_timeout: Optional[float] = 600.0) -> Optional[MicroBatcher]:
+    global _batcher
+    _batcher = MicroBatcher(max_windows, max_wait, result_timeout) if max_windows and max_windows > 1 else None
+    return _batcher
+
+
+def get_batcher() -> Optional[MicroBatcher]:
+    return _batcher
@@ -0,0 +1,228 @@
+# bench.py
+# End-to-end benchmark: runs main.main over synthetic or recorded well CSVs
+# against the stub backend and reports throughput, per-stage latency
+# percentiles, token usage per window and peak RSS as JSON.
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+import main as main_module
+import process
+from backends import FACIES_LABELS, ChatBackend, StubBackend, set_backend
+from result_index import detect_compression, iter_lines, list_segments, segment_path
+from stub_server import parse_latency
+
+STAGE_MARKERS = [
+    ("persona:expert", "EXPERT MODE"),
+    ("persona:model_aware", "MODEL-AWARE MODE"),
+    ("persona:trend_focus", "TREND-FOCUSED MODE"),
+]
+
+
+def make_synthetic_well(n_rows: int = 800, n_wells: int = 1, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    frames = []
+    for w in range(n_wells):
+        # 分段平稳的相序列，段长 5~40 行
+        labels: List[int] = []
+        while len(labels) < n_rows:
+            labels.extend([int(rng.integers(0, 9))] * int(rng.integers(5, 40)))
+        labels_arr = np.array(labels[:n_rows])
+        nm_m = np.where(labels_arr < 5, 1, 2)
+
+        probs = rng.dirichlet(np.full(9, 0.5), size=n_rows)
+        probs[np.arange(n_rows), labels_arr] += rng.uniform(0.0, 2.0, size=n_rows)
+        probs /= probs.sum(axis=1, keepdims=True)
+        predicted = probs.argmax(axis=1)
+
+        frame = pd.DataFrame({
+            "Well Name": f"SYN-{w + 1}",
+            "Depth": 2800.0 + 0.5 * np.arange(n_rows),
+            "GR": 40 + 8 * labels_arr + rng.normal(0, 6, n_rows),
+            "ILD_log10": 0.4 + 0.05 * labels_arr + rng.normal(0, 0.08, n_rows),
+            "DeltaPHI": rng.normal(4, 3, n_rows),
+            "PHIND": 8 + labels_arr + rng.normal(0, 2, n_rows),
+            "PE": 2.5 + 0.3 * (nm_m == 2) * labels_arr + rng.normal(0, 0.3, n_rows),
+            "NM_M": nm_m,
+            "RELPOS": np.linspace(1.0, 0.0, n_rows),
+            "Facies": [FACIES_LABELS[k] for k in labels_arr],
+            "Predicted_Facies": [FACIES_LABELS[k] for k in predicted],
+        })
+        for k, label in enumerate(FACIES_LABELS):
+            frame[f"Prob_{label}"] = probs[:, k]
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+def classify_stage(request: Dict[str, Any]) -> str:
+    messages = request.get("messages", [])
+    system = " ".join(m["content"] for m in messages if m.get("role") == "system")
+    user = " ".join(m["content"] for m in messages if m.get("role") == "user")
+    if "planning agent" in system:
+        return "planner"
+    for stage, marker in STAGE_MARKERS:
+        if marker in user:
+            return stage
+    if not request.get("response_format"):
+        return "trend"
+    return "decision"
+
+
+class RecordingBackend(ChatBackend):
+    name = "recording"
+
+    def __init__(self, inner: ChatBackend):
+        self.inner = inner
+        self.calls: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def create(self, request: Dict[str, Any]):
+        start = time.perf_counter()
+        response = self.inner.create(request)
+        elapsed = time.perf_counter() - start
+
+        usage = getattr(response, "usage", None)
+        entry = {
+            "stage": classify_stage(request),
+            "seconds": elapsed,
+            "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+            "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+        }
+        with self._lock:
+            self.calls.append(entry)
+        return response
+
+
+def _timed(fn, stage: str, sink: List[Dict[str, Any]], lock: threading.Lock):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with lock:
+                sink.append({"stage": stage, "seconds": time.perf_counter() - start})
+    return wrapper
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"count": 0, "p50": 0.0, "p95": 0.0, "p99": 0.0, "mean": 0.0}
+    arr = np.asarray(values, dtype=float)
+    p50, p95, p99 = np.percentile(arr, [50, 95, 99])
+    return {"count": int(arr.size), "p50": float(p50), "p95": float(p95),
+            "p99": float(p99), "mean": float(arr.mean())}
+
+
+def peak_rss_mb() -> float:
+    # Linux 上 ru_maxrss 单位为 KB，macOS 上为字节
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if platform.system() == "Darwin" else rss / 1024
+
+
+def run_benchmark(csv_path: str,
+                  latency=("lognormal", 0.05, 0.5),
+                  failure_rate: float = 0.0,
+                  max_workers: int = 1,
+                  seed: int = 0,
+                  quiet: bool = True,
+                  main_kwargs: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    recorder = RecordingBackend(StubBackend(latency=latency, failure_rate=failure_rate, seed=seed))
+    set_backend(recorder)
+
+    local_calls: List[Dict[str, Any]] = []
+    lock = threading.Lock()
+    originals = {
+        "aggregate_panel": process.aggregate_panel,
+        "enforce_nm_m_consistency": process.enforce_nm_m_consistency,
+    }
+    process.aggregate_panel = _timed(originals["aggregate_panel"], "post:aggregate_panel", local_calls, lock)
+    process.enforce_nm_m_consistency = _timed(originals["enforce_nm_m_consistency"],
+                                              "post:enforce_nm_m_consistency", local_calls, lock)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        output_jsonl = os.path.join(tmp, "bench.jsonl")
+        start = time.perf_counter()
+        log = io.StringIO() if quiet else None
+        try:
+            with contextlib.redirect_stdout(log) if quiet else contextlib.nullcontext():
+                main_module.main(csv_path, output_jsonl, max_workers=max_workers, **(main_kwargs or {}))
+        finally:
+            process.aggregate_panel = originals["aggregate_panel"]
+            process.enforce_nm_m_consistency = originals["enforce_nm_m_consistency"]
+            set_backend(None)
+        wall = time.perf_counter() - start
+
+        # 经索引层读取：压缩、分段的结果也按窗口计数，字节数为各段落盘大小之和
+        windows = sum(1 for _ in iter_lines(output_jsonl))
+        compression = detect_compression(output_jsonl)
+        output_bytes = sum(os.path.getsize(segment_path(output_jsonl, segment, compression))
+                           for segment in list_segments(output_jsonl, compression))
+
+    stages: Dict[str, List[float]] = {}
+    for entry in recorder.calls + local_calls:
+        stages.setdefault(entry["stage"], []).append(entry["seconds"])
+
+    prompt_tokens = sum(c["prompt_tokens"] for c in recorder.calls)
+    completion_tokens = sum(c["completion_tokens"] for c in recorder.calls)
+    per_window = max(windows, 1)
+
+    return {
+        "input": csv_path,
+        "max_workers": max_workers,
+        "latency": list(latency) if isinstance(latency, tuple) else latency,
+        "failure_rate": failure_rate,
+        "windows": windows,
+        "wall_seconds": wall,
+        "windows_per_second": windows / wall if wall > 0 else 0.0,
+        "llm_calls": len(recorder.calls),
+        "llm_calls_per_window": len(recorder.calls) / per_window,
+        "prompt_tokens_per_window": prompt_tokens / per_window,
+        "completion_tokens_per_window": completion_tokens / per_window,
+        "stages": {stage: percentiles(values) for stage, values in sorted(stages.items())},
+        "output_bytes": output_bytes,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the GeoDecider pipeline against the stub backend.")
+    parser.add_argument("--csv", nargs="*", default=[], help="recorded well CSVs; synthetic data if omitted")
+    parser.add_argument("--rows", type=int, default=800, help="rows per synthetic well")
+    parser.add_argument("--wells", type=int, default=1, help="number of synthetic wells")
+    parser.add_argument("--latency", default="lognormal:0.05:0.5")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="", help="write results as JSON to this path")
+    args = parser.parse_args()
+
+    latency = parse_latency(args.latency)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        inputs = list(args.csv)
+        if not inputs:
+            synthetic = os.path.join(tmp_dir, "synthetic.csv")
+            make_synthetic_well(args.rows, args.wells, args.seed).to_csv(synthetic, index=False)
+            inputs.append(synthetic)
+
+        for path in inputs:
+            results.append(run_benchmark(path, latency=latency, failure_rate=args.failure_rate,
+                                         max_workers=args.workers, seed=args.seed))
+
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "runs": results}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
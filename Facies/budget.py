@@ -0,0 +1,182 @@
+# budget.py
+# Budget-aware scheduling. Before any LLM call every window is scored for
+# uncertainty (base-classifier margin, Predicted_Facies churn, NM_M
+# transitions), and a call or token budget per run or per well is spent in
+# order of that score: first every uncertain window gets a single persona,
+# then whatever is left upgrades the hardest windows to the full panel with
+# tools. The rest accept the base classifier, so spend per well is bounded and
+# known up front.
+import math
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from routing import row_confidence
+from table_format import estimate_tokens, format_table
+
+TIERS = ("accept", "single", "full")
+BUDGET_SCOPES = ("run", "well")
+
+# 每次调用的提示与推理开销（静态知识、工具输出、推理 token），不含数据表本身
+DEFAULT_CALL_TOKENS = 3000
+DEFAULT_WEIGHTS = {"margin": 1.0, "churn": 1.0, "nm_m": 0.5}
+
+
+def _row_signals(well) -> Dict[str, np.ndarray]:
+    # 逐行信号的前缀和，窗口内的均值/计数都能 O(1) 取得
+    df = well.df
+    n = len(df)
+    conf = row_confidence(df)
+    if conf is None:
+        uncertain = np.full(n, 0.5)
+    else:
+        uncertain = 1.0 - np.clip(np.nan_to_num(np.asarray(conf, dtype=float), nan=0.0), 0.0, 1.0)
+
+    def changes(column: str) -> np.ndarray:
+        if column not in df.columns or n == 0:
+            return np.zeros(n)
+        values = df[column].astype(str).to_numpy()
+        return np.r_[0.0, (values[1:] != values[:-1]).astype(float)]
+
+    return {
+        "uncertain": np.r_[0.0, np.cumsum(uncertain)],
+        "churn": np.r_[0.0, np.cumsum(changes("Predicted_Facies"))],
+        "nm_m": np.r_[0.0, np.cumsum(changes("NM_M"))],
+    }
+
+
+def _tokens_per_row(well, columns: Sequence[str], sample_rows: int = 64) -> float:
+    cols = [c for c in columns if c in well.df.columns]
+    sample = well.df.iloc[:sample_rows]
+    if not len(sample):
+        return 0.0
+    return estimate_tokens(format_table(sample, cols)) / len(sample)
+
+
+def window_uncertainty(well, start: int, end: int,
+                       weights: Optional[Dict[str, float]] = None) -> Dict[str, float]:
+    weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+    signals = well.cached("budget_signals", lambda: _row_signals(well))
+    n = max(1, end - start)
+    pairs = max(1, end - start - 1)
+    margin = (signals["uncertain"][end] - signals["uncertain"][start]) / n
+    # 窗口内相邻行之间的变化，不计窗口第一行与上一窗口之间
+    churn = (signals["churn"][end] - signals["churn"][start + 1]) / pairs if end - start > 1 else 0.0
+    nm_m = 1.0 if end - start > 1 and signals["nm_m"][end] - signals["nm_m"][start + 1] > 0 else 0.0
+    total = sum(weights.values()) or 1.0
+    score = (weights["margin"] * margin + weights["churn"] * churn + weights["nm_m"] * nm_m) / total
+    return {"margin": float(margin), "churn": float(churn), "nm_m": nm_m, "score": float(score)}
+
+
+def tier_calls(planner_mode: str = "llm", trend_mode: str = "llm",
+               panel_size: int = 3) -> Dict[str, int]:
+    # 上界：规划器（rules 模式不调用）、LLM 趋势分析、每个 persona 一次；single 档只有一次 persona 调用
+    full = panel_size + (0 if planner_mode == "rules" else 1) + (1 if trend_mode == "llm" else 0)
+    return {"accept": 0, "single": 1, "full": full}
+
+
+def tier_pipeline_options(tier: str, pipeline_options: Dict[str, Any],
+                          single_persona: str = "model_aware") -> Dict[str, Any]:
+    if tier == "single":
+        return {**pipeline_options, "planner_mode": "rules", "trend_mode": "local",
+                "panel_mode": "full", "panel_order": [single_persona]}
+    return pipeline_options
+
+
+def allocate(items: List[Dict[str, Any]],
+             budget_calls: Optional[float] = None,
+             budget_tokens: Optional[float] = None,
+             min_score: float = 0.0) -> Tuple[Dict[int, str], Dict[str, float]]:
+    left_calls = math.inf if budget_calls is None else float(budget_calls)
+    left_tokens = math.inf if budget_tokens is None else float(budget_tokens)
+    tiers = {it["window_id"]: "accept" for it in items}
+    order = sorted((it for it in items if it["score"] > min_score), key=lambda it: (-it["score"], it["window_id"]))
+
+    # 先让尽可能多的不确定窗口至少被一个 persona 看过，剩余预算再按难度升级为完整 panel
+    for it in order:
+        calls, tokens = it["cost"]["single"]
+        if calls <= left_calls and tokens <= left_tokens:
+            tiers[it["window_id"]] = "single"
+            left_calls -= calls
+            left_tokens -= tokens
+    for it in order:
+        if tiers[it["window_id"]] != "single":
+            continue
+        calls = it["cost"]["full"][0] - it["cost"]["single"][0]
+        tokens = it["cost"]["full"][1] - it["cost"]["single"][1]
+        if calls <= left_calls and tokens <= left_tokens:
+            tiers[it["window_id"]] = "full"
+            left_calls -= calls
+            left_tokens -= tokens
+
+    spent = {
+        "calls": sum(it["cost"][tiers[it["window_id"]]][0] for it in items),
+        "tokens": sum(it["cost"][tiers[it["window_id"]]][1] for it in items),
+    }
+    return tiers, spent
+
+
+class BudgetPlan:
+    def __init__(self, windows: Dict[int, Dict[str, Any]], groups: Dict[str, Dict[str, Any]], scope: str):
+        self.windows = windows
+        self.groups = groups
+        self.scope = scope
+
+    def get(self, window_id: int) -> Optional[Dict[str, Any]]:
+        return self.windows.get(window_id)
+
+    def summary(self) -> Dict[str, Any]:
+        counts = {tier: 0 for tier in TIERS}
+        for w in self.windows.values():
+            counts[w["tier"]] += 1
+        return {
+            "scope": self.scope,
+            "windows": len(self.windows),
+            "tiers": counts,
+            "estimated_calls": sum(g["spent"]["calls"] for g in self.groups.values()),
+            "estimated_tokens": int(sum(g["spent"]["tokens"] for g in self.groups.values())),
+        }
+
+    def format(self) -> str:
+        s = self.summary()
+        tiers = ", ".join(f"{tier}={s['tiers'][tier]}" for tier in TIERS)
+        return (f"Budget plan ({s['scope']}): {s['windows']} windows [{tiers}], "
+                f"~{s['estimated_calls']} calls, ~{s['estimated_tokens']} tokens")
+
+
+def plan_budget(jobs: Iterable[Dict[str, Any]],
+                budget_calls: Optional[float] = None,
+                budget_tokens: Optional[float] = None,
+                scope: str = "run",
+                min_score: float = 0.05,
+                calls: Optional[Dict[str, int]] = None,
+                call_tokens: int = DEFAULT_CALL_TOKENS,
+                columns: Sequence[str] = (),
+                weights: Optional[Dict[str, float]] = None) -> BudgetPlan:
+    if scope not in BUDGET_SCOPES:
+        raise ValueError(f"Unknown budget scope {scope!r}, expected one of {BUDGET_SCOPES}")
+    calls = calls or tier_calls()
+
+    # 只看窗口划分与逐行信号，不做任何 LLM 调用；窗口号确定，续跑时得到同一份计划
+    items: Dict[str, List[Dict[str, Any]]] = {}
+    for job in jobs:
+        well = job["well"]
+        per_row = well.cached("budget_tokens_per_row", lambda: _tokens_per_row(well, columns))
+        u = window_uncertainty(well, job["start"], job["end"], weights)
+        per_call = call_tokens + per_row * (job["end"] - job["start"])
+        items.setdefault(job["well_name"] if scope == "well" else "", []).append({
+            "window_id": job["window_id"],
+            "score": u["score"],
+            "signals": u,
+            "cost": {tier: (calls[tier], calls[tier] * per_call) for tier in TIERS},
+        })
+
+    windows: Dict[int, Dict[str, Any]] = {}
+    groups: Dict[str, Dict[str, Any]] = {}
+    for name, group in items.items():
+        tiers, spent = allocate(group, budget_calls, budget_tokens, min_score)
+        groups[name] = {"spent": spent, "windows": len(group)}
+        for it in group:
+            windows[it["window_id"]] = {"tier": tiers[it["window_id"]], "score": round(it["score"], 4),
+                                        "scope": scope}
+    return BudgetPlan(windows, groups, scope)
@@ -0,0 +1,203 @@
+# governor.py
+# Shared call governor for LLM requests: token buckets for requests and tokens
+# per minute, an AIMD concurrency limit that shrinks on rate-limit responses
+# and grows only while calls succeed, and jittered exponential backoff on
+# retryable errors.
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = {"APITimeoutError", "APIConnectionError", "RateLimitError",
+                    "InternalServerError", "Timeout", "ConnectError", "ReadTimeout"}
+# 调用结果三态：只有 success 放大并发，throttled 收缩，其余错误保持不变
+OUTCOMES = ("success", "throttled", "error")
+
+
+def error_status(error: BaseException) -> Optional[int]:
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+def is_retryable(error: BaseException) -> bool:
+    if type(error).__name__ in RETRYABLE_ERRORS:
+        return True
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    return error_status(error) in RETRYABLE_STATUS
+
+
+def is_throttled(error: BaseException) -> bool:
+    return error_status(error) == 429 or type(error).__name__ == "RateLimitError"
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self, amount: float = 1.0) -> float:
+        # 单次请求超过桶容量时按容量计，避免永远等待
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return waited
+                delay = (amount - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def charge(self, amount: float) -> None:
+        # 实际用量超出预估时补扣，允许短暂为负
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+
+
+class AIMDLimiter:
+    def __init__(self, initial: float = 4, minimum: float = 1, maximum: float = 64,
+                 increase: float = 1.0, decrease: float = 0.5, cooldown: float = 2.0):
+        self.limit = float(initial)
+        self.minimum = float(minimum)
+        self.maximum = float(maximum)
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self._in_use = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> float:
+        start = time.monotonic()
+        with self._cond:
+            while self._in_use >= max(1, int(self.limit)):
+                self._cond.wait()
+            self._in_use += 1
+        return time.monotonic() - start
+
+    def release(self, outcome: str = "success") -> None:
+        if outcome not in OUTCOMES:
+            raise ValueError(f"Unknown call outcome {outcome!r}, expected one of {OUTCOMES}")
+        with self._cond:
+            self._in_use -= 1
+            now = time.monotonic()
+            if outcome == "throttled":
+                # 同一波 429 只收缩一次
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._last_decrease = now
+            elif outcome == "success":
+                # 每个“窗口”（约 limit 次成功）加 increase；5xx/超时/连接错误不算成功
+                self.limit = min(self.maximum, self.limit + self.increase / max(self.limit, 1.0))
+            self._cond.notify_all()
+
+
+class CallGovernor:
+    def __init__(self,
+                 requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None,
+                 max_concurrency: Optional[int] = None,
+                 initial_concurrency: Optional[int] = None,
+                 min_concurrency: int = 1,
+                 max_retries: int = 5,
+                 base_delay: float = 1.0,
+                 max_delay: float = 60.0,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.limiter = None
+        if max_concurrency:
+            self.limiter = AIMDLimiter(initial=initial_concurrency or max(min_concurrency, max_concurrency // 2),
+                                       minimum=min_concurrency, maximum=max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._sleep = sleep
+
+    def backoff(self, attempt: int, error: BaseException) -> float:
+        hint = retry_after(error)
+        if hint is not None:
+            return min(self.max_delay, hint)
+        # full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def call(self, fn: Callable[[], Any], estimated_tokens: int = 0,
+             stats: Optional[Dict[str, Any]] = None,
+             used_tokens: Optional[Callable[[Any], int]] = None) -> Any:
+        if stats is None:
+            stats = {}
+        stats.setdefault("retries", 0)
+        stats.setdefault("throttle_seconds", 0.0)
+
+        attempt = 0
+        while True:
+            waited = 0.0
+            if self.requests is not None:
+                waited += self.requests.acquire(1)
+            if self.tokens is not None and estimated_tokens:
+                waited += self.tokens.acquire(estimated_tokens)
+            if self.limiter is not None:
+                waited += self.limiter.acquire()
+            stats["throttle_seconds"] += waited
+
+            # KeyboardInterrupt 等也按 error 释放
+            outcome = "error"
+            try:
+                result = fn()
+            except Exception as e:
+                outcome = "throttled" if is_throttled(e) else "error"
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = self.backoff(attempt, e)
+                print(f"Retryable LLM error ({e}); retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+            else:
+                outcome = "success"
+                if self.tokens is not None and used_tokens is not None:
+                    extra = used_tokens(result) - estimated_tokens
+                    if extra > 0:
+                        self.tokens.charge(extra)
+                return result
+            finally:
+                if self.limiter is not None:
+                    self.limiter.release(outcome)
+
+            attempt += 1
+            stats["retries"] = attempt
+            self._sleep(delay)
+
+
+_governor = CallGovernor()
+
+
+def configure_governor(**kwargs) -> CallGovernor:
+    global _governor
+    _governor = CallGovernor(**kwargs)
+    return _governor
+
+
+def get_governor() -> CallGovernor:
+    return _governor
@@ -0,0 +1,73 @@
+# http_client.py
+# One pooled HTTP client shared by every OpenAI-compatible backend in the
+# process. It is built on first use (so importing the pipeline never touches
+# the network stack), keeps connections alive between calls, negotiates HTTP/2
+# when the h2 package is installed, and is rebuilt after a fork so worker
+# processes never share sockets with their parent.
+import importlib.util
+import os
+import threading
+from typing import Any, Dict, Optional
+
+DEFAULT_MAX_CONNECTIONS = 16
+
+_options: Dict[str, Any] = {
+    "max_connections": DEFAULT_MAX_CONNECTIONS,
+    "keepalive_expiry": 30.0,
+    "http2": None,
+    "timeout": 600.0,
+}
+_client = None
+_client_pid: Optional[int] = None
+_lock = threading.Lock()
+
+
+def http2_available() -> bool:
+    return importlib.util.find_spec("h2") is not None
+
+
+def configure_http(max_connections: Optional[int] = None, keepalive_expiry: float = 30.0,
+                   http2: Optional[bool] = None, timeout: float = 600.0) -> None:
+    # http2=None 时有 h2 就用 HTTP/2
+    _options.update(max_connections=max(1, int(max_connections or DEFAULT_MAX_CONNECTIONS)),
+                    keepalive_expiry=keepalive_expiry, http2=http2, timeout=timeout)
+    close_http_client()
+
+
+def http_options() -> Dict[str, Any]:
+    return dict(_options)
+
+
+def _build():
+    from openai import DEFAULT_CONNECTION_LIMITS, DefaultHttpxClient
+
+    # 连接池上限与并发数一致，空闲连接全部保活，省去重复的 TCP/TLS 握手
+    limits = type(DEFAULT_CONNECTION_LIMITS)(
+        max_connections=_options["max_connections"],
+        max_keepalive_connections=_options["max_connections"],
+        keepalive_expiry=_options["keepalive_expiry"],
+    )
+    http2 = _options["http2"]
+    if http2 is None:
+        http2 = http2_available()
+    return DefaultHttpxClient(limits=limits, http2=http2, timeout=_options["timeout"])
+
+
+def get_http_client():
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _lock:
+            if _client is None or _client_pid != pid:
+                _client = _build()
+                _client_pid = pid
+    return _client
+
+
+def close_http_client() -> None:
+    global _client, _client_pid
+    with _lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
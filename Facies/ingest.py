@@ -0,0 +1,76 @@
+# ingest.py
+# Streaming, well-aware ingestion. The CSV is read in chunks and rows are
+# grouped into one DataFrame per well, so memory is bounded by the largest
+# well rather than the whole export, and windows (with their up/down context)
+# never straddle two wells. Row labels of each well DataFrame are the global
+# row positions in the source CSV.
+import threading
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+import pandas as pd
+
+WELL_COLUMN = "Well Name"
+
+
+class WellContext:
+    # 一口井的数据及其按需构建、在该井所有窗口间共享的派生结构（趋势引擎等）
+    def __init__(self, name: str, df: pd.DataFrame):
+        self.name = name
+        self.df = df
+        self._cache: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def cached(self, key: str, factory: Callable[[], Any]) -> Any:
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = factory()
+            return self._cache[key]
+
+
+def iter_wells(file_path: str,
+               well_column: Optional[str] = WELL_COLUMN,
+               chunksize: int = 50_000) -> Iterator[Tuple[str, pd.DataFrame]]:
+    row_offset = 0
+    pending: list = []
+    pending_name = None
+    seen = set()
+
+    reader = pd.read_csv(file_path, chunksize=chunksize)
+    for chunk in reader:
+        chunk.index = pd.RangeIndex(row_offset, row_offset + len(chunk))
+        row_offset += len(chunk)
+
+        if not well_column or well_column not in chunk.columns:
+            # 没有井名列时整份文件视为一口井
+            pending.append(chunk)
+            pending_name = ""
+            continue
+
+        names = chunk[well_column].astype(str)
+        # 相邻行井名变化处切分；井通常在导出文件中连续存放
+        breaks = (names != names.shift()).to_numpy().nonzero()[0]
+        bounds = list(breaks) + [len(chunk)]
+        for k in range(len(bounds) - 1):
+            part = chunk.iloc[bounds[k]: bounds[k + 1]]
+            name = names.iloc[bounds[k]]
+            if name != pending_name and pending:
+                yield _emit(pending_name, pending, seen)
+                pending = []
+            pending_name = name
+            pending.append(part)
+
+    if pending:
+        yield _emit(pending_name, pending, seen)
+
+
+def _emit(name: str, parts: list, seen: set) -> Tuple[str, pd.DataFrame]:
+    if name in seen:
+        print(f"Warning: well {name!r} appears in more than one contiguous block; "
+              f"blocks are processed separately.")
+    seen.add(name)
+    return name, pd.concat(parts) if len(parts) > 1 else parts[0]
+
+
+def iter_window_starts(n_rows: int, window_size: int, step_size: int) -> Iterator[Tuple[int, int]]:
+    for start in range(0, n_rows, step_size):
+        yield start, min(start + window_size, n_rows)
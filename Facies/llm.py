@@ -0,0 +1,108 @@
+# llm.py
+# Single entry point for chat-completion requests: cache lookup, then the
+# configured backend under the call governor (rate limits, adaptive
+# concurrency, retries). When a stats dict is passed it receives the token
+# usage, retry count and whether the answer came from the cache. With a
+# validator the answer is streamed into it and the generation is cut off as
+# soon as the validator rejects the output.
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+
+from backends import get_backend
+from governor import get_governor
+from llm_cache import get_cache, request_key
+from metrics import usage_to_dict
+from table_format import estimate_tokens as estimate_text_tokens
+
+
+def estimate_tokens(request: Dict[str, Any]) -> int:
+    text = "\n".join(m.get("content") or "" for m in request.get("messages", []))
+    return estimate_text_tokens(text) + int(request.get("max_tokens") or 0)
+
+
+def _used_tokens(response) -> int:
+    usage = getattr(response, "usage", None)
+    return int(getattr(usage, "total_tokens", 0) or 0)
+
+
+def _consume_stream(backend, request: Dict[str, Any], validator):
+    # 每次（重试）尝试都从头喂给 validator；validator 拒绝后立即关闭连接
+    validator.reset()
+    stream = backend.stream(request)
+    think: List[str] = []
+    answer: List[str] = []
+    usage = None
+    aborted = False
+    try:
+        for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            for choice in getattr(chunk, "choices", None) or []:
+                delta = choice.delta
+                reasoning = getattr(delta, "reasoning_content", None)
+                if reasoning:
+                    think.append(reasoning)
+                if delta.content:
+                    answer.append(delta.content)
+                    if not validator.feed(delta.content):
+                        aborted = True
+            if aborted:
+                break
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+
+    think_text, answer_text = "".join(think), "".join(answer)
+    if usage is None:
+        # 中途断开时服务端不会发送 usage，按已收到的文本估算
+        prompt_tokens = estimate_tokens(request)
+        reasoning_tokens = estimate_text_tokens(think_text) if think_text else 0
+        completion_tokens = reasoning_tokens + (estimate_text_tokens(answer_text) if answer_text else 0)
+        usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                total_tokens=prompt_tokens + completion_tokens,
+                                completion_tokens_details=SimpleNamespace(reasoning_tokens=reasoning_tokens))
+    message = SimpleNamespace(role="assistant", content=answer_text, reasoning_content=think_text)
+    return SimpleNamespace(choices=[SimpleNamespace(index=0, message=message,
+                                                    finish_reason="aborted" if aborted else "stop")],
+                           usage=usage, aborted=aborted)
+
+
+def complete(request: Dict[str, Any], stats: Optional[Dict[str, Any]] = None,
+             validator=None) -> Tuple[str, str]:
+    if stats is None:
+        stats = {}
+    stats.setdefault("retries", 0)
+
+    cache = get_cache()
+    key = request_key(request) if cache is not None else None
+
+    if cache is not None:
+        hit = cache.get(key)
+        if hit is not None:
+            stats["cache_hit"] = True
+            if validator is not None:
+                validator.reset()
+                validator.feed(hit["answer"])
+            return hit["think"], hit["answer"]
+
+    backend = get_backend()
+    if validator is not None:
+        fn = lambda: _consume_stream(backend, request, validator)
+    else:
+        fn = lambda: backend.create(request)
+    response = get_governor().call(fn, estimate_tokens(request), stats, used_tokens=_used_tokens)
+    think = response.choices[0].message.reasoning_content
+    answer = response.choices[0].message.content
+
+    stats["cache_hit"] = False
+    stats.update(usage_to_dict(getattr(response, "usage", None)))
+
+    if getattr(response, "aborted", False):
+        # 被截断的回答不进缓存
+        stats["stream_aborted"] = True
+        return think, answer
+
+    if cache is not None:
+        cache.put(key, {"think": think, "answer": answer})
+    return think, answer
@@ -0,0 +1,154 @@
+# llm_cache.py
+# Content-addressed on-disk cache for chat-completion calls. Entries are keyed
+# by a hash of the full request (model, messages and parameters) and stored in
+# SQLite, so several processes working on the same runs can share one file.
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+CACHE_MODES = ("rw", "ro", "off")
+
+
+def request_key(request: Dict[str, Any]) -> str:
+    payload = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    def __init__(self, path: str, mode: str = "rw",
+                 max_bytes: Optional[int] = None,
+                 max_age: Optional[float] = None,
+                 evict_every: int = 100):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode {mode!r}, expected one of {CACHE_MODES}")
+
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.evict_every = evict_every
+        self._local = threading.local()
+        self._puts = 0
+        self._lock = threading.Lock()
+
+        if mode != "off":
+            cache_dir = os.path.dirname(path)
+            if cache_dir and not os.path.exists(cache_dir):
+                os.makedirs(cache_dir, exist_ok=True)
+            conn = self._conn()
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created REAL NOT NULL,"
+                " accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions(accessed)")
+            conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 连接不能跨线程共享，每个线程各开一个
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        if self.mode == "off":
+            return None
+
+        conn = self._conn()
+        row = conn.execute("SELECT value, created FROM completions WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        value, created = row
+        now = time.time()
+        if self.max_age is not None and now - created > self.max_age:
+            return None
+
+        if self.mode == "rw":
+            conn.execute("UPDATE completions SET accessed = ? WHERE key = ?", (now, key))
+            conn.commit()
+        return json.loads(value)
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        if self.mode != "rw":
+            return
+
+        payload = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO completions (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+            (key, payload, len(payload.encode("utf-8")), now, now),
+        )
+        conn.commit()
+
+        with self._lock:
+            self._puts += 1
+            due = self._puts % self.evict_every == 0
+        if due:
+            self.evict()
+
+    def evict(self) -> int:
+        if self.mode != "rw":
+            return 0
+
+        conn = self._conn()
+        removed = 0
+        if self.max_age is not None:
+            cur = conn.execute("DELETE FROM completions WHERE created < ?", (time.time() - self.max_age,))
+            removed += cur.rowcount
+
+        if self.max_bytes is not None:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+            if total > self.max_bytes:
+                # 按最近访问时间从旧到新删除，直到总大小回到上限以内
+                excess = total - self.max_bytes
+                freed = 0
+                victims = []
+                for key, size in conn.execute("SELECT key, size FROM completions ORDER BY accessed ASC"):
+                    victims.append((key,))
+                    freed += size
+                    if freed >= excess:
+                        break
+                conn.executemany("DELETE FROM completions WHERE key = ?", victims)
+                removed += len(victims)
+
+        conn.commit()
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        if self.mode == "off":
+            return {"entries": 0, "bytes": 0}
+        entries, size = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+        return {"entries": entries, "bytes": size}
+
+
+_cache: Optional[LLMCache] = None
+
+
+def configure_cache(path: Optional[str], mode: str = "rw",
+                    max_bytes: Optional[int] = None,
+                    max_age: Optional[float] = None) -> Optional[LLMCache]:
+    global _cache
+    if path is None or mode == "off":
+        _cache = None
+    else:
+        _cache = LLMCache(path, mode=mode, max_bytes=max_bytes, max_age=max_age)
+    return _cache
+
+
+def get_cache() -> Optional[LLMCache]:
+    return _cache
+
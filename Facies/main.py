@@ -1,92 +1,396 @@
 import pandas as pd
+import itertools
 import json
 import os
-from process import process_logic
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from process import PANEL_STYLES, process_logic
+from backends import set_backend
+from llm_cache import configure_cache
+from governor import configure_governor
+from http_client import configure_http
+from neighbors import configure_neighbors
+from planner import configure_planner
+from table_format import configure_tables
+from batching import configure_batching
+from refinement import refine_outputs, refined_path
+from segmentation import WINDOWING_MODES, adaptive_windows
+from structured_output import configure_answers
+from budget import plan_budget, tier_calls, tier_pipeline_options
+from metrics import configure_metrics, close_metrics, make_sink, record, run_summary, stage_timer
+from routing import route_window, merge_routed_labels, base_labels
+from results import SidecarWriter, lean_meta, row_ranges, sidecar_path, window_columns
+from result_index import index_path, rebuild, recover, results_exist
+from result_writer import ResultWriter
+from ingest import WELL_COLUMN, WellContext, iter_wells, iter_window_starts
 
 target_columns = ['Depth', 'GR', 'ILD_log10', 'DeltaPHI', 'PHIND', 'PE', 'NM_M', 'RELPOS', 'Predicted_Facies']
 
 
-def main(file_path, output_jsonl):
+def build_meta_data(df, start, end, current_window_id, window_size, step_size, well=None):
+    # df 为单口井的数据，行标签是源 CSV 中的全局行号
+    window_df = df.iloc[start: end]
+    row_offset = int(df.index[0]) if len(df) else 0
+
+    meta_data = {}
+    meta_data['target_columns'] = target_columns
+    meta_data['current_window_id'] = current_window_id
+    meta_data['window_df'] = window_df
+    meta_data['window_up'] = df.iloc[max(0, start - step_size): start] if start - step_size >= 0 else pd.DataFrame()
+    meta_data['window_down'] = df.iloc[end: end + step_size] if end < len(df) else pd.DataFrame()
+    meta_data['is_full_window'] = (len(window_df) == window_size)
+    meta_data['rows'] = {name: [a + row_offset, b + row_offset]
+                         for name, (a, b) in row_ranges(len(df), start, end, step_size).items()}
+    if well is not None:
+        meta_data['well'] = well
+    return meta_data
+
+
+def process_window(df, i, current_window_id, window_size, step_size,
+                   routing_threshold=None, routing_mode="margin", routing_context=2,
+                   well=None, pipeline_options=None, budget=None, single_persona="model_aware"):
+    pipeline_options = pipeline_options or {}
+    end = min(i + window_size, len(df))
+    meta_data = build_meta_data(df, i, end, current_window_id, window_size, step_size, well)
+
+    if budget is not None:
+        # 预算档位：accept 直接采用基分类器，single 只跑一个 persona，full 走完整流程
+        meta_data['budget'] = budget
+        if budget["tier"] == "accept":
+            print(f"Budget tier 'accept' (uncertainty {budget['score']}), accepting base classifier predictions.")
+            answer = json.dumps({"answer": base_labels(meta_data['window_df'])}, ensure_ascii=False)
+            return "", "", answer, meta_data
+        pipeline_options = tier_pipeline_options(budget["tier"], pipeline_options, single_persona)
+
+    if routing_threshold is None:
+        print('Calling API / Agent pipeline...')
+        return process_logic(meta_data, **pipeline_options)
+
+    window_df = meta_data['window_df']
+    routing = route_window(window_df, routing_threshold, mode=routing_mode, context_rows=routing_context)
+    llm_span = routing["llm_span"]
+
+    if llm_span is None:
+        print(f"All {len(window_df)} rows confident, accepting base classifier predictions.")
+        meta_data['routing'] = routing
+        answer = json.dumps({"answer": base_labels(window_df)}, ensure_ascii=False)
+        return "", "", answer, meta_data
+
+    # 只把模糊的行（以及上下文）交给 agent 流程
+    sub_start, sub_end = i + llm_span[0], i + llm_span[1]
+    row_offset = meta_data['rows']['window'][0] - i
+    print(f"{routing['num_confident']}/{len(window_df)} rows confident, "
+          f"routing rows {sub_start + row_offset} → {sub_end + row_offset - 1} to the agent pipeline...")
+    sub_meta = build_meta_data(df, sub_start, sub_end, current_window_id, window_size, step_size, well)
+    prompt, think, _, sub_meta = process_logic(sub_meta, **pipeline_options)
+
+    llm_labels = sub_meta["panel_aggregation"]["final_labels"]
+    labels = merge_routed_labels(window_df, llm_span, llm_labels, routing["confident"])
+
+    sub_meta['window_df'] = meta_data['window_df']
+    sub_meta['window_up'] = meta_data['window_up']
+    sub_meta['window_down'] = meta_data['window_down']
+    sub_meta['is_full_window'] = meta_data['is_full_window']
+    sub_meta['rows'] = meta_data['rows']
+    sub_meta['routing'] = routing
+    sub_meta['routing']['llm_labels'] = llm_labels
+    if budget is not None:
+        sub_meta['budget'] = budget
+    answer = json.dumps({"answer": labels}, ensure_ascii=False)
+    return prompt, think, answer, sub_meta
+
+
+def build_record(prompt, think, answer, meta_data, lean=False):
+    # 将 raw 里的 DataFrame 转成可序列化结构
+    raw = meta_data.get("raw", {})
+    if isinstance(raw.get("window_df"), pd.DataFrame):
+        raw["window_df"] = raw["window_df"].to_dict(orient='records')
+    if isinstance(raw.get("window_up"), pd.DataFrame):
+        raw["window_up"] = raw["window_up"].to_dict(orient='records')
+    if isinstance(raw.get("window_down"), pd.DataFrame):
+        raw["window_down"] = raw["window_down"].to_dict(orient='records')
+    meta_data["raw"] = raw
+    meta_data.pop("well", None)
+
+    if lean:
+        # 只记录源 CSV 中的行号区间，由 results.load_records 按需还原
+        meta_data = lean_meta(meta_data)
+    else:
+        meta_data['window_df'] = meta_data['window_df'].to_dict(orient='records')
+        meta_data['window_up'] = meta_data['window_up'].to_dict(orient='records')
+        meta_data['window_down'] = meta_data['window_down'].to_dict(orient='records')
+
+    return {
+        "meta_data": meta_data,
+        "content": {
+            "prompt": prompt,
+            "think": think,
+            "answer": answer,
+        },
+    }
+
+
+def generate_windows(file_path, window_size, step_size, well_column, chunksize, skip_until_id=0,
+                     adaptive=None):
+    # adaptive 为 segmentation.adaptive_windows 的参数；窗口划分是确定性的，续跑时按窗口号跳过
+    window_id = 0
+    for well_name, well_df in iter_wells(file_path, well_column, chunksize):
+        well = WellContext(well_name, well_df)
+        if adaptive is None:
+            spans = iter_window_starts(len(well_df), window_size, step_size)
+        else:
+            spans = adaptive_windows(well, **adaptive)
+        for start, end in spans:
+            window_id += 1
+            if window_id <= skip_until_id:
+                continue
+            yield {
+                "window_id": window_id,
+                "well_name": well_name,
+                "well": well,
+                "start": start,
+                "end": end,
+                "window_size": window_size if adaptive is None else end - start,
+                "rows": [int(well_df.index[start]), int(well_df.index[end - 1]) + 1],
+            }
+
+
+def run_window(job, window_size, step_size, window_options, output_options):
+    df, i = job["well"].df, job["start"]
+    current_window_id = job["window_id"]
+    well = f"well {job['well_name']}, " if job["well_name"] else ""
+    print(f"Processing window {current_window_id} ({well}Rows {job['rows'][0]} → {job['rows'][1] - 1})")
+
+    start = time.perf_counter()
+    prompt, think, answer, meta_data = process_window(
+        df, i, current_window_id, job.get("window_size", window_size), step_size, well=job["well"],
+        budget=job.get("budget"), **window_options
+    )
+    if job["well_name"]:
+        meta_data['well_name'] = job["well_name"]
+    record(meta_data, "window", {"seconds": time.perf_counter() - start})
+    print(f"Window {current_window_id} API call successful.")
+
+    depths = meta_data['window_df']['Depth'] if 'Depth' in meta_data['window_df'].columns else pd.Series(dtype=float)
+    info = {
+        "window_id": current_window_id,
+        "rows": meta_data['rows']['window'],
+        "depth_range": (float(depths.min()), float(depths.max())) if len(depths) else (float("nan"), float("nan")),
+    }
+
+    # JSON 编码与写盘交给后台写线程
+    columns = window_columns(meta_data, answer) if output_options["sidecar"] else None
+    if output_options["lean"]:
+        meta_data['source_csv'] = output_options["source_csv"]
+    result = build_record(prompt, think, answer, meta_data, lean=output_options["lean"])
+    print(f"Window {current_window_id} processed.")
+    print("-" * 50)
+    return result, columns, info
+
+
+def main(file_path, output_jsonl, max_workers=1,
+         routing_threshold=None, routing_mode="margin", routing_context=2,
+         cache_path=None, cache_mode="rw", cache_max_bytes=None, cache_max_age=None,
+         backend=None, metrics_path=None, metrics_format="csv",
+         lean=False, sidecar=None, well_column=WELL_COLUMN, chunksize=50_000,
+         requests_per_minute=None, tokens_per_minute=None, llm_concurrency=None, max_retries=5,
+         trend_mode="llm", neighbor_index=None, neighbor_k=5,
+         planner_mode="llm", plan_cache_path=None,
+         table_format="csv", table_precision=None, prompt_token_budget=None,
+         batch_windows=1, batch_wait=0.05,
+         panel_mode="full", panel_order=None, early_exit_agreement=None,
+         refine=False,
+         window_size=16, step_size=16, windowing="fixed",
+         max_window_rows=64, min_window_rows=8, boundary_margin=3, window_token_cap=None,
+         stream_answers=False, repair_rounds=1,
+         compression=None, rotate_bytes=None, fsync="none", write_queue=64, write_group=32,
+         panel_weights=None,
+         budget_calls=None, budget_tokens=None, budget_scope="run", budget_min_score=0.05,
+         single_persona="model_aware"):
+    if backend is not None:
+        set_backend(backend)
+    configure_metrics(make_sink(metrics_path, metrics_format))
+    configure_cache(cache_path, mode=cache_mode, max_bytes=cache_max_bytes, max_age=cache_max_age)
+    configure_governor(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute,
+                       max_concurrency=llm_concurrency, max_retries=max_retries)
+    # 每个窗口最多同时有规划/趋势/persona 等约 4 个请求在途
+    configure_http(max_connections=llm_concurrency or 4 * max_workers)
+    configure_neighbors(neighbor_index, k=neighbor_k)
+    configure_planner(plan_cache_path)
+    configure_tables(table_format, precision=table_precision, budget=prompt_token_budget)
+    # 批量分类需要多个窗口同时在途（max_workers > 1）才能凑批
+    configure_batching(batch_windows, batch_wait)
+    # 回答逐行校验；缺失或非法的行单独重查，stream_answers 时跑题即中断生成
+    configure_answers(stream=stream_answers, repair_rounds=repair_rounds)
+
     output_dir = os.path.dirname(output_jsonl)
     if output_dir and not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    df = pd.read_csv(file_path)
-    window_size = 16
-    step_size = 16
+    if windowing not in WINDOWING_MODES:
+        raise ValueError(f"Unknown windowing {windowing!r}, expected one of {WINDOWING_MODES}")
+    # adaptive 模式下窗口长度可变，step_size 只决定上下文行数
+    adaptive = None
+    if windowing == "adaptive":
+        adaptive = {
+            "max_rows": max_window_rows,
+            "min_rows": min_window_rows,
+            "boundary_margin": boundary_margin,
+            "token_cap": window_token_cap,
+            "columns": target_columns,
+        }
 
+    # 通过偏移索引续跑：只读索引尾部，并截掉崩溃时写了一半的记录
     start_window_idx = 0
-    if os.path.exists(output_jsonl):
-        with open(output_jsonl, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            start_window_idx = len(lines)
+    if results_exist(output_jsonl):
+        if os.path.exists(index_path(output_jsonl)):
+            last = recover(output_jsonl)
+        elif os.path.exists(output_jsonl):
+            last = rebuild(output_jsonl, step_size)
+        else:
+            raise ValueError(f"Compressed results for {output_jsonl} have no index; cannot resume")
+        if last is not None:
+            start_window_idx = last["window_id"]
 
-    start_row_index = start_window_idx * step_size
+    # 有预算时先扫一遍全部窗口，按不确定度分配档位（不调用 LLM）
+    plan = None
+    if budget_calls is not None or budget_tokens is not None:
+        calls = tier_calls(planner_mode, trend_mode, len(panel_order or PANEL_STYLES))
+        plan = plan_budget(generate_windows(file_path, window_size, step_size, well_column, chunksize,
+                                            adaptive=adaptive),
+                           budget_calls=budget_calls, budget_tokens=budget_tokens, scope=budget_scope,
+                           min_score=budget_min_score, calls=calls, columns=target_columns)
+        print(plan.format())
 
-    if start_row_index >= len(df):
+    # 按井流式读取，窗口及其上下文不会跨井
+    jobs = generate_windows(file_path, window_size, step_size, well_column, chunksize,
+                            skip_until_id=start_window_idx, adaptive=adaptive)
+    if plan is not None:
+        jobs = (dict(job, budget=plan.get(job["window_id"])) for job in jobs)
+    first_job = next(jobs, None)
+    if first_job is None:
         print("all windows have been processed. No more data to process.")
+        close_metrics()
         return
 
-    print(f"Starting processing from window {start_window_idx + 1} (Row index {start_row_index})...")
-
-    with open(output_jsonl, 'a', encoding='utf-8') as f:
-        for i in range(start_row_index, len(df), step_size):
-            current_window_id = i // step_size + 1
-            print(f"Processing window {current_window_id} (Rows {i} → {min(i + window_size, len(df)) - 1})")
-
-            window_df = df.iloc[i: i + window_size]
-
-            try:
-                meta_data = {}
-                meta_data['target_columns'] = target_columns
-                meta_data['current_window_id'] = current_window_id
-                meta_data['window_df'] = window_df
-                meta_data['window_up'] = df.iloc[max(0, i - step_size): i] if i - step_size >= 0 else pd.DataFrame()
-                meta_data['window_down'] = df.iloc[i + window_size: i + window_size + step_size] if i + window_size < len(df) else pd.DataFrame()
-                meta_data['is_full_window'] = (len(window_df) == window_size)
-
-                print('Calling API / Agent pipeline...')
-
-                prompt, think, answer, meta_data = process_logic(meta_data)
-                print(f"Window {current_window_id} API call successful.")
-
-                # 将 raw 里的 DataFrame 转成可序列化结构
-                raw = meta_data.get("raw", {})
-                if isinstance(raw.get("window_df"), pd.DataFrame):
-                    raw["window_df"] = raw["window_df"].to_dict(orient='records')
-                if isinstance(raw.get("window_up"), pd.DataFrame):
-                    raw["window_up"] = raw["window_up"].to_dict(orient='records')
-                if isinstance(raw.get("window_down"), pd.DataFrame):
-                    raw["window_down"] = raw["window_down"].to_dict(orient='records')
-                meta_data["raw"] = raw
-
-                meta_data['window_df'] = meta_data['window_df'].to_dict(orient='records')
-                meta_data['window_up'] = meta_data['window_up'].to_dict(orient='records')
-                meta_data['window_down'] = meta_data['window_down'].to_dict(orient='records')
-
-                record = {
-                    "meta_data": meta_data,
-                    "content": {
-                        "prompt": prompt,
-                        "think": think,
-                        "answer": answer,
-                    },
-                }
-
-                print(f"Window {current_window_id} processed.")
-                print("-" * 50)
-
-                f.write(json.dumps(record, ensure_ascii=False) + "\n")
-                f.flush()
-
-            except Exception as e:
-                print(f"Error processing window {current_window_id}: {e}")
+    print(f"Starting processing from window {start_window_idx + 1} (Row index {first_job['rows'][0]})...")
+    jobs = itertools.chain([first_job], jobs)
 
-                break
+    window_options = {
+        "routing_threshold": routing_threshold,
+        "routing_mode": routing_mode,
+        "routing_context": routing_context,
+        "single_persona": single_persona,
+        "pipeline_options": {
+            "trend_mode": trend_mode,
+            "planner_mode": planner_mode,
+            "panel_mode": panel_mode,
+            "panel_order": panel_order,
+            "early_exit_agreement": early_exit_agreement,
+            "panel_weights": panel_weights,
+        },
+    }
+    output_options = {
+        "lean": lean,
+        "sidecar": sidecar,
+        "source_csv": os.path.abspath(file_path),
+    }
+    sidecar_writer = SidecarWriter(sidecar_path(output_jsonl, sidecar), sidecar) if sidecar else None
+
+    # 后台组提交：记录按窗口顺序入队，写线程负责编码、压缩、分段与 fsync
+    writer = ResultWriter(output_jsonl, compression=compression, rotate_bytes=rotate_bytes, fsync=fsync,
+                          queue_size=write_queue, group_size=write_group, sidecar=sidecar_writer)
+
+    def emit(result):
+        record_obj, columns, info = result
+        writer.write(record_obj, info, columns)
+
+    def mark_error(job):
+        writer.mark_error(job["window_id"], job["rows"])
+
+    try:
+        if max_workers <= 1:
+            for job in jobs:
+                try:
+                    emit(run_window(job, window_size, step_size, window_options, output_options))
+                except Exception as e:
+                    print(f"Error processing window {job['window_id']}: {e}")
+                    mark_error(job)
+                    break
+        else:
+            run_windows_concurrently(emit, jobs, max_workers,
+                                     lambda job: run_window(job, window_size, step_size,
+                                                            window_options, output_options),
+                                     mark_error)
+    finally:
+        writer.close()
+        if sidecar_writer is not None:
+            sidecar_writer.flush()
 
+    if refine:
+        # 整口井的 Viterbi 平滑，跨窗口边界保持连续；也可用 refinement.py 离线重跑
+        with stage_timer(None, "refinement"):
+            refined = refine_outputs(output_jsonl, file_path, well_column)
+            refined.to_csv(refined_path(output_jsonl), index=False)
+        print(f"Refined labels saved in: {refined_path(output_jsonl)}")
+
+    close_metrics()
+    print("Run summary:")
+    print(run_summary().format())
     print(f"Done. Results saved in: {output_jsonl}")
 
 
+def run_windows_concurrently(emit, jobs, max_workers, run_one, on_error=None):
+    # 窗口并发执行，但按窗口顺序写出：只写出连续完成的前缀，
+    # 这样中途崩溃后按索引续跑依然正确。窗口按需从 jobs 中取出，
+    # 因此同时驻留内存的只有在途窗口所在的井。
+    jobs = iter(jobs)
+    submitted = {}
+    pending = {}
+    next_to_write = 0
+    next_seq = 0
+    exhausted = False
+    first_error = None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}
+        while True:
+            while first_error is None and not exhausted and len(in_flight) < max_workers:
+                job = next(jobs, None)
+                if job is None:
+                    exhausted = True
+                    break
+                submitted[next_seq] = job
+                in_flight[executor.submit(run_one, job)] = next_seq
+                next_seq += 1
+
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                k = in_flight.pop(future)
+                if future.cancelled():
+                    continue
+                try:
+                    pending[k] = future.result()
+                except Exception as e:
+                    print(f"Error processing window {submitted[k]['window_id']}: {e}")
+                    first_error = k if first_error is None else min(first_error, k)
+                    # 出错窗口之后的结果都不能写出
+                    for other in list(in_flight):
+                        if in_flight[other] > k:
+                            other.cancel()
+
+            while next_to_write in pending and (first_error is None or next_to_write < first_error):
+                emit(pending.pop(next_to_write))
+                submitted.pop(next_to_write)
+                next_to_write += 1
+
+    if first_error is not None and on_error is not None and next_to_write == first_error:
+        on_error(submitted[first_error])
+
+
 if __name__ == "__main__":
     input_file = ""
     output_file = ""
@@ -0,0 +1,223 @@
+# metrics.py
+# Per-stage timing and token accounting. Every stage writes its numbers into
+# meta_data["metrics"][stage] and forwards them to the configured sink; a
+# per-run summary is kept in memory for the end of main.main.
+import csv
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+TOKEN_FIELDS = [
+    "prompt_tokens",
+    "completion_tokens",
+    "reasoning_tokens",
+    "cached_prompt_tokens",
+    "uncached_prompt_tokens",
+]
+
+EVENT_FIELDS = ["time", "window_id", "stage", "seconds", "retries", "throttle_seconds", "cache_hit"] + TOKEN_FIELDS
+
+
+def usage_to_dict(usage) -> Dict[str, int]:
+    if usage is None:
+        return {}
+
+    def field(obj, name):
+        if obj is None:
+            return None
+        if isinstance(obj, dict):
+            return obj.get(name)
+        return getattr(obj, name, None)
+
+    prompt_tokens = field(usage, "prompt_tokens") or 0
+    completion_tokens = field(usage, "completion_tokens") or 0
+    reasoning_tokens = field(field(usage, "completion_tokens_details"), "reasoning_tokens") or 0
+
+    # DeepSeek 报告 prompt_cache_hit/miss_tokens，OpenAI 报告 prompt_tokens_details.cached_tokens
+    cached = field(usage, "prompt_cache_hit_tokens")
+    if cached is None:
+        cached = field(field(usage, "prompt_tokens_details"), "cached_tokens")
+    cached = cached or 0
+    uncached = field(usage, "prompt_cache_miss_tokens")
+    if uncached is None:
+        uncached = max(0, prompt_tokens - cached)
+
+    return {
+        "prompt_tokens": int(prompt_tokens),
+        "completion_tokens": int(completion_tokens),
+        "reasoning_tokens": int(reasoning_tokens),
+        "cached_prompt_tokens": int(cached),
+        "uncached_prompt_tokens": int(uncached),
+    }
+
+
+# =============== Sinks ===============
+
+class MetricsSink:
+    def emit(self, event: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class CSVMetricsSink(MetricsSink):
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._f = open(path, "a", encoding="utf-8", newline="")
+        self._writer = csv.DictWriter(self._f, fieldnames=EVENT_FIELDS, extrasaction="ignore")
+        if new_file:
+            self._writer.writeheader()
+
+    def emit(self, event: Dict[str, Any]) -> None:
+        with self._lock:
+            self._writer.writerow(event)
+            self._f.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._f.close()
+
+
+class PrometheusTextSink(MetricsSink):
+    # 以 Prometheus 文本格式累计计数，供 node_exporter textfile collector 读取
+    def __init__(self, path: str, prefix: str = "geodecider", flush_every: int = 50):
+        self.path = path
+        self.prefix = prefix
+        self.flush_every = flush_every
+        self._summary = RunSummary()
+        self._events = 0
+        self._lock = threading.Lock()
+
+    def emit(self, event: Dict[str, Any]) -> None:
+        self._summary.add(event)
+        with self._lock:
+            self._events += 1
+            due = self._events % self.flush_every == 0
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        p = self.prefix
+        lines = [
+            f"# TYPE {p}_stage_calls_total counter",
+            f"# TYPE {p}_stage_seconds_total counter",
+            f"# TYPE {p}_stage_retries_total counter",
+            f"# TYPE {p}_tokens_total counter",
+        ]
+        for stage, agg in sorted(self._summary.snapshot().items()):
+            label = f'stage="{stage}"'
+            lines.append(f"{p}_stage_calls_total{{{label}}} {agg['calls']}")
+            lines.append(f"{p}_stage_seconds_total{{{label}}} {agg['seconds']:.6f}")
+            lines.append(f"{p}_stage_retries_total{{{label}}} {agg['retries']}")
+            for kind in TOKEN_FIELDS:
+                lines.append(f'{p}_tokens_total{{{label},kind="{kind}"}} {agg[kind]}')
+
+        tmp = self.path + ".tmp"
+        with self._lock:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp, self.path)
+
+    def close(self) -> None:
+        self.flush()
+
+
+def make_sink(path: Optional[str], fmt: str = "csv") -> Optional[MetricsSink]:
+    if not path:
+        return None
+    if fmt == "csv":
+        return CSVMetricsSink(path)
+    if fmt == "prometheus":
+        return PrometheusTextSink(path)
+    raise ValueError(f"Unknown metrics format {fmt!r}")
+
+
+# =============== Run summary ===============
+
+class RunSummary:
+    def __init__(self):
+        self._stages: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, event: Dict[str, Any]) -> None:
+        with self._lock:
+            agg = self._stages.setdefault(event["stage"], {
+                "calls": 0, "seconds": 0.0, "max_seconds": 0.0, "retries": 0, "cache_hits": 0,
+                **{k: 0 for k in TOKEN_FIELDS},
+            })
+            agg["calls"] += 1
+            agg["seconds"] += event.get("seconds") or 0.0
+            agg["max_seconds"] = max(agg["max_seconds"], event.get("seconds") or 0.0)
+            agg["retries"] += event.get("retries") or 0
+            agg["cache_hits"] += 1 if event.get("cache_hit") else 0
+            for k in TOKEN_FIELDS:
+                agg[k] += event.get(k) or 0
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {stage: dict(agg) for stage, agg in self._stages.items()}
+
+    def format(self) -> str:
+        stages = self.snapshot()
+        if not stages:
+            return "No metrics recorded."
+        lines = [f"{'stage':<36}{'calls':>7}{'total s':>10}{'mean s':>9}{'max s':>9}"
+                 f"{'prompt tok':>12}{'cached':>10}{'uncached':>10}{'compl tok':>11}{'retries':>9}"]
+        for stage, agg in sorted(stages.items(), key=lambda x: -x[1]["seconds"]):
+            mean = agg["seconds"] / agg["calls"] if agg["calls"] else 0.0
+            lines.append(f"{stage:<36}{agg['calls']:>7}{agg['seconds']:>10.2f}{mean:>9.3f}{agg['max_seconds']:>9.3f}"
+                         f"{agg['prompt_tokens']:>12}{agg['cached_prompt_tokens']:>10}{agg['uncached_prompt_tokens']:>10}"
+                         f"{agg['completion_tokens']:>11}{agg['retries']:>9}")
+        return "\n".join(lines)
+
+
+_sink: Optional[MetricsSink] = None
+_summary = RunSummary()
+
+
+def configure_metrics(sink: Optional[MetricsSink]) -> None:
+    global _sink, _summary
+    if _sink is not None:
+        _sink.close()
+    _sink = sink
+    _summary = RunSummary()
+
+
+def run_summary() -> RunSummary:
+    return _summary
+
+
+def close_metrics() -> None:
+    global _sink
+    if _sink is not None:
+        _sink.close()
+        _sink = None
+
+
+def record(meta_data: Optional[Dict[str, Any]], stage: str, stats: Dict[str, Any]) -> None:
+    if meta_data is not None:
+        meta_data.setdefault("metrics", {})[stage] = stats
+
+    event = {"time": time.time(), "stage": stage, **stats}
+    if meta_data is not None:
+        event["window_id"] = meta_data.get("current_window_id")
+    _summary.add(event)
+    if _sink is not None:
+        _sink.emit(event)
+
+
+@contextmanager
+def stage_timer(meta_data: Optional[Dict[str, Any]], stage: str) -> Iterator[Dict[str, Any]]:
+    stats: Dict[str, Any] = {}
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats["seconds"] = time.perf_counter() - start
+        record(meta_data, stage, stats)
+
@@ -0,0 +1,281 @@
+# neighbors.py
+# k-NN retrieval over labelled historical wells. The index is a directory of
+# .npy arrays (normalised features, squared norms, labels, well codes, depths)
+# plus a small JSON header; arrays are opened memory-mapped on first use, so
+# startup is cheap and worker processes share the same pages through the OS
+# page cache. Queries for all rows of a window are answered in one batched
+# distance computation over index blocks.
+import argparse
+import json
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ingest import WELL_COLUMN, iter_wells
+from prompts import LABEL_DESCRIPTIONS
+from trend_engine import _fill, _rolling
+
+NEIGHBOR_CURVES = ["GR", "ILD_log10", "DeltaPHI", "PHIND", "PE", "NM_M", "RELPOS"]
+LABEL_COLUMN = "Facies"
+INDEX_VERSION = 1
+BLOCK_ROWS = 1 << 18
+
+FACIES_NAMES = list(LABEL_DESCRIPTIONS)
+
+
+def _label_names(values: pd.Series) -> List[str]:
+    # Facies 既可能是 1~9 的编码，也可能直接是相名称
+    out = []
+    for v in values.tolist():
+        try:
+            code = int(v)
+        except (TypeError, ValueError):
+            out.append(str(v))
+            continue
+        out.append(FACIES_NAMES[code - 1] if 1 <= code <= len(FACIES_NAMES) else str(v))
+    return out
+
+
+def well_features(well_df: pd.DataFrame, curves: Sequence[str],
+                  trend_window: int = 0) -> np.ndarray:
+    # 每行的曲线值；可选附加以该行为中心的滑动均值/标准差作为窗口级趋势描述
+    values = _fill(well_df.reindex(columns=list(curves)).to_numpy(dtype=float))
+    if not trend_window:
+        return values
+    mean, std = _rolling(values, trend_window)
+    return np.hstack([values, mean, std])
+
+
+def feature_names(curves: Sequence[str], trend_window: int = 0) -> List[str]:
+    names = list(curves)
+    if trend_window:
+        names += [f"{c}_mean{trend_window}" for c in curves] + [f"{c}_std{trend_window}" for c in curves]
+    return names
+
+
+def build_index(csv_paths: Iterable[str], output_dir: str,
+                curves: Sequence[str] = NEIGHBOR_CURVES,
+                label_column: str = LABEL_COLUMN,
+                well_column: Optional[str] = WELL_COLUMN,
+                trend_window: int = 5,
+                chunksize: int = 50_000) -> Dict[str, Any]:
+    features, labels, wells, depths = [], [], [], []
+    label_names: List[str] = list(FACIES_NAMES)
+    well_names: List[str] = []
+
+    for path in csv_paths:
+        for name, df in iter_wells(path, well_column, chunksize):
+            if label_column not in df.columns:
+                continue
+            # 特征在整口井上计算（与查询时一致），再只保留有标签的行
+            labelled = df[label_column].notna().to_numpy()
+            if not labelled.any():
+                continue
+            well_x = well_features(df, curves, trend_window)[labelled]
+            df = df[labelled]
+            names = _label_names(df[label_column])
+            for label in names:
+                if label not in label_names:
+                    label_names.append(label)
+            code = {label: k for k, label in enumerate(label_names)}
+
+            well_key = f"{os.path.basename(path)}:{name}"
+            well_names.append(well_key)
+            features.append(well_x)
+            labels.append(np.array([code[label] for label in names], dtype=np.int16))
+            wells.append(np.full(len(df), len(well_names) - 1, dtype=np.int32))
+            if "Depth" in df.columns:
+                depths.append(df["Depth"].to_numpy(dtype=np.float32))
+            else:
+                depths.append(np.full(len(df), np.nan, dtype=np.float32))
+
+    if not features:
+        raise ValueError(f"No labelled rows ({label_column!r}) found to index")
+
+    x = np.vstack(features)
+    mean = x.mean(axis=0)
+    std = x.std(axis=0)
+    std = np.where(std > 1e-9, std, 1.0)
+    x = ((x - mean) / std).astype(np.float32)
+
+    os.makedirs(output_dir, exist_ok=True)
+    arrays = {
+        "features": x,
+        "sq_norms": np.einsum("ij,ij->i", x, x).astype(np.float32),
+        "labels": np.concatenate(labels),
+        "wells": np.concatenate(wells),
+        "depths": np.concatenate(depths),
+    }
+    for name, arr in arrays.items():
+        tmp = os.path.join(output_dir, f"{name}.tmp.npy")
+        np.save(tmp, arr)
+        os.replace(tmp, os.path.join(output_dir, f"{name}.npy"))
+
+    header = {
+        "version": INDEX_VERSION,
+        "curves": list(curves),
+        "trend_window": trend_window,
+        "features": feature_names(curves, trend_window),
+        "mean": mean.tolist(),
+        "std": std.tolist(),
+        "labels": label_names,
+        "wells": well_names,
+        "rows": int(x.shape[0]),
+    }
+    with open(os.path.join(output_dir, "index.json"), "w", encoding="utf-8") as f:
+        json.dump(header, f, ensure_ascii=False, indent=2)
+    return header
+
+
+class NeighborIndex:
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "index.json"), "r", encoding="utf-8") as f:
+            self.header = json.load(f)
+        if self.header.get("version") != INDEX_VERSION:
+            raise ValueError(f"Unsupported neighbor index version {self.header.get('version')!r}")
+        self.curves = self.header["curves"]
+        self.trend_window = self.header["trend_window"]
+        self.labels = self.header["labels"]
+        self.well_names = self.header["wells"]
+        self.mean = np.array(self.header["mean"])
+        self.std = np.array(self.header["std"])
+
+        # 只读内存映射：多个进程打开同一索引时共享页缓存
+        def load(name):
+            return np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r")
+        self.features = load("features")
+        self.sq_norms = load("sq_norms")
+        self.row_labels = load("labels")
+        self.row_wells = load("wells")
+        self.row_depths = load("depths")
+
+    def __len__(self) -> int:
+        return int(self.features.shape[0])
+
+    def well_code(self, well_name: Optional[str]) -> Optional[int]:
+        if not well_name:
+            return None
+        for k, key in enumerate(self.well_names):
+            if key.split(":", 1)[-1] == well_name:
+                return k
+        return None
+
+    def transform(self, raw_features: np.ndarray) -> np.ndarray:
+        return ((raw_features - self.mean) / self.std).astype(np.float32)
+
+    def kneighbors(self, queries: np.ndarray, k: int = 5,
+                   exclude_well: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        # 分块计算 |q|^2 - 2 q·x + |x|^2，逐块保留每行前 k 个
+        q = np.asarray(queries, dtype=np.float32)
+        q_norms = np.einsum("ij,ij->i", q, q)[:, None]
+        k = min(k, len(self))
+        best_d = np.full((q.shape[0], 0), np.inf, dtype=np.float32)
+        best_i = np.zeros((q.shape[0], 0), dtype=np.int64)
+
+        for lo in range(0, len(self), BLOCK_ROWS):
+            hi = min(lo + BLOCK_ROWS, len(self))
+            block = np.asarray(self.features[lo:hi])
+            d2 = q_norms - 2.0 * (q @ block.T) + np.asarray(self.sq_norms[lo:hi])[None, :]
+            if exclude_well is not None:
+                d2[:, np.asarray(self.row_wells[lo:hi]) == exclude_well] = np.inf
+            kk = min(k, hi - lo)
+            part = np.argpartition(d2, kk - 1, axis=1)[:, :kk]
+            best_d = np.hstack([best_d, np.take_along_axis(d2, part, axis=1)])
+            best_i = np.hstack([best_i, part + lo])
+            if best_d.shape[1] > k:
+                keep = np.argpartition(best_d, k - 1, axis=1)[:, :k]
+                best_d = np.take_along_axis(best_d, keep, axis=1)
+                best_i = np.take_along_axis(best_i, keep, axis=1)
+
+        order = np.argsort(best_d, axis=1)
+        best_d = np.take_along_axis(best_d, order, axis=1)
+        best_i = np.take_along_axis(best_i, order, axis=1)
+        return np.sqrt(np.maximum(best_d, 0.0)), best_i
+
+    def query_window(self, well_df: pd.DataFrame, target_rows: Sequence[int],
+                     k: int = 5, well_name: Optional[str] = None,
+                     raw: Optional[np.ndarray] = None) -> Dict[str, Any]:
+        # well_df 为整口井（或窗口及其上下文），行标签为全局行号；趋势特征需要上下文。
+        # raw 为预先算好的 well_features(well_df)，同一口井的窗口可复用
+        if raw is None:
+            raw = well_features(well_df, self.curves, self.trend_window)
+        pos = well_df.index.get_indexer(range(target_rows[0], target_rows[1]))
+        dist, idx = self.kneighbors(self.transform(raw[pos]), k, self.well_code(well_name))
+        return {
+            "distances": dist,
+            "labels": np.asarray(self.row_labels)[idx],
+            "wells": np.asarray(self.row_wells)[idx],
+            "depths": np.asarray(self.row_depths)[idx],
+        }
+
+
+def format_evidence(result: Dict[str, Any], depths: Sequence[float], label_names: List[str]) -> str:
+    lines = []
+    window_votes: Dict[str, int] = {}
+    for row, depth in enumerate(depths):
+        counts: Dict[str, int] = {}
+        for code in result["labels"][row]:
+            name = label_names[int(code)]
+            counts[name] = counts.get(name, 0) + 1
+            window_votes[name] = window_votes.get(name, 0) + 1
+        k = len(result["labels"][row])
+        votes = ", ".join(f"{name} {n}/{k}" for name, n in sorted(counts.items(), key=lambda x: -x[1]))
+        lines.append(f"- Depth {depth:.1f}: {votes} (mean distance {result['distances'][row].mean():.2f})")
+
+    total = sum(window_votes.values()) or 1
+    summary = ", ".join(f"{name} {n / total:.0%}"
+                        for name, n in sorted(window_votes.items(), key=lambda x: -x[1]))
+    return (
+        "Facies of the nearest labelled samples from historical wells "
+        "(normalised log features, smaller distance = more similar):\n"
+        + "\n".join(lines)
+        + f"\nWindow-level neighbour facies distribution: {summary}.\n"
+    )
+
+
+_index_dir: Optional[str] = None
+_index: Optional[NeighborIndex] = None
+_k = 5
+_lock = threading.Lock()
+
+
+def configure_neighbors(index_dir: Optional[str], k: int = 5) -> None:
+    global _index_dir, _index, _k
+    with _lock:
+        _index_dir = index_dir
+        _index = None
+        _k = k
+
+
+def get_neighbor_index() -> Optional[NeighborIndex]:
+    # 第一次查询时才打开索引
+    global _index
+    if _index_dir is None:
+        return None
+    with _lock:
+        if _index is None:
+            _index = NeighborIndex(_index_dir)
+        return _index
+
+
+def neighbor_k() -> int:
+    return _k
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a k-NN index over labelled well CSVs.")
+    parser.add_argument("csv", nargs="+")
+    parser.add_argument("--output", required=True, help="index directory")
+    parser.add_argument("--label-column", default=LABEL_COLUMN)
+    parser.add_argument("--well-column", default=WELL_COLUMN)
+    parser.add_argument("--trend-window", type=int, default=5, help="0 disables trend descriptors")
+    args = parser.parse_args()
+
+    header = build_index(args.csv, args.output, label_column=args.label_column,
+                         well_column=args.well_column, trend_window=args.trend_window)
+    print(f"Indexed {header['rows']} rows from {len(header['wells'])} wells "
+          f"({len(header['features'])} features) into {args.output}")
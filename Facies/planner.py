@@ -0,0 +1,136 @@
+# planner.py
+# Cheap tool planning. A window is reduced to a coarse signature (NM_M mix,
+# curve variability, base-classifier disagreement, boundary count); tools are
+# then picked by rules, or an earlier LLM plan for the same signature is reused
+# from the plan cache, so the reasoning planner only runs for novel windows.
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from routing import row_confidence
+from trend_engine import TREND_CURVES, WellTrendEngine
+
+PLANNER_MODES = ("llm", "cached", "rules")
+
+
+def _bucket(value: float, edges: List[float], names: List[str]) -> str:
+    for edge, name in zip(edges, names):
+        if value < edge:
+            return name
+    return names[-1]
+
+
+def window_signature(meta_data: Dict[str, Any]) -> Dict[str, Any]:
+    window_df: pd.DataFrame = meta_data["window_df"]
+    up = meta_data.get("window_up", pd.DataFrame())
+    down = meta_data.get("window_down", pd.DataFrame())
+    well = meta_data.get("well")
+    context = well.df if well is not None else pd.concat([up, window_df, down])
+
+    # NM_M 组成
+    nm = set(window_df["NM_M"].dropna().astype(int)) if "NM_M" in window_df.columns else set()
+    nm_mix = "mixed" if len(nm) > 1 else ("nonmarine" if nm == {1} else "marine" if nm == {2} else "unknown")
+
+    # 曲线波动：窗口内标准差相对整口井（或上下文）标准差的均值
+    curves = [c for c in TREND_CURVES if c in window_df.columns and c not in ("NM_M", "RELPOS")]
+    if curves and len(window_df) > 1:
+        ctx_std = context[curves].std().replace(0, np.nan)
+        variability = float((window_df[curves].std() / ctx_std).mean(skipna=True))
+        variability = 0.0 if np.isnan(variability) else variability
+    else:
+        variability = 0.0
+
+    # 基分类器分歧：有概率列时看低置信度行比例，否则看预测相的切换次数
+    confidence = row_confidence(window_df)
+    if confidence is not None:
+        disagreement = float(np.mean(np.nan_to_num(confidence, nan=0.0) < 0.5))
+    elif "Predicted_Facies" in window_df.columns and len(window_df) > 1:
+        pred = window_df["Predicted_Facies"].astype(str)
+        disagreement = float((pred != pred.shift()).iloc[1:].mean())
+    else:
+        disagreement = 0.0
+
+    # 层界数：复用趋势引擎的变点
+    if well is not None:
+        engine = well.cached("trend_engine", lambda: WellTrendEngine(well.df))
+    else:
+        engine = WellTrendEngine(context)
+    positions = engine.positions(int(window_df.index[0]), int(window_df.index[-1]) + 1)
+    rows = engine.boundary_rows()
+    boundaries = int(((rows > positions.start) & (rows < positions.stop)).sum())
+
+    signature = {
+        "nm_mix": nm_mix,
+        "variability": _bucket(variability, [0.5, 1.0], ["low", "mid", "high"]),
+        "disagreement": _bucket(disagreement, [1e-9, 0.25], ["none", "low", "high"]),
+        "boundaries": _bucket(boundaries, [1, 2], ["0", "1", "2+"]),
+    }
+    signature["key"] = "|".join(f"{k}={signature[k]}" for k in ("nm_mix", "variability", "disagreement", "boundaries"))
+    signature["values"] = {"variability": variability, "disagreement": disagreement, "boundaries": boundaries}
+    return signature
+
+
+def rule_plan(signature: Dict[str, Any], neighbors_available: bool = False) -> Tuple[List[str], List[Dict[str, str]]]:
+    tools = [("expert_feature_description_tool", "curve semantics are needed for every window")]
+
+    if signature["disagreement"] != "none" or signature["nm_mix"] == "mixed":
+        tools.append(("expert_label_description_tool", "ambiguous labels or mixed depositional environment"))
+        tools.append(("classification_suggestions_tool", "heuristic rules help resolve disagreement"))
+
+    if signature["boundaries"] != "0" or signature["variability"] == "high":
+        tools.append(("trend_analysis_tool", "boundaries or strong variability inside the window"))
+
+    if neighbors_available and signature["disagreement"] == "high":
+        tools.append(("neighbor_find_tool", "base classifier is unsure; use labelled reference cases"))
+
+    return [name for name, _ in tools], [{"name": name, "why": why} for name, why in tools]
+
+
+class PlanCache:
+    # 签名 → LLM 计划；可选 JSON Lines 文件持久化，跨运行复用
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._plans: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._plans[item["key"]] = item
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._plans.get(key)
+
+    def put(self, key: str, tool_call_list: List[str], answer: str) -> None:
+        item = {"key": key, "tools": tool_call_list, "answer": answer}
+        with self._lock:
+            if key in self._plans:
+                return
+            self._plans[key] = item
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+    def __len__(self) -> int:
+        return len(self._plans)
+
+
+_plan_cache = PlanCache()
+
+
+def configure_planner(plan_cache_path: Optional[str] = None) -> PlanCache:
+    global _plan_cache
+    _plan_cache = PlanCache(plan_cache_path)
+    return _plan_cache
+
+
+def get_plan_cache() -> PlanCache:
+    return _plan_cache
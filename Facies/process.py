@@ -1,10 +1,19 @@
 import json
-from typing import Any, Dict, List
+import time
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
 
 import pandas as pd
 
-from api import get_result
+from api import get_result, get_batch_result
+from batching import get_batcher
+from structured_output import AnswerStream, answer_options, normalize_label
 from tool_call import get_tool_selection
+from scheduler import run_dag, run_sequential
+from metrics import record, stage_timer
+from table_format import estimate_tokens, format_table, render_window
+from neighbors import get_neighbor_index
+from planner import PLANNER_MODES, get_plan_cache, rule_plan, window_signature
 from tools import (
     ExpertFeatureDescriptionTool,
     ExpertLabelDescriptionTool,
@@ -13,17 +22,6 @@ from tools import (
     NeighborFindTool,
 )
 
-def parse_labels_from_answer(answer_str: str) -> List[str]:
-    try:
-        obj = json.loads(answer_str)
-        labels = obj.get("answer", [])
-        if isinstance(labels, list):
-            return [str(x) for x in labels]
-    except Exception:
-        pass
-    return []
-
-
 STRICT_NONMARINE_LABELS = {
     "Nonmarine sandstone",
     "Nonmarine coarse siltstone",
@@ -105,7 +103,8 @@ def enforce_nm_m_consistency(meta_data: Dict[str, Any],
     return fixed, info
 
 
-def aggregate_panel(label_lists: Dict[str, List[str]]):
+def aggregate_panel(label_lists: Dict[str, List[str]], weights: Optional[Dict[str, float]] = None):
+    # weights 为各 persona 的票权，缺省每票 1；平票时取 persona 顺序中先出现的标签
     if not label_lists:
         return [], [], 0.0
 
@@ -114,23 +113,24 @@ def aggregate_panel(label_lists: Dict[str, List[str]]):
     agreement_per_depth: List[float] = []
 
     for i in range(max_len):
-        votes: List[str] = []
-        for _, seq in label_lists.items():
-            if i < len(seq):
-                votes.append(seq[i])
+        votes: List[Tuple[str, float]] = []
+        for style, seq in label_lists.items():
+            if i < len(seq) and seq[i] is not None:
+                votes.append((seq[i], 1.0 if weights is None else float(weights.get(style, 1.0))))
 
-        if not votes:
+        total = sum(w for _, w in votes)
+        if not votes or total <= 0:
             final_labels.append("UNKNOWN")
             agreement_per_depth.append(0.0)
             continue
 
-        counts: Dict[str, int] = {}
-        for v in votes:
-            counts[v] = counts.get(v, 0) + 1
+        counts: Dict[str, float] = {}
+        for v, w in votes:
+            counts[v] = counts.get(v, 0) + w
 
         best_label, best_count = max(counts.items(), key=lambda x: x[1])
         final_labels.append(best_label)
-        agreement_per_depth.append(best_count / len(votes))
+        agreement_per_depth.append(best_count / total)
 
     if agreement_per_depth:
         global_agreement = sum(agreement_per_depth) / len(agreement_per_depth)
@@ -140,35 +140,90 @@ def aggregate_panel(label_lists: Dict[str, List[str]]):
     return final_labels, agreement_per_depth, global_agreement
 
 
+PANEL_STYLES = ["expert", "model_aware", "trend_focus"]
+PANEL_MODES = ("full", "early_exit")
+
+
+def majority_decided(label_lists: Dict[str, List[str]], remaining: float,
+                     weights: Optional[Dict[str, float]] = None) -> bool:
+    # 每一行领先票数都超过第二名 + 剩余 persona 的票权时，后续投票无法改变多数结果
+    if not label_lists:
+        return False
+    max_len = max(len(v) for v in label_lists.values())
+    for i in range(max_len):
+        counts: Dict[str, float] = {}
+        for style, seq in label_lists.items():
+            if i < len(seq) and seq[i] is not None:
+                w = 1.0 if weights is None else float(weights.get(style, 1.0))
+                counts[seq[i]] = counts.get(seq[i], 0) + w
+        top = sorted(counts.values(), reverse=True) + [0, 0]
+        if top[0] - top[1] <= remaining:
+            return False
+    return True
+
+
 # =============== 1. Planner 阶段（工具选择） ===============
 
 from typing import Any, Dict, List
 import pandas as pd
 
-def process_logic_part1(meta_data: Dict[str, Any]) -> Dict[str, Any]:
+def process_logic_part1(meta_data: Dict[str, Any], planner_mode: str = "llm") -> Dict[str, Any]:
+    if planner_mode not in PLANNER_MODES:
+        raise ValueError(f"Unknown planner mode {planner_mode!r}, expected one of {PLANNER_MODES}")
+
     window_df: pd.DataFrame = meta_data["window_df"]
     target_columns: List[str] = meta_data["target_columns"].copy()
 
     if "Predicted_Facies" in target_columns:
         target_columns.remove("Predicted_Facies")
 
-    table_df = window_df[target_columns]
-    table_str = table_df.to_string(index=False)
-
-    planner_prompt, think, answer, tool_call_list = get_tool_selection(table_str)
+    with stage_timer(meta_data, "planner") as stats:
+        signature = None
+        cached = None
+        if planner_mode != "llm":
+            # 相同签名的窗口复用已有计划；rules 模式下未命中时按规则选工具，不调用模型
+            signature = window_signature(meta_data)
+            cached = get_plan_cache().get(signature["key"])
+
+        if cached is not None:
+            source = "cache"
+            planner_prompt, think, answer, tool_call_list = "", "", cached["answer"], list(cached["tools"])
+            stats["cache_hit"] = True
+        elif planner_mode == "rules":
+            source = "rules"
+            tool_call_list, tools = rule_plan(signature, get_neighbor_index() is not None)
+            planner_prompt, think, answer = "", "", json.dumps({"tools": tools}, ensure_ascii=False)
+        else:
+            source = "llm"
+            table_str = format_table(window_df, target_columns, index=False)
+            planner_prompt, think, answer, tool_call_list = get_tool_selection(table_str, stats)
+            if signature is not None:
+                get_plan_cache().put(signature["key"], tool_call_list, answer)
 
     meta_data["tool_call_prompt"] = planner_prompt
     meta_data["tool_call_think"] = think
     meta_data["tool_call_answer"] = answer
     meta_data["tool_call_list"] = tool_call_list
+    meta_data["planner"] = {"mode": planner_mode, "source": source}
+    if signature is not None:
+        meta_data["planner"]["signature"] = signature["key"]
     return meta_data
 
 
 
-def build_base_decision_prompt(meta_data: Dict[str, Any]) -> str:
-    window_df: pd.DataFrame = meta_data["window_df"]
-    target_columns: List[str] = meta_data["target_columns"]
+# 提示布局：静态知识 → 与 persona 无关的上下文 → 数据 → persona 尾部。
+# 同一窗口的三个 persona 以及选了相同工具的不同窗口共享最长的逐字节前缀，
+# 便于服务端的上下文缓存命中。
+
+STATIC_KNOWLEDGE_KEYS = [
+    "expert_feature_description",
+    "expert_label_description",
+    "expert_classification_suggestions",
+]
+
 
+@lru_cache(maxsize=64)
+def build_static_prefix(sections: Tuple[str, ...]) -> str:
     parts: List[str] = []
 
     parts.append(
@@ -177,23 +232,37 @@ def build_base_decision_prompt(meta_data: Dict[str, Any]) -> str:
         "into one of 9 lithofacies categories using the provided well log features.\n"
     )
 
-    if meta_data.get("expert_feature_description"):
-        parts.append(meta_data["expert_feature_description"] + "\n")
+    parts.append(
+        "In the features, NM_M means non-marine or marine.\n"
+        "1 means non-marine. The label can only be one of: "
+        "Nonmarine sandstone, Nonmarine coarse siltstone, Nonmarine fine siltstone, "
+        "Marine siltstone and shale, Mudstone.\n"
+        "2 means marine. The label can only be one of: "
+        "Wackestone, Dolomite, Packstone-grainstone, Phylloid-algal bafflestone.\n"
+    )
 
-    if meta_data.get("expert_label_description"):
-        parts.append(meta_data["expert_label_description"] + "\n")
+    parts.append(
+        "You must output a JSON object in the following format:\n"
+        "{ \"answer\": [\"X1\", \"X2\", ...] }\n"
+        "Each Xi is the facies label for the corresponding depth point "
+        "of the data table given below, strictly chosen from the 9 categories above.\n"
+    )
 
-    if meta_data.get("classification_suggestions"):
-        parts.append(meta_data["classification_suggestions"] + "\n")
+    for text in sections:
+        parts.append(text + "\n")
 
-    parts.append("## Data to be Classified:\n")
-    parts.append("### Well Log Data to Classify:\n")
-    parts.append(str(window_df[target_columns]) + "\n")
+    return "\n".join(parts)
 
-    parts.append(
-        "The Predicted_Facies column is provided by XGBoost for reference. "
-        "You may refine or override it based on your expert analysis of the well log features.\n"
-    )
+
+def static_sections(meta_data: Dict[str, Any]) -> Tuple[str, ...]:
+    return tuple(meta_data[key] for key in STATIC_KNOWLEDGE_KEYS if meta_data.get(key))
+
+
+def build_window_section(meta_data: Dict[str, Any], prefix: str = "", suffix: str = "") -> str:
+    window_df: pd.DataFrame = meta_data["window_df"]
+    target_columns: List[str] = meta_data["target_columns"]
+
+    parts: List[str] = []
 
     if "trend_analysis_answer" in meta_data:
         parts.append(
@@ -202,28 +271,34 @@ def build_base_decision_prompt(meta_data: Dict[str, Any]) -> str:
             f"{meta_data['trend_analysis_answer']}\n"
         )
 
-    parts.append(
-        "In the features, NM_M means non-marine or marine.\n"
-        "1 means non-marine. The label can only be one of: "
-        "Nonmarine sandstone, Nonmarine coarse siltstone, Nonmarine fine siltstone, "
-        "Marine siltstone and shale, Mudstone.\n"
-        "2 means marine. The label can only be one of: "
-        "Wackestone, Dolomite, Packstone-grainstone, Phylloid-algal bafflestone.\n"
-    )
+    if meta_data.get("neighbor_evidence"):
+        parts.append(
+            "\nHere are reference cases retrieved from labelled historical wells:\n"
+            "### Nearest Neighbor Evidence:\n"
+            f"{meta_data['neighbor_evidence']}\n"
+        )
 
+    parts.append("## Data to be Classified:\n")
     parts.append(
-        "You must output a JSON object in the following format:\n"
-        "{ \"answer\": [\"X1\", \"X2\", ...] }\n"
-        "Each Xi is the facies label for the corresponding depth point, "
-        "strictly chosen from the 9 categories above.\n"
+        "The Predicted_Facies column is provided by XGBoost for reference. "
+        "You may refine or override it based on your expert analysis of the well log features.\n"
     )
+    parts.append("### Well Log Data to Classify:\n")
+    # 上下文行一并交给 render_window，超出预算时先裁上下文；persona 尾部与修复说明计入开销
+    table, _ = render_window(window_df, meta_data.get("window_up"), meta_data.get("window_down"),
+                             columns=target_columns, mark_context=True,
+                             overhead_tokens=estimate_tokens(prefix + "\n".join(parts) + suffix))
+    parts.append(table)
 
     return "\n".join(parts)
 
 
-def build_decision_prompt(style: str, meta_data: Dict[str, Any]) -> str:
-    base = build_base_decision_prompt(meta_data)
+def build_base_decision_prompt(meta_data: Dict[str, Any], suffix: str = "") -> str:
+    prefix = build_static_prefix(static_sections(meta_data))
+    return "\n".join([prefix, build_window_section(meta_data, prefix, suffix)])
+
 
+def persona_tail(style: str) -> str:
     if style == "expert":
         tail = (
             "\n## Decision Preference (EXPERT MODE)\n"
@@ -245,23 +320,87 @@ def build_decision_prompt(style: str, meta_data: Dict[str, Any]) -> str:
     else:
         tail = "\n## Decision Preference\n- Use a balanced combination of all information sources.\n"
 
-    return base + tail
+    return tail
+
+
+def build_decision_prompt(style: str, meta_data: Dict[str, Any], extra: str = "") -> str:
+    tail = persona_tail(style) + extra
+    return build_base_decision_prompt(meta_data, tail) + tail
+
+
+def build_repair_prompt(style: str, meta_data: Dict[str, Any], labels: List[Optional[str]],
+                        rows: List[int]) -> str:
+    # 沿用完整提示作为前缀（命中服务端缓存），只要求补出缺失/非法的行
+    known = ", ".join(f"{k}: {label}" for k, label in enumerate(labels) if label is not None)
+    return build_decision_prompt(style, meta_data, (
+        "\n## Repair Request\n"
+        "An earlier answer for this window was incomplete or contained labels outside the 9 categories.\n"
+        f"Rows already labelled (# column): {known or 'none'}\n"
+        f"Rows to label: {', '.join(str(k) for k in rows)}\n"
+        "Output { \"answer\": [...] } with exactly one label per listed row, in the listed order.\n"
+    ))
+
+
+def build_batch_decision_prompt(style: str, sections: Tuple[str, ...],
+                                metas: List[Dict[str, Any]]) -> str:
+    # 多个窗口共用静态前缀与 persona 尾部，各窗口的上下文与数据依次排列
+    prefix = build_static_prefix(sections)
+    parts: List[str] = [
+        prefix,
+        "## Batched Request\n"
+        "This request contains several independent windows labelled W1, W2, ... "
+        "Classify every depth point of every window. Instead of a single answer list, output:\n"
+        "{ \"answers\": { \"W1\": [\"X1\", \"X2\", ...], \"W2\": [...], ... } }\n"
+        "Each list must have exactly as many labels as its window has rows.\n",
+    ]
+    for k, md in enumerate(metas, 1):
+        parts.append(f"# Window W{k} ({len(md['window_df'])} rows)\n")
+        parts.append(build_window_section(md, prefix, persona_tail(style)))
+    return "\n".join(parts) + persona_tail(style)
+
+
+def parse_batch_answers(answer_str: str) -> Dict[str, List[str]]:
+    try:
+        obj = json.loads(answer_str)
+        answers = obj.get("answers", {})
+        if isinstance(answers, dict):
+            return {str(k): [str(x) for x in v] for k, v in answers.items() if isinstance(v, list)}
+    except Exception:
+        pass
+    return {}
 
 
 # =============== 3. 主流程：工具执行 + Panel 决策 + 环境纠偏 ===============
 
-def process_logic(meta_data: Dict[str, Any]):
-    meta_data = process_logic_part1(meta_data)
-    tool_call_list: List[str] = meta_data["tool_call_list"]
-    print("Selected Tools:", tool_call_list)
+def _tool_updates(run, meta_data: Dict[str, Any]) -> Dict[str, Any]:
+    # 工具在副本上运行，只返回新增/修改的字段，便于并发执行后再合并
+    local = dict(meta_data)
+    out = run(local)
+    return {k: v for k, v in out.items() if k not in meta_data or meta_data[k] is not v}
+
+
+def _timed_text_tool(name: str, key: str, tool, meta_data: Dict[str, Any]):
+    def run(_):
+        with stage_timer(meta_data, f"tool:{name}"):
+            return {key: tool.run()}
+    return run
+
+
+def build_tool_tasks(tool_call_list: List[str], meta_data: Dict[str, Any],
+                     trend_mode: str = "llm") -> Dict[str, Any]:
+    tasks: Dict[str, Any] = {}
 
     if "expert_feature_description_tool" in tool_call_list:
         tool_expert_feature_description = ExpertFeatureDescriptionTool()
-        meta_data["expert_feature_description"] = tool_expert_feature_description.run()
+        tasks["expert_feature_description_tool"] = (
+            _timed_text_tool("expert_feature_description", "expert_feature_description",
+                             tool_expert_feature_description, meta_data), [])
 
     if "expert_label_description_tool" in tool_call_list:
         tool_expert_label_description = ExpertLabelDescriptionTool()
-        meta_data["expert_label_description"] = tool_expert_label_description.run()
+        tasks["expert_label_description_tool"] = (
+            _timed_text_tool("expert_label_description", "expert_label_description",
+                             tool_expert_label_description, meta_data), [])
 
     classification_tool_names = {
         "classification_suggestions_tool",
@@ -269,48 +408,202 @@ def process_logic(meta_data: Dict[str, Any]):
     }
     if any(name in tool_call_list for name in classification_tool_names):
         tool_classification_suggestions = ClassificationSuggestionsTool()
-        meta_data["expert_classification_suggestions"] = tool_classification_suggestions.run()
+        tasks["classification_suggestions_tool"] = (
+            _timed_text_tool("classification_suggestions", "expert_classification_suggestions",
+                             tool_classification_suggestions, meta_data), [])
 
     if "trend_analysis_tool" in tool_call_list:
-        tool_trend_analysis = TrendAnalysisTool()
-        meta_data = tool_trend_analysis.run(meta_data)
+        tool_trend_analysis = TrendAnalysisTool(mode=trend_mode)
+        tasks["trend_analysis_tool"] = (
+            lambda _: _tool_updates(tool_trend_analysis.run, meta_data), [])
 
-    if "neighbor_finding_tool" in tool_call_list or "neighbor_finding_tool" in tool_call_list:
+    if "neighbor_find_tool" in tool_call_list or "neighbor_finding_tool" in tool_call_list:
         tool_neighbor_find = NeighborFindTool()
-        meta_data = tool_neighbor_find.run(meta_data)
+        tasks["neighbor_find_tool"] = (
+            lambda _: _tool_updates(tool_neighbor_find.run, meta_data), [])
+
+    return tasks
+
+
+def query_labels(prompt: str, rows: int, stats: Dict[str, Any]):
+    # 流式模式下边生成边校验，跑题即中断；否则完整回答先按普通 JSON 解析
+    parser = AnswerStream(rows)
+    stream = answer_options()["stream"]
+    think, answer = get_result(prompt, stats, parser if stream else None)
+    if not stream:
+        parser.parse(answer)
+    labels, missing = parser.finish()
+    if missing:
+        stats["invalid_rows"] = len(missing)
+    if parser.off_schema:
+        stats["off_schema"] = True
+    return think, answer, labels, missing, parser
+
+
+def repair_labels(style: str, meta_data: Dict[str, Any], labels: List[Optional[str]],
+                  missing: List[int]) -> Tuple[List[Optional[str]], Dict[str, Any]]:
+    info: Dict[str, Any] = {"rows": list(missing), "rounds": 0}
+    for _ in range(answer_options()["repair_rounds"]):
+        if not missing:
+            break
+        prompt = build_repair_prompt(style, meta_data, labels, missing)
+        with stage_timer(meta_data, f"panel:{style}:repair") as stats:
+            stats["rows"] = len(missing)
+            _, _, fixed, _, _ = query_labels(prompt, len(missing), stats)
+        info["rounds"] += 1
+        for k, label in zip(missing, fixed):
+            if label is not None:
+                labels[k] = label
+        missing = [k for k, label in enumerate(labels) if label is None]
+    info["unresolved"] = missing
+    return labels, info
+
+
+def finish_persona(style: str, meta_data: Dict[str, Any], output: Dict[str, Any],
+                   labels: List[Optional[str]], missing: List[int], problems: List[str]) -> Dict[str, Any]:
+    if missing:
+        labels, info = repair_labels(style, meta_data, list(labels), missing)
+        info["problems"] = problems
+        output["repair"] = info
+        output["answer"] = json.dumps({"answer": labels}, ensure_ascii=False)
+    # 仍未修好的行为 None，聚合时不计票
+    output["labels"] = labels
+    return output
+
+
+def run_persona_single(style: str, meta_data: Dict[str, Any], stage: Optional[str] = None) -> Dict[str, Any]:
+    prompt_i = build_decision_prompt(style, meta_data)
+    with stage_timer(meta_data, stage or f"panel:{style}") as stats:
+        think_i, answer_i, labels_i, missing, parser = query_labels(prompt_i, len(meta_data["window_df"]), stats)
+
+    output = {
+        "prompt": prompt_i,
+        "think": think_i,
+        "answer": answer_i,
+    }
+    return finish_persona(style, meta_data, output, labels_i, missing, parser.problems)
 
-    styles = ["expert", "model_aware", "trend_focus"]
-    panel_outputs: Dict[str, Dict[str, Any]] = {}
-    label_lists: Dict[str, List[str]] = {}
 
-    for style in styles:
-        prompt_i = build_decision_prompt(style, meta_data)
-        think_i, answer_i = get_result(prompt_i)
-        labels_i = parse_labels_from_answer(answer_i)
+def run_persona_batch(style: str, sections: Tuple[str, ...],
+                      metas: List[Dict[str, Any]]) -> List[Optional[Dict[str, Any]]]:
+    if len(metas) == 1:
+        return [None]
+
+    prompt = build_batch_decision_prompt(style, sections, metas)
+    with stage_timer(None, f"panel_batch:{style}") as stats:
+        stats["batch_size"] = len(metas)
+        think, answer = get_batch_result(prompt, stats)
+    answers = parse_batch_answers(answer)
 
-        panel_outputs[style] = {
-            "prompt": prompt_i,
-            "think": think_i,
-            "answer": answer_i,
-            "labels": labels_i,
-        }
-        label_lists[style] = labels_i
+    outputs: List[Optional[Dict[str, Any]]] = []
+    for k, md in enumerate(metas, 1):
+        labels = answers.get(f"W{k}")
+        if labels is None or len(labels) != len(md["window_df"]):
+            outputs.append(None)
+            continue
+        outputs.append({
+            "prompt": prompt,
+            "think": think,
+            "answer": json.dumps({"answer": labels}, ensure_ascii=False),
+            "labels": [normalize_label(label) for label in labels],
+            "batch": {"size": len(metas), "position": k},
+        })
+    return outputs
+
+
+def run_persona(style: str, meta_data: Dict[str, Any]) -> Dict[str, Any]:
+    batcher = get_batcher()
+    if batcher is None:
+        return run_persona_single(style, meta_data)
+
+    sections = static_sections(meta_data)
+    start = time.perf_counter()
+    result, size = batcher.submit((style, sections), meta_data,
+                                  lambda metas: run_persona_batch(style, sections, metas))
+    if result is not None:
+        record(meta_data, f"panel:{style}", {"seconds": time.perf_counter() - start, "batch_size": size})
+        labels = result["labels"]
+        missing = [k for k, label in enumerate(labels) if label is None]
+        problems = [f"row {k}: invalid label" for k in missing]
+        return finish_persona(style, meta_data, result, labels, missing, problems)
+
+    # 未凑成批，或批量回答中该窗口缺失/长度不符：单独查询
+    return run_persona_single(style, meta_data, f"panel:{style}" if size == 1 else f"panel:{style}:requery")
+
+
+def process_logic(meta_data: Dict[str, Any], parallel: bool = True, trend_mode: str = "llm",
+                  planner_mode: str = "llm", panel_mode: str = "full",
+                  panel_order: Optional[List[str]] = None,
+                  early_exit_agreement: Optional[float] = None,
+                  panel_weights: Optional[Dict[str, float]] = None):
+    if panel_mode not in PANEL_MODES:
+        raise ValueError(f"Unknown panel mode {panel_mode!r}, expected one of {PANEL_MODES}")
+    styles = list(panel_order or PANEL_STYLES)
+    meta_data.setdefault("metrics", {})
+    meta_data = process_logic_part1(meta_data, planner_mode)
+    tool_call_list: List[str] = meta_data["tool_call_list"]
+    print("Selected Tools:", tool_call_list)
+
+    # 依赖图：各工具互相独立 → 合并上下文 → persona 互相独立。
+    # early_exit 模式下图中只放前两个 persona，其余按顺序逐个补跑，结果已定即停止
+    tasks = build_tool_tasks(tool_call_list, meta_data, trend_mode)
+    tool_names = list(tasks)
+
+    def merge_tool_outputs(tool_outputs: Dict[str, Any]):
+        for name in tool_names:
+            meta_data.update(tool_outputs[name])
+        return tool_names
+
+    tasks["context"] = (merge_tool_outputs, tool_names)
+
+    first = styles if panel_mode == "full" else styles[:2]
+    for style in first:
+        tasks[f"panel:{style}"] = ((lambda _, s=style: run_persona(s, meta_data)), ["context"])
+
+    results = run_dag(tasks) if parallel else run_sequential(tasks)
+
+    panel_outputs: Dict[str, Dict[str, Any]] = {}
+    label_lists: Dict[str, List[str]] = {}
+    for style in first:
+        panel_outputs[style] = results[f"panel:{style}"]
+        label_lists[style] = panel_outputs[style]["labels"]
+
+    early_exit = None
+    for style in styles[len(first):]:
+        remaining = sum(1.0 if panel_weights is None else float(panel_weights.get(s, 1.0))
+                        for s in styles if s not in panel_outputs)
+        if majority_decided(label_lists, remaining, panel_weights):
+            early_exit = {"after": list(panel_outputs), "reason": "majority_fixed"}
+        elif early_exit_agreement is not None and aggregate_panel(label_lists, panel_weights)[2] >= early_exit_agreement:
+            early_exit = {"after": list(panel_outputs), "reason": "agreement_threshold",
+                          "threshold": early_exit_agreement}
+        if early_exit is not None:
+            break
+        panel_outputs[style] = run_persona(style, meta_data)
+        label_lists[style] = panel_outputs[style]["labels"]
 
     meta_data["panel"] = panel_outputs
 
-    final_labels, agreement_per_depth, global_agreement = aggregate_panel(label_lists)
+    with stage_timer(meta_data, "aggregate_panel"):
+        final_labels, agreement_per_depth, global_agreement = aggregate_panel(label_lists, panel_weights)
     meta_data["panel_aggregation"] = {
         "final_labels_before_env_fix": final_labels,
         "agreement_per_depth": agreement_per_depth,
         "global_agreement": global_agreement,
+        "persona_order": styles,
+        "skipped_personas": [s for s in styles if s not in panel_outputs],
     }
+    if early_exit is not None:
+        meta_data["panel_aggregation"]["early_exit"] = early_exit
 
-    fixed_labels, nm_info = enforce_nm_m_consistency(meta_data, final_labels)
+    with stage_timer(meta_data, "env_consistency"):
+        fixed_labels, nm_info = enforce_nm_m_consistency(meta_data, final_labels)
     meta_data["env_consistency"] = nm_info
     meta_data["panel_aggregation"]["final_labels"] = fixed_labels
 
-    expert_prompt = panel_outputs["expert"]["prompt"]
-    expert_think = panel_outputs["expert"]["think"]
+    lead = "expert" if "expert" in panel_outputs else styles[0]
+    expert_prompt = panel_outputs[lead]["prompt"]
+    expert_think = panel_outputs[lead]["think"]
     final_answer_obj = {"answer": fixed_labels}
     final_answer_str = json.dumps(final_answer_obj, ensure_ascii=False)
 
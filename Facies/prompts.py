@@ -1,3 +1,5 @@
+from table_format import estimate_tokens, render_window
+
 FEATURE_DESCRIPTIONS = {
     'GR': 'Gamma Ray log. Grain size & shale indicator (higher → finer sediment, shale, mudstone; lower → clean sandstones or carbonates).',
     'ILD_log10': 'Resistivity log (log10 scale). Indicates fluid type & lithology. High values often reflect hydrocarbons or tight carbonates; low values indicate water-bearing formations or shales.',
@@ -50,7 +52,7 @@ CLASSIFICATION_SUGGESTIONS={
 }
 
 
-def build_trend_prompt(window):
+def build_trend_prompt(window, window_up=None, window_down=None):
     prompt = """# Well Log Data Trend Analysis Task
     ## Task Description
     You are a petroleum well log data analysis expert. Please conduct detailed trend analysis on the given well log data window, focusing on the trend variations of each feature in the target sample segment."""
@@ -81,8 +83,6 @@ def build_trend_prompt(window):
     - Focus on feature combinations related to reservoir quality
     - Identify possible hydrocarbon indication features"""
 
-    prompt+=f"Here is the well log data window for analysis:{window}\n"
-
     prompt+="""
         ## Output Format Requirements
         Please organize your analysis results according to the following structure:
@@ -101,4 +101,7 @@ def build_trend_prompt(window):
 
         Please ensure the analysis is detailed and specific, using professional geological terminology to provide valuable trend information for subsequent reservoir classification.
         """
+    # 数据放在最后，使固定的任务说明成为可缓存的前缀；上下文行在超出 token 预算时先被裁掉
+    table, _ = render_window(window, window_up, window_down, overhead_tokens=estimate_tokens(prompt))
+    prompt+=f"Here is the well log data window for analysis:\n{table}"
     return prompt
\ No newline at end of file
@@ -0,0 +1,279 @@
+# refinement.py
+# Whole-well geological refinement. Panel votes, base-classifier
+# probabilities and NM_M constraints become a (depth x 9) emission matrix in
+# log space; a facies transition matrix ties neighbouring samples together
+# across window boundaries, and a blocked Viterbi decode (vectorised over
+# blocks, sequential only over block boundaries) returns the most plausible
+# label sequence for the well. Runs online on a finished well or offline from
+# a stored result JSONL.
+import argparse
+import json
+import os
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ingest import WELL_COLUMN, iter_wells
+from result_index import iter_lines
+from neighbors import FACIES_NAMES
+from process import PANEL_STYLES, STRICT_MARINE_LABELS, STRICT_NONMARINE_LABELS
+from routing import PROB_PREFIX, find_prob_columns, routed_rows
+
+N_CLASSES = len(FACIES_NAMES)
+CLASS_INDEX = {name: k for k, name in enumerate(FACIES_NAMES)}
+NEG_INF = np.float32(-1e30)
+
+
+def _class_of(name: Any) -> Optional[int]:
+    if name in CLASS_INDEX:
+        return CLASS_INDEX[name]
+    try:
+        code = int(name)
+    except (TypeError, ValueError):
+        return None
+    return code - 1 if 1 <= code <= N_CLASSES else None
+
+
+def env_mask(nm_m: np.ndarray) -> np.ndarray:
+    # 与 enforce_nm_m_consistency 相同的约束：NM_M=1 排除严格海相，NM_M=2 排除严格陆相
+    allowed = np.ones((len(nm_m), N_CLASSES), dtype=bool)
+    marine = np.array([name in STRICT_MARINE_LABELS for name in FACIES_NAMES])
+    nonmarine = np.array([name in STRICT_NONMARINE_LABELS for name in FACIES_NAMES])
+    allowed[nm_m == 1] &= ~marine
+    allowed[nm_m == 2] &= ~nonmarine
+    return allowed
+
+
+def transition_matrix(p_stay: float = 0.9, labels: Optional[Sequence[str]] = None,
+                      smoothing: float = 1.0) -> np.ndarray:
+    # 无标注序列时用“保持/均匀切换”先验；有标注序列时按相邻转移计数估计
+    if labels is None:
+        trans = np.full((N_CLASSES, N_CLASSES), (1.0 - p_stay) / (N_CLASSES - 1))
+        np.fill_diagonal(trans, p_stay)
+        return np.log(trans).astype(np.float32)
+
+    codes = np.array([_class_of(x) if _class_of(x) is not None else -1 for x in labels])
+    prev, nxt = codes[:-1], codes[1:]
+    ok = (prev >= 0) & (nxt >= 0)
+    counts = np.full((N_CLASSES, N_CLASSES), smoothing)
+    np.add.at(counts, (prev[ok], nxt[ok]), 1.0)
+    return np.log(counts / counts.sum(axis=1, keepdims=True)).astype(np.float32)
+
+
+def emissions(votes: Optional[np.ndarray] = None,
+              probs: Optional[np.ndarray] = None,
+              nm_m: Optional[np.ndarray] = None,
+              vote_weight: float = 1.0,
+              prob_weight: float = 1.0,
+              alpha: float = 0.5) -> np.ndarray:
+    n = len(votes) if votes is not None else len(probs) if probs is not None else len(nm_m)
+    score = np.zeros((n, N_CLASSES), dtype=np.float32)
+    if votes is not None:
+        total = votes.sum(axis=1, keepdims=True)
+        score += vote_weight * np.log((votes + alpha) / (total + alpha * N_CLASSES))
+    if probs is not None:
+        p = np.nan_to_num(probs, nan=1.0 / N_CLASSES)
+        p = p / np.maximum(p.sum(axis=1, keepdims=True), 1e-12)
+        score += prob_weight * np.log(np.maximum(p, 1e-6))
+    if nm_m is not None:
+        score[~env_mask(np.asarray(nm_m))] = NEG_INF
+    return score
+
+
+def _maxplus_step(scores: np.ndarray, trans: np.ndarray, with_arg: bool = True):
+    # out[..., j] = max_k scores[..., k] + trans[k, j]；按 k 循环原地取最大，避免 (..., 9, 9) 临时数组
+    out = scores[..., 0, None] + trans[0]
+    tmp = np.empty_like(out)
+    arg = np.zeros(out.shape, dtype=np.int8) if with_arg else None
+    for k in range(1, trans.shape[0]):
+        np.add(scores[..., k, None], trans[k], out=tmp)
+        if with_arg:
+            np.copyto(arg, k, where=tmp > out)
+        np.maximum(out, tmp, out=out)
+    return out, arg
+
+
+def _forward(e: np.ndarray, trans: np.ndarray, start: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # 逐步前向：start 为第一个样本之前的得分（None 表示自由起点），返回末得分与回溯指针
+    back = np.zeros((len(e), e.shape[1]), dtype=np.int8)
+    if start is None:
+        delta = e[0].copy()
+    else:
+        delta, back[0] = _maxplus_step(start, trans)
+        delta += e[0]
+    for t in range(1, len(e)):
+        delta, back[t] = _maxplus_step(delta, trans)
+        delta += e[t]
+    return delta, back
+
+
+def viterbi(emit: np.ndarray, trans: np.ndarray, block: int = 256) -> np.ndarray:
+    n, c = emit.shape
+    emit = emit.astype(np.float32)
+    trans = trans.astype(np.float32)
+    n_blocks = n // block
+    if n_blocks < 2:
+        delta, back = _forward(emit, trans, None) if n else (None, None)
+        path = np.zeros(n, dtype=np.int64)
+        if n:
+            path[-1] = int(delta.argmax())
+            for t in range(n - 1, 0, -1):
+                path[t - 1] = back[t][path[t]]
+        return path
+
+    e = emit[: n_blocks * block].reshape(n_blocks, block, c)
+    tail = emit[n_blocks * block:]
+
+    # 1) 各块的转移矩阵：A[b, i, j] = 由上一块末状态 i 到本块末状态 j 的最优得分（对所有块并行）
+    a = trans[None, :, :] + e[:, 0, None, :]
+    for t in range(1, block):
+        a, _ = _maxplus_step(a, trans, with_arg=False)
+        a += e[:, t, None, :]
+
+    # 2) 只在块边界上顺序推进，并回溯得到每块末尾的状态；不足一块的尾部逐步处理
+    v = np.empty((n_blocks, c), dtype=np.float32)
+    v[0], _ = _forward(e[0], trans, None)
+    for b in range(1, n_blocks):
+        v[b] = (v[b - 1][:, None] + a[b]).max(axis=0)
+
+    tail_path = np.zeros(len(tail), dtype=np.int64)
+    ends = np.empty(n_blocks, dtype=np.int64)
+    if len(tail):
+        delta, back = _forward(tail, trans, v[-1])
+        tail_path[-1] = int(delta.argmax())
+        for t in range(len(tail) - 1, 0, -1):
+            tail_path[t - 1] = back[t][tail_path[t]]
+        ends[-1] = back[0][tail_path[0]]
+    else:
+        ends[-1] = int(v[-1].argmax())
+    for b in range(n_blocks - 1, 0, -1):
+        ends[b - 1] = int((v[b - 1] + a[b][:, ends[b]]).argmax())
+
+    # 3) 已知每块的入口与出口状态，块内 Viterbi 再次对所有块并行
+    delta = np.empty((n_blocks, c), dtype=np.float32)
+    delta[0] = e[0, 0]
+    delta[1:] = trans[ends[:-1]] + e[1:, 0]
+    back = np.empty((block, n_blocks, c), dtype=np.int8)
+    for t in range(1, block):
+        delta, back[t] = _maxplus_step(delta, trans)
+        delta += e[:, t]
+
+    path = np.empty((n_blocks, block), dtype=np.int64)
+    state = ends.copy()
+    rows = np.arange(n_blocks)
+    for t in range(block - 1, -1, -1):
+        path[:, t] = state
+        if t:
+            state = back[t][rows, state]
+    return np.concatenate([path.reshape(-1), tail_path])
+
+
+def vote_matrix(label_rows: Iterable[Tuple[int, str]], row_index: Dict[int, int], n: int) -> np.ndarray:
+    votes = np.zeros((n, N_CLASSES), dtype=np.float32)
+    for row, label in label_rows:
+        k = _class_of(label)
+        pos = row_index.get(row)
+        if k is not None and pos is not None:
+            votes[pos, k] += 1.0
+    return votes
+
+
+def prob_matrix(well_df: pd.DataFrame) -> Optional[np.ndarray]:
+    columns = find_prob_columns(well_df)
+    if not columns:
+        return None
+    probs = np.zeros((len(well_df), N_CLASSES), dtype=np.float32)
+    found = False
+    for column in columns:
+        k = _class_of(str(column)[len(PROB_PREFIX):])
+        if k is not None:
+            probs[:, k] = well_df[column].to_numpy(dtype=np.float32)
+            found = True
+    return probs if found else None
+
+
+def refine_well(well_df: pd.DataFrame, label_rows: Iterable[Tuple[int, str]],
+                trans: Optional[np.ndarray] = None, **weights) -> np.ndarray:
+    # well_df 的行标签为全局行号；label_rows 为 (行号, 标签) 的投票
+    row_index = {int(r): k for k, r in enumerate(well_df.index)}
+    votes = vote_matrix(label_rows, row_index, len(well_df))
+    nm_m = well_df["NM_M"].to_numpy() if "NM_M" in well_df.columns else None
+    emit = emissions(votes, prob_matrix(well_df), nm_m, **weights)
+    path = viterbi(emit, trans if trans is not None else transition_matrix())
+    return np.array(FACIES_NAMES, dtype=object)[path]
+
+
+def llm_span(meta_data: Dict[str, Any]) -> Tuple[int, int]:
+    # 窗口内交给 panel 的行：(相对窗口起点的偏移, 行数)
+    start, end = meta_data["rows"]["window"]
+    routing = meta_data.get("routing")
+    if routing is None:
+        return 0, end - start
+    if routing.get("llm_span") is None:
+        return 0, 0
+    return routing["llm_span"][0], routing["llm_span"][1] - routing["llm_span"][0]
+
+
+def record_votes(record: Dict[str, Any]) -> List[Tuple[int, str]]:
+    # 从一条结果记录取出逐行投票：参与的各 persona 标签；未交给 agent 的行用最终标签
+    meta_data = record["meta_data"]
+    start, end = meta_data["rows"]["window"]
+    offset, span = llm_span(meta_data)
+    routed = routed_rows(meta_data.get("routing"), end - start)
+
+    out: List[Tuple[int, str]] = []
+    panel = meta_data.get("panel", {})
+    for style in PANEL_STYLES:
+        for k, label in enumerate(panel.get(style, {}).get("labels", [])[:span]):
+            if routed[offset + k]:
+                out.append((start + offset + k, label))
+    try:
+        answer = json.loads(record["content"]["answer"]).get("answer", [])
+    except (ValueError, AttributeError):
+        answer = []
+    for k, label in enumerate(answer[: end - start]):
+        if not panel or not routed[k]:
+            out.append((start + k, label))
+    return out
+
+
+def refined_path(output_jsonl: str) -> str:
+    root, _ = os.path.splitext(output_jsonl)
+    return f"{root}.refined.csv"
+
+
+def refine_outputs(output_jsonl: str, source_csv: str,
+                   well_column: Optional[str] = WELL_COLUMN,
+                   trans: Optional[np.ndarray] = None, **weights) -> pd.DataFrame:
+    # 离线重跑：只需结果 JSONL（含行号区间）与源 CSV
+    votes: List[Tuple[int, str]] = []
+    for line in iter_lines(output_jsonl):
+        votes.extend(record_votes(json.loads(line)))
+    votes_by_row = pd.DataFrame(votes, columns=["row", "label"])
+
+    frames = []
+    for name, well_df in iter_wells(source_csv, well_column):
+        lo, hi = int(well_df.index[0]), int(well_df.index[-1])
+        mine = votes_by_row[(votes_by_row["row"] >= lo) & (votes_by_row["row"] <= hi)]
+        refined = refine_well(well_df, mine.itertuples(index=False, name=None), trans, **weights)
+        frames.append(pd.DataFrame({"row": well_df.index, "well": name, "refined_label": refined}))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=["row", "well", "refined_label"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Whole-well Viterbi refinement of stored GeoDecider results.")
+    parser.add_argument("output_jsonl")
+    parser.add_argument("--source", required=True, help="source CSV the results were produced from")
+    parser.add_argument("--output", required=True, help="CSV with row, well and refined_label")
+    parser.add_argument("--well-column", default=WELL_COLUMN)
+    parser.add_argument("--p-stay", type=float, default=0.9)
+    parser.add_argument("--vote-weight", type=float, default=1.0)
+    parser.add_argument("--prob-weight", type=float, default=1.0)
+    args = parser.parse_args()
+
+    table = refine_outputs(args.output_jsonl, args.source, args.well_column,
+                           transition_matrix(args.p_stay),
+                           vote_weight=args.vote_weight, prob_weight=args.prob_weight)
+    table.to_csv(args.output, index=False)
+    print(f"Refined {len(table)} rows from {table['well'].nunique()} wells into {args.output}")
@@ -0,0 +1,329 @@
+# replay.py
+# Offline replay and evaluation. The stored panel answers of a finished run
+# are loaded once into a (rows x personas) class matrix; the local stages
+# (weighted panel aggregation, NM_M environment fixing, whole-well
+# refinement) are then re-run vectorised over all rows, and each stage is
+# scored against the ground-truth facies column, so aggregation weights and
+# environment rules can be tuned without a single LLM call.
+import argparse
+import json
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ingest import WELL_COLUMN
+from neighbors import FACIES_NAMES, LABEL_COLUMN
+from process import PANEL_STYLES, STRICT_MARINE_LABELS, STRICT_NONMARINE_LABELS
+from refinement import (
+    N_CLASSES, _class_of, emissions, llm_span, prob_matrix, transition_matrix, viterbi,
+)
+from result_index import iter_lines
+from routing import routed_rows
+
+NONMARINE_DEFAULT = "Nonmarine sandstone"
+MARINE_DEFAULT = "Wackestone"
+
+_NAMES = np.array(FACIES_NAMES + ["UNKNOWN"], dtype=object)
+_MARINE = np.array([_class_of(x) for x in STRICT_MARINE_LABELS])
+_NONMARINE = np.array([_class_of(x) for x in STRICT_NONMARINE_LABELS])
+
+
+def to_classes(values: Sequence[Any]) -> np.ndarray:
+    # 类别名或 1-9 编码 → 0-8；无法识别的记为 -1
+    out = np.full(len(values), -1, dtype=np.int16)
+    for k, v in enumerate(values):
+        c = _class_of(v)
+        if c is not None:
+            out[k] = c
+    return out
+
+
+def to_names(classes: np.ndarray) -> np.ndarray:
+    return _NAMES[np.where(classes >= 0, classes, N_CLASSES)]
+
+
+def load_panel(output_jsonl: str, styles: Sequence[str] = PANEL_STYLES) -> pd.DataFrame:
+    # 每个样本行一行：存储的最终标签、是否经过 panel、线上的 persona 顺序、各 persona 的类别；
+    # 同一行出现多次时取最后一次
+    rows: List[int] = []
+    stored: List[Any] = []
+    in_panel: List[bool] = []
+    orders: List[str] = []
+    votes: List[List[Any]] = [[] for _ in styles]
+
+    for line in iter_lines(output_jsonl):
+        record = json.loads(line)
+        meta_data = record["meta_data"]
+        start, end = meta_data["rows"]["window"]
+        offset, span = llm_span(meta_data)
+        routed = routed_rows(meta_data.get("routing"), end - start)
+        panel = meta_data.get("panel", {})
+        try:
+            answer = json.loads(record["content"]["answer"]).get("answer", [])
+        except (ValueError, AttributeError):
+            answer = []
+        persona_labels = [panel.get(style, {}).get("labels") or [] for style in styles]
+        # 线上平票按本次运行的 persona 顺序取舍；不在该顺序里的 persona 没有票，排在最后
+        order = meta_data.get("panel_aggregation", {}).get("persona_order") or []
+        order = [s for s in order if s in styles]
+        order_key = ",".join(order + [s for s in styles if s not in order])
+
+        for k in range(end - start):
+            rows.append(start + k)
+            stored.append(answer[k] if k < len(answer) else None)
+            inside = bool(panel) and routed[k]
+            in_panel.append(inside)
+            orders.append(order_key)
+            for p, labels in enumerate(persona_labels):
+                j = k - offset
+                votes[p].append(labels[j] if inside and j < len(labels) else None)
+
+    table = pd.DataFrame({"row": np.asarray(rows, dtype=np.int64),
+                          "stored": to_classes(stored),
+                          "in_panel": np.asarray(in_panel, dtype=bool),
+                          "persona_order": orders})
+    for style, labels in zip(styles, votes):
+        table[style] = to_classes(labels)
+    return table.drop_duplicates("row", keep="last").sort_values("row").reset_index(drop=True)
+
+
+def order_columns(keys: Sequence[str], styles: Sequence[str]) -> np.ndarray:
+    # load_panel 的 persona_order 列 → 每行按优先级排列的列下标
+    pos = {style: j for j, style in enumerate(styles)}
+    lookup = {key: [pos[s] for s in key.split(",")] for key in pd.unique(np.asarray(keys, dtype=object))}
+    return np.array([lookup[key] for key in keys], dtype=np.int64).reshape(len(keys), len(styles))
+
+
+def aggregate_votes(votes: np.ndarray, weights: Optional[np.ndarray] = None,
+                    order: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    # 与 aggregate_panel 相同的加权多数：平票时取 persona 顺序中先出现且得分最高的标签；
+    # order 为每行的列优先级（缺省为列顺序）
+    n, p = votes.shape
+    weights = np.ones(p, dtype=np.float64) if weights is None else np.asarray(weights, dtype=np.float64)
+    order = np.broadcast_to(np.arange(p), (n, p)) if order is None else order
+    idx = np.arange(n)
+    valid = votes >= 0
+    scores = np.zeros((n, N_CLASSES), dtype=np.float64)
+    for j in range(p):
+        m = valid[:, j]
+        scores[idx[m], votes[m, j]] += weights[j]
+
+    best = scores.max(axis=1)
+    choice = np.full(n, -1, dtype=np.int16)
+    for r in range(p):
+        v = votes[idx, order[:, r]]
+        cand = np.where(v >= 0, v, 0)
+        hit = (choice < 0) & (v >= 0) & (scores[idx, cand] == best) & (best > 0)
+        choice[hit] = cand[hit]
+
+    total = (valid * weights).sum(axis=1)
+    agreement = np.divide(best, total, out=np.zeros(n), where=total > 0)
+    return choice, agreement
+
+
+def env_fix(labels: np.ndarray, nm_m: np.ndarray, base: np.ndarray,
+            nonmarine_default: str = NONMARINE_DEFAULT,
+            marine_default: str = MARINE_DEFAULT) -> Tuple[np.ndarray, np.ndarray]:
+    # enforce_nm_m_consistency 的向量版：环境与标签矛盾时优先改用基分类器的预测，否则用默认类别
+    fixed = labels.copy()
+    bad_nm = (nm_m == 1) & np.isin(labels, _MARINE)
+    repl_nm = np.where((base >= 0) & ~np.isin(base, _MARINE), base, _class_of(nonmarine_default))
+    bad_m = (nm_m == 2) & np.isin(labels, _NONMARINE)
+    repl_m = np.where((base >= 0) & ~np.isin(base, _NONMARINE), base, _class_of(marine_default))
+    fixed[bad_nm] = repl_nm[bad_nm]
+    fixed[bad_m] = repl_m[bad_m]
+    return fixed, bad_nm | bad_m
+
+
+def refine_rows(source: pd.DataFrame, votes: np.ndarray, weights: np.ndarray,
+                fallback: np.ndarray, well_ids: np.ndarray,
+                trans: Optional[np.ndarray] = None, **refine_weights) -> np.ndarray:
+    # 加权 persona 票 + 非 panel 行的最终标签构成投票矩阵，逐井 Viterbi
+    n = len(source)
+    vote_counts = np.zeros((n, N_CLASSES), dtype=np.float32)
+    idx = np.arange(n)
+    for j in range(votes.shape[1]):
+        m = votes[:, j] >= 0
+        vote_counts[idx[m], votes[m, j]] += weights[j]
+    m = (fallback >= 0) & ((votes >= 0).sum(axis=1) == 0)
+    vote_counts[idx[m], fallback[m]] += 1.0
+
+    probs = prob_matrix(source)
+    nm_m = source["NM_M"].to_numpy() if "NM_M" in source.columns else None
+    emit = emissions(vote_counts, probs, nm_m, **refine_weights)
+    trans = trans if trans is not None else transition_matrix()
+
+    out = np.full(n, -1, dtype=np.int16)
+    edges = np.flatnonzero(np.r_[True, well_ids[1:] != well_ids[:-1], True])
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        out[lo:hi] = viterbi(emit[lo:hi], trans)
+    return out
+
+
+def boundary_mask(truth: np.ndarray, well_ids: np.ndarray, tolerance: int = 1) -> np.ndarray:
+    # 真实相变化处两侧各 tolerance 行；不跨井
+    n = len(truth)
+    change = np.flatnonzero((truth[1:] != truth[:-1]) & (well_ids[1:] == well_ids[:-1])) + 1
+    near = np.zeros(n, dtype=bool)
+    for d in range(-tolerance, tolerance):
+        j = change + d
+        ok = (j >= 0) & (j < n)
+        ok[ok] &= well_ids[j[ok]] == well_ids[change[ok]]
+        near[j[ok]] = True
+    return near
+
+
+def evaluate(pred: np.ndarray, truth: np.ndarray, well_ids: Optional[np.ndarray] = None,
+             boundary_tolerance: int = 1) -> Dict[str, Any]:
+    valid = truth >= 0
+    p, t = pred[valid], truth[valid]
+    correct = p == t
+    labelled = p >= 0
+
+    confusion = np.bincount(t[labelled].astype(np.int64) * N_CLASSES + p[labelled],
+                            minlength=N_CLASSES * N_CLASSES).reshape(N_CLASSES, N_CLASSES)
+    support = np.bincount(t.astype(np.int64), minlength=N_CLASSES)
+    tp = np.diag(confusion).astype(np.float64)
+    predicted = confusion.sum(axis=0)
+    precision = np.divide(tp, predicted, out=np.zeros(N_CLASSES), where=predicted > 0)
+    recall = np.divide(tp, support, out=np.zeros(N_CLASSES), where=support > 0)
+    f1 = np.divide(2 * precision * recall, precision + recall,
+                   out=np.zeros(N_CLASSES), where=(precision + recall) > 0)
+    present = support > 0
+
+    result: Dict[str, Any] = {
+        "rows": int(valid.sum()),
+        "unlabelled": int((~labelled).sum()),
+        "accuracy": float(correct.mean()) if len(t) else 0.0,
+        "macro_f1": float(f1[present].mean()) if present.any() else 0.0,
+        "weighted_f1": float((f1 * support).sum() / support.sum()) if support.sum() else 0.0,
+        "per_class": {name: {"precision": float(precision[k]), "recall": float(recall[k]),
+                             "f1": float(f1[k]), "support": int(support[k])}
+                      for k, name in enumerate(FACIES_NAMES)},
+        "confusion": confusion.tolist(),
+    }
+    if well_ids is not None:
+        near = boundary_mask(truth, well_ids, boundary_tolerance)[valid]
+        result["boundary_rows"] = int(near.sum())
+        result["boundary_accuracy"] = float(correct[near].mean()) if near.any() else 0.0
+        result["interior_accuracy"] = float(correct[~near].mean()) if (~near).any() else 0.0
+    return result
+
+
+def replay(output_jsonl: str, source_csv: str,
+           weights: Optional[Dict[str, float]] = None,
+           fix_env: bool = True,
+           refine: bool = False,
+           well_column: Optional[str] = WELL_COLUMN,
+           truth_column: str = LABEL_COLUMN,
+           boundary_tolerance: int = 1,
+           nonmarine_default: str = NONMARINE_DEFAULT,
+           marine_default: str = MARINE_DEFAULT,
+           trans: Optional[np.ndarray] = None,
+           **refine_weights) -> Tuple[pd.DataFrame, Dict[str, Dict[str, Any]]]:
+    styles = list(PANEL_STYLES)
+    w = np.array([1.0 if weights is None else float(weights.get(s, 1.0)) for s in styles])
+
+    panel = load_panel(output_jsonl, styles)
+    source = pd.read_csv(source_csv)
+    covered = panel["row"].to_numpy()
+    source = source.iloc[covered]
+
+    votes = panel[styles].to_numpy()
+    stored = panel["stored"].to_numpy()
+    in_panel = panel["in_panel"].to_numpy()
+    base = to_classes(source["Predicted_Facies"].tolist()) if "Predicted_Facies" in source.columns \
+        else np.full(len(source), -1, dtype=np.int16)
+    nm_m = source["NM_M"].to_numpy() if "NM_M" in source.columns else np.zeros(len(source))
+    well_ids = (pd.factorize(source[well_column])[0] if well_column and well_column in source.columns
+                else np.zeros(len(source), dtype=np.int64))
+
+    # 只有经过 panel 的行会被重新聚合；路由给基分类器的行保持存储结果
+    aggregated, agreement = aggregate_votes(votes, w, order_columns(panel["persona_order"].tolist(), styles))
+    aggregated = np.where(in_panel, aggregated, stored)
+    final = aggregated
+    corrected = np.zeros(len(final), dtype=bool)
+    if fix_env:
+        fixed, corrected = env_fix(aggregated, nm_m, base, nonmarine_default, marine_default)
+        corrected &= in_panel
+        final = np.where(in_panel, fixed, stored)
+
+    table = pd.DataFrame({
+        "row": covered,
+        "well": source[well_column].to_numpy() if well_column and well_column in source.columns else "",
+        "base": to_names(base),
+        "stored": to_names(stored),
+        "aggregated": to_names(aggregated),
+        "final": to_names(final),
+        "agreement": np.where(in_panel, agreement, np.nan),
+        "env_corrected": corrected,
+    })
+    stages = {"base": base, "stored": stored, "aggregated": aggregated, "final": final}
+    if refine:
+        refined = refine_rows(source, votes, w, stored, well_ids, trans, **refine_weights)
+        table["refined"] = to_names(refined)
+        stages["refined"] = refined
+
+    metrics: Dict[str, Dict[str, Any]] = {}
+    if truth_column in source.columns:
+        truth = to_classes(source[truth_column].tolist())
+        table["truth"] = to_names(truth)
+        for name, pred in stages.items():
+            metrics[name] = evaluate(pred, truth, well_ids, boundary_tolerance)
+    return table, metrics
+
+
+def format_metrics(metrics: Dict[str, Dict[str, Any]]) -> str:
+    lines = [f"{'stage':<12}{'accuracy':>10}{'macro_f1':>10}{'boundary':>10}{'interior':>10}{'rows':>8}"]
+    for name, m in metrics.items():
+        lines.append(f"{name:<12}{m['accuracy']:>10.4f}{m['macro_f1']:>10.4f}"
+                     f"{m.get('boundary_accuracy', float('nan')):>10.4f}"
+                     f"{m.get('interior_accuracy', float('nan')):>10.4f}{m['rows']:>8}")
+    return "\n".join(lines)
+
+
+def _parse_weights(text: Optional[str]) -> Optional[Dict[str, float]]:
+    # "expert=1.5,model_aware=1,trend_focus=0.5"
+    if not text:
+        return None
+    out = {}
+    for item in text.split(","):
+        name, value = item.split("=")
+        out[name.strip()] = float(value)
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay local stages over stored GeoDecider results and score them.")
+    parser.add_argument("output_jsonl")
+    parser.add_argument("--source", required=True, help="source CSV the results were produced from")
+    parser.add_argument("--weights", default=None, help="persona weights, e.g. expert=1.5,trend_focus=0.5")
+    parser.add_argument("--no-env-fix", action="store_true")
+    parser.add_argument("--refine", action="store_true")
+    parser.add_argument("--p-stay", type=float, default=0.9)
+    parser.add_argument("--well-column", default=WELL_COLUMN)
+    parser.add_argument("--truth-column", default=LABEL_COLUMN)
+    parser.add_argument("--boundary-tolerance", type=int, default=1)
+    parser.add_argument("--nonmarine-default", default=NONMARINE_DEFAULT)
+    parser.add_argument("--marine-default", default=MARINE_DEFAULT)
+    parser.add_argument("--labels", default=None, help="optional CSV for the replayed labels")
+    parser.add_argument("--metrics", default=None, help="optional JSON for the full metrics")
+    args = parser.parse_args()
+
+    table, metrics = replay(args.output_jsonl, args.source,
+                            weights=_parse_weights(args.weights),
+                            fix_env=not args.no_env_fix,
+                            refine=args.refine,
+                            well_column=args.well_column,
+                            truth_column=args.truth_column,
+                            boundary_tolerance=args.boundary_tolerance,
+                            nonmarine_default=args.nonmarine_default,
+                            marine_default=args.marine_default,
+                            trans=transition_matrix(args.p_stay))
+    if args.labels:
+        table.to_csv(args.labels, index=False)
+    if args.metrics:
+        with open(args.metrics, "w", encoding="utf-8") as f:
+            json.dump(metrics, f, indent=2)
+    print(format_metrics(metrics) if metrics else f"Replayed {len(table)} rows (no {args.truth_column!r} column to score against).")
@@ -0,0 +1,287 @@
+# result_index.py
+# Fixed-width binary offset index next to a result JSONL. Each entry maps a
+# window id to the byte range of its record, the source rows it covers and its
+# depth range, so resume only reads the tail of the index and any window can
+# be fetched without scanning the result file. Results may be split into
+# rotated segments and stored as one gzip/zstd member per record; the entry
+# then also names the segment and the offset points at the compressed member.
+import gzip
+import io
+import json
+import os
+import re
+import struct
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+COMPRESSIONS = (None, "gzip", "zstd")
+_SUFFIX = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+# 旧索引的填充字节为 0，即全部位于第 0 段
+ENTRY = struct.Struct("<qqqqqddB3xI")
+ENTRY_DTYPE = np.dtype([
+    ("window_id", "<i8"),
+    ("offset", "<i8"),
+    ("length", "<i8"),
+    ("row_start", "<i8"),
+    ("row_end", "<i8"),
+    ("depth_min", "<f8"),
+    ("depth_max", "<f8"),
+    ("status", "u1"),
+    ("_pad", "V3"),
+    ("segment", "<u4"),
+])
+assert ENTRY_DTYPE.itemsize == ENTRY.size
+
+
+def index_path(output_jsonl: str) -> str:
+    return output_jsonl + ".idx"
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("zstd compression needs the 'zstandard' package (pip install zstandard)") from e
+    return zstandard
+
+
+def compress(data: bytes, compression: Optional[str], level: Optional[int] = None) -> bytes:
+    if compression is None:
+        return data
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=6 if level is None else level, mtime=0)
+    if compression == "zstd":
+        return _zstd().ZstdCompressor(level=3 if level is None else level).compress(data)
+    raise ValueError(f"Unknown compression {compression!r}, expected one of {COMPRESSIONS}")
+
+
+def decompress(data: bytes, compression: Optional[str]) -> bytes:
+    if compression is None:
+        return data
+    if compression == "gzip":
+        return gzip.decompress(data)
+    return _zstd().ZstdDecompressor().decompress(data)
+
+
+def segment_path(output_jsonl: str, segment: int = 0, compression: Optional[str] = None) -> str:
+    # 第 0 段沿用原文件名，之后为 out.0001.jsonl、out.0002.jsonl ...（压缩时再加 .gz/.zst）
+    if segment == 0:
+        return output_jsonl + _SUFFIX[compression]
+    root, ext = os.path.splitext(output_jsonl)
+    return f"{root}.{segment:04d}{ext}{_SUFFIX[compression]}"
+
+
+def detect_compression(output_jsonl: str) -> Optional[str]:
+    for compression in ("gzip", "zstd"):
+        if os.path.exists(segment_path(output_jsonl, 0, compression)):
+            return compression
+    return None
+
+
+def list_segments(output_jsonl: str, compression: Optional[str] = None) -> List[int]:
+    root, ext = os.path.splitext(output_jsonl)
+    pattern = re.compile(re.escape(os.path.basename(root)) + r"\.(\d{4,})" + re.escape(ext + _SUFFIX[compression]) + "$")
+    segments = [0] if os.path.exists(segment_path(output_jsonl, 0, compression)) else []
+    for name in os.listdir(os.path.dirname(output_jsonl) or "."):
+        m = pattern.match(name)
+        if m:
+            segments.append(int(m.group(1)))
+    return sorted(segments)
+
+
+def results_exist(output_jsonl: str) -> bool:
+    return any(os.path.exists(segment_path(output_jsonl, 0, c)) for c in COMPRESSIONS)
+
+
+def _unpack(raw: bytes) -> Dict[str, Any]:
+    window_id, offset, length, row_start, row_end, depth_min, depth_max, status, segment = ENTRY.unpack(raw)
+    return {
+        "window_id": window_id, "offset": offset, "length": length,
+        "row_start": row_start, "row_end": row_end,
+        "depth_min": depth_min, "depth_max": depth_max, "status": status,
+        "segment": segment,
+    }
+
+
+def _record_ok(path: str, offset: int, length: int, compression: Optional[str]) -> bool:
+    if length <= 0 or not os.path.exists(path) or offset + length > os.path.getsize(path):
+        return False
+    with open(path, "rb") as data_f:
+        if compression is None:
+            data_f.seek(offset + length - 1)
+            return data_f.read(1) == b"\n"
+        data_f.seek(offset)
+        try:
+            return decompress(data_f.read(length), compression).endswith(b"\n")
+        except Exception:
+            return False
+
+
+def recover(output_jsonl: str) -> Optional[Dict[str, Any]]:
+    # 截掉索引尾部的残缺条目与结果文件尾部未被索引的半行，返回最后一个完好条目
+    # 分段时只保留最后完好记录所在段及之前的段，其后的段整体删除
+    idx = index_path(output_jsonl)
+    if not os.path.exists(idx):
+        return None
+
+    compression = detect_compression(output_jsonl)
+    n = os.path.getsize(idx) // ENTRY.size
+    last_ok = None
+    keep = n
+
+    with open(idx, "rb") as idx_f:
+        while keep > 0:
+            idx_f.seek((keep - 1) * ENTRY.size)
+            entry = _unpack(idx_f.read(ENTRY.size))
+            if entry["status"] == STATUS_OK:
+                path = segment_path(output_jsonl, entry["segment"], compression)
+                if _record_ok(path, entry["offset"], entry["length"], compression):
+                    last_ok = entry
+                    break
+            elif entry["status"] == STATUS_ERROR:
+                # 出错窗口不算完成，续跑时重做
+                pass
+            keep -= 1
+
+    with open(idx, "r+b") as idx_f:
+        idx_f.truncate(keep * ENTRY.size)
+    last_segment = last_ok["segment"] if last_ok else 0
+    data_end = last_ok["offset"] + last_ok["length"] if last_ok else 0
+    path = segment_path(output_jsonl, last_segment, compression)
+    if os.path.exists(path) and os.path.getsize(path) > data_end:
+        with open(path, "r+b") as data_f:
+            data_f.truncate(data_end)
+    for segment in [s for s in list_segments(output_jsonl, compression) if s > last_segment]:
+        os.remove(segment_path(output_jsonl, segment, compression))
+    return last_ok
+
+
+def rebuild(output_jsonl: str, step_size: int = 16) -> Optional[Dict[str, Any]]:
+    # 为旧格式的结果文件补建索引（只需扫描一次）
+    entries = []
+    offset = 0
+    with open(output_jsonl, "rb") as f:
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break
+            try:
+                meta_data = json.loads(raw)["meta_data"]
+            except ValueError:
+                break
+            window_id = int(meta_data.get("current_window_id", len(entries) + 1))
+            rows = meta_data.get("rows", {}).get("window")
+            if rows is None:
+                start = (window_id - 1) * step_size
+                rows = [start, start + (len(meta_data.get("window_df", [])) or step_size)]
+            depths = [r.get("Depth") for r in meta_data.get("window_df", []) if isinstance(r, dict)]
+            depths = [d for d in depths if d is not None]
+            entries.append(ENTRY.pack(window_id, offset, len(raw), rows[0], rows[1],
+                                      min(depths) if depths else float("nan"),
+                                      max(depths) if depths else float("nan"), STATUS_OK, 0))
+            offset += len(raw)
+
+    with open(index_path(output_jsonl), "wb") as idx_f:
+        idx_f.write(b"".join(entries))
+    return recover(output_jsonl)
+
+
+def pack_entry(window_id: int, offset: int, length: int, rows: List[int],
+               depth_range=(float("nan"), float("nan")), status: int = STATUS_OK, segment: int = 0) -> bytes:
+    return ENTRY.pack(window_id, offset, length, rows[0], rows[1],
+                      depth_range[0], depth_range[1], status, segment)
+
+
+class IndexWriter:
+    def __init__(self, output_jsonl: str):
+        self._f = open(index_path(output_jsonl), "ab")
+
+    def append(self, window_id: int, offset: int, length: int, rows: List[int],
+               depth_range=(float("nan"), float("nan")), status: int = STATUS_OK, segment: int = 0) -> None:
+        self._f.write(pack_entry(window_id, offset, length, rows, depth_range, status, segment))
+        self._f.flush()
+
+    def append_many(self, entries: List[bytes]) -> None:
+        self._f.write(b"".join(entries))
+        self._f.flush()
+
+    def fileno(self) -> int:
+        return self._f.fileno()
+
+    def close(self) -> None:
+        self._f.close()
+
+
+def iter_lines(output_jsonl: str) -> Iterator[bytes]:
+    # 按段顺序逐行读取全部结果，压缩段按多成员流解压
+    compression = detect_compression(output_jsonl)
+    for segment in list_segments(output_jsonl, compression):
+        path = segment_path(output_jsonl, segment, compression)
+        if compression is None:
+            f = open(path, "rb")
+        elif compression == "gzip":
+            f = gzip.open(path, "rb")
+        else:
+            raw = open(path, "rb")
+            f = io.BufferedReader(_zstd().ZstdDecompressor().stream_reader(raw, read_across_frames=True,
+                                                                           closefd=True))
+        with f:
+            for line in f:
+                if line.strip():
+                    yield line
+
+
+class ResultReader:
+    def __init__(self, output_jsonl: str):
+        self.output_jsonl = output_jsonl
+        self.compression = detect_compression(output_jsonl)
+        idx = index_path(output_jsonl)
+        if os.path.exists(idx) and os.path.getsize(idx) >= ENTRY.size:
+            self.index = np.memmap(idx, dtype=ENTRY_DTYPE, mode="r",
+                                   shape=(os.path.getsize(idx) // ENTRY.size,))
+        else:
+            self.index = np.zeros(0, dtype=ENTRY_DTYPE)
+        self._files: Dict[int, Any] = {}
+
+    def __len__(self) -> int:
+        return int((self.index["status"] == STATUS_OK).sum())
+
+    def _read(self, k: int) -> Dict[str, Any]:
+        entry = self.index[k]
+        segment = int(entry["segment"])
+        if segment not in self._files:
+            self._files[segment] = open(segment_path(self.output_jsonl, segment, self.compression), "rb")
+        f = self._files[segment]
+        f.seek(int(entry["offset"]))
+        return json.loads(decompress(f.read(int(entry["length"])), self.compression))
+
+    def _ok(self) -> np.ndarray:
+        return self.index["status"] == STATUS_OK
+
+    def get(self, window_id: int) -> Optional[Dict[str, Any]]:
+        hits = np.flatnonzero((self.index["window_id"] == window_id) & self._ok())
+        return self._read(int(hits[-1])) if len(hits) else None
+
+    def by_row(self, row: int) -> Optional[Dict[str, Any]]:
+        hits = np.flatnonzero((self.index["row_start"] <= row) & (row < self.index["row_end"]) & self._ok())
+        return self._read(int(hits[-1])) if len(hits) else None
+
+    def by_depth(self, depth: float) -> List[Dict[str, Any]]:
+        # 多井文件中不同井的深度区间会重叠，因此返回全部命中的窗口
+        hits = np.flatnonzero((self.index["depth_min"] <= depth) & (depth <= self.index["depth_max"]) & self._ok())
+        return [self._read(int(k)) for k in hits]
+
+    def close(self) -> None:
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
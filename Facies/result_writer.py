@@ -0,0 +1,182 @@
+# result_writer.py
+# Background group-commit writer for window records. Workers hand finished
+# records to a bounded queue; one thread serialises them, optionally
+# compresses each record as its own gzip/zstd member, appends a group of them
+# to the current segment, then appends their index entries. Segments rotate by
+# size and fsync follows the configured policy, so neither JSON encoding nor
+# disk latency sits on the path of the next window's API calls. Sidecar rows
+# are journaled in the same group commit.
+import json
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from metrics import stage_timer
+from result_index import (
+    COMPRESSIONS, STATUS_ERROR, STATUS_OK, IndexWriter, compress, detect_compression,
+    list_segments, pack_entry, results_exist, segment_path,
+)
+
+FSYNC_POLICIES = ("none", "group", "close")
+
+_STOP = object()
+
+
+class ResultWriter:
+    def __init__(self, output_jsonl: str,
+                 compression: Optional[str] = None,
+                 compression_level: Optional[int] = None,
+                 rotate_bytes: Optional[int] = None,
+                 fsync: str = "none",
+                 queue_size: int = 64,
+                 group_size: int = 32,
+                 group_wait: float = 0.0,
+                 background: bool = True,
+                 sidecar=None):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression!r}, expected one of {COMPRESSIONS}")
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync!r}, expected one of {FSYNC_POLICIES}")
+        if results_exist(output_jsonl) and detect_compression(output_jsonl) != compression:
+            raise ValueError(f"{output_jsonl} was written with compression={detect_compression(output_jsonl)!r}; "
+                             f"resume with the same setting")
+
+        self.output_jsonl = output_jsonl
+        self.compression = compression
+        self.compression_level = compression_level
+        self.rotate_bytes = rotate_bytes
+        self.fsync = fsync
+        self.group_size = max(1, group_size)
+        self.group_wait = group_wait
+        self.sidecar = sidecar
+
+        # 续跑时接着写最后一段
+        segments = list_segments(output_jsonl, compression)
+        self.segment = segments[-1] if segments else 0
+        self._f = open(segment_path(output_jsonl, self.segment, compression), "ab")
+        self._index = IndexWriter(output_jsonl)
+        self._error: Optional[BaseException] = None
+
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        if background:
+            self._queue = queue.Queue(maxsize=max(1, queue_size))
+            self._thread = threading.Thread(target=self._loop, name="result-writer", daemon=True)
+            self._thread.start()
+
+    # ---------- 生产端 ----------
+
+    def write(self, record, info: Dict[str, Any], columns=None) -> None:
+        self._put(("ok", record, info, columns))
+
+    def mark_error(self, window_id: int, rows: List[int]) -> None:
+        self._put(("error", None, {"window_id": window_id, "rows": rows}, None))
+
+    def _put(self, item) -> None:
+        if self._error is not None:
+            raise RuntimeError(f"result writer failed: {self._error}") from self._error
+        if self._queue is None:
+            self._commit([item])
+        else:
+            # 队列有界：写盘跟不上时反压到工作线程
+            self._queue.put(item)
+
+    def close(self) -> None:
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+        try:
+            if self.fsync != "none" and self._error is None:
+                self._sync()
+        finally:
+            self._f.close()
+            self._index.close()
+        if self._error is not None:
+            raise RuntimeError(f"result writer failed: {self._error}") from self._error
+
+    # ---------- 写盘端 ----------
+
+    def _loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            group = [item]
+            stop = False
+            deadline = time.monotonic() + self.group_wait
+            while len(group) < self.group_size:
+                try:
+                    remaining = deadline - time.monotonic()
+                    nxt = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is _STOP:
+                    stop = True
+                    break
+                group.append(nxt)
+            if self._error is None:
+                try:
+                    self._commit(group)
+                except BaseException as e:
+                    # 出错后不再写盘，但继续取队列，避免生产端阻塞
+                    self._error = e
+            if stop:
+                return
+
+    def _encode(self, record) -> bytes:
+        if isinstance(record, bytes):
+            return record
+        with stage_timer(None, "serialize"):
+            return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+    def _rotate(self) -> None:
+        self._f.flush()
+        if self.fsync != "none":
+            os.fsync(self._f.fileno())
+        self._f.close()
+        self.segment += 1
+        self._f = open(segment_path(self.output_jsonl, self.segment, self.compression), "ab")
+
+    def _sync(self) -> None:
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        os.fsync(self._index.fileno())
+
+    def _commit(self, group) -> None:
+        entries: List[bytes] = []
+        sidecar_rows = []
+        with stage_timer(None, "write") as stats:
+            written = 0
+            for kind, record, info, columns in group:
+                if kind == "error":
+                    entries.append(pack_entry(info["window_id"], self._f.tell(), 0, info["rows"],
+                                              status=STATUS_ERROR, segment=self.segment))
+                    continue
+                data = compress(self._encode(record), self.compression, self.compression_level)
+                if self.rotate_bytes and self._f.tell() and self._f.tell() + len(data) > self.rotate_bytes:
+                    self._rotate()
+                offset = self._f.tell()
+                self._f.write(data)
+                written += len(data)
+                entries.append(pack_entry(info["window_id"], offset, len(data), info["rows"],
+                                          info["depth_range"], STATUS_OK, self.segment))
+                if columns is not None:
+                    sidecar_rows.append(columns)
+
+            # 先落数据再落索引：索引里的条目总指向完整的记录
+            self._f.flush()
+            if self.fsync == "group":
+                os.fsync(self._f.fileno())
+            self._index.append_many(entries)
+            if self.fsync == "group":
+                os.fsync(self._index.fileno())
+            # sidecar 日志与索引同组提交，遵循同一 fsync 策略
+            if self.sidecar is not None and sidecar_rows:
+                self.sidecar.add_many(sidecar_rows)
+                if self.fsync == "group":
+                    os.fsync(self.sidecar.fileno())
+            stats["records"] = len(group)
+            stats["bytes"] = written
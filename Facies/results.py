@@ -0,0 +1,196 @@
+# results.py
+# Lean result records and their columnar sidecar. A lean record stores the
+# source CSV row ranges of a window instead of three copies of its rows; the
+# sidecar keeps one row per depth sample with the final label, panel agreement
+# and NM_M corrections so analyses need not parse the JSONL at all.
+import json
+import os
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from result_index import iter_lines
+from routing import routed_rows
+
+SIDECAR_FORMATS = ("npz", "parquet")
+
+SIDECAR_COLUMNS = [
+    "row", "window_id", "label", "label_before_env_fix", "base_label",
+    "agreement", "corrected", "routed_to_llm",
+]
+
+
+def row_ranges(df_len: int, start: int, end: int, step_size: int) -> Dict[str, List[int]]:
+    up_start = start - step_size if start - step_size >= 0 else start
+    down_end = min(end + step_size, df_len) if end < df_len else end
+    return {"window": [start, end], "up": [up_start, start], "down": [end, down_end]}
+
+
+def lean_meta(meta_data: Dict[str, Any]) -> Dict[str, Any]:
+    meta_data.pop("window_df", None)
+    meta_data.pop("window_up", None)
+    meta_data.pop("window_down", None)
+    meta_data["lean"] = True
+    return meta_data
+
+
+def window_columns(meta_data: Dict[str, Any], answer: str) -> Dict[str, list]:
+    start, end = meta_data["rows"]["window"]
+    n = end - start
+    window_df: pd.DataFrame = meta_data["window_df"]
+
+    try:
+        labels = [str(x) for x in json.loads(answer).get("answer", [])]
+    except Exception:
+        labels = []
+    labels = (labels + ["UNKNOWN"] * n)[:n]
+
+    if "Predicted_Facies" in window_df.columns:
+        base = [str(x) for x in window_df["Predicted_Facies"].tolist()]
+    else:
+        base = ["UNKNOWN"] * n
+
+    # 路由模式下 agent 只处理了窗口内的一段，需要平移回窗口坐标
+    routing = meta_data.get("routing")
+    if routing is None:
+        offset, span = 0, n
+    elif routing.get("llm_span") is None:
+        offset, span = 0, 0
+    else:
+        offset, span = routing["llm_span"][0], routing["llm_span"][1] - routing["llm_span"][0]
+
+    agreement = np.full(n, np.nan)
+    before_fix = list(labels)
+    corrected = np.zeros(n, dtype=bool)
+    # 只有不自信的行取 agent 的标签，span 内的上下文行保留基分类器预测
+    routed = routed_rows(routing, n)
+
+    aggregation = meta_data.get("panel_aggregation", {})
+    for k, value in enumerate(aggregation.get("agreement_per_depth", [])[:span]):
+        if routed[offset + k]:
+            agreement[offset + k] = value
+    for k, label in enumerate(aggregation.get("final_labels_before_env_fix", [])[:span]):
+        if routed[offset + k]:
+            before_fix[offset + k] = label
+    for item in meta_data.get("env_consistency", {}).get("details", []):
+        if item["index"] < span and routed[offset + item["index"]]:
+            corrected[offset + item["index"]] = True
+
+    return {
+        "row": list(range(start, end)),
+        "window_id": [meta_data["current_window_id"]] * n,
+        "label": labels,
+        "label_before_env_fix": before_fix,
+        "base_label": base,
+        "agreement": agreement.tolist(),
+        "corrected": corrected.tolist(),
+        "routed_to_llm": routed.tolist(),
+    }
+
+
+def sidecar_path(output_jsonl: str, fmt: str) -> str:
+    root, _ = os.path.splitext(output_jsonl)
+    return f"{root}.labels.{fmt}"
+
+
+def load_sidecar(path: str) -> pd.DataFrame:
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    with np.load(path, allow_pickle=False) as data:
+        return pd.DataFrame({name: data[name] for name in data.files})
+
+
+class SidecarWriter:
+    def __init__(self, path: str, fmt: str = "npz"):
+        if fmt not in SIDECAR_FORMATS:
+            raise ValueError(f"Unknown sidecar format {fmt!r}, expected one of {SIDECAR_FORMATS}")
+        self.path = path
+        self.fmt = fmt
+        # 每个窗口提交后先追加到日志，进程被杀掉也不丢；flush 时再并入列式文件
+        self.journal = path + ".journal"
+        self._f = open(self.journal, "a", encoding="utf-8")
+        if self._f.tell():
+            # 上次被杀时可能留下半行，新内容另起一行
+            self._f.write("\n")
+
+    def add(self, columns: Dict[str, list]) -> None:
+        self.add_many([columns])
+
+    def add_many(self, batch: List[Dict[str, list]]) -> None:
+        for columns in batch:
+            self._f.write(json.dumps({name: columns[name] for name in SIDECAR_COLUMNS}) + "\n")
+        self._f.flush()
+
+    def fileno(self) -> int:
+        return self._f.fileno()
+
+    def _read_journal(self) -> Optional[pd.DataFrame]:
+        frames = []
+        with open(self.journal, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    frames.append(pd.DataFrame(json.loads(line)))
+                except ValueError:
+                    # 被杀时写了一半的最后一行
+                    continue
+        if not frames:
+            return None
+        return pd.concat(frames, ignore_index=True)
+
+    def flush(self) -> None:
+        self._f.close()
+        new = self._read_journal()
+        if new is None:
+            os.remove(self.journal)
+            return
+
+        # 日志里同一行可能出现多次（续跑重做的窗口），以最后一次为准
+        new = new.drop_duplicates("row", keep="last")
+        if os.path.exists(self.path):
+            # 续跑时与已有 sidecar 合并，同一行以新结果为准
+            old = load_sidecar(self.path)
+            new = pd.concat([old[~old["row"].isin(new["row"])], new], ignore_index=True)
+        new = new.sort_values("row", kind="stable").reset_index(drop=True)
+
+        tmp = self.path + ".tmp"
+        if self.fmt == "parquet":
+            new.to_parquet(tmp, index=False)
+        else:
+            arrays = {name: new[name].to_numpy() for name in SIDECAR_COLUMNS}
+            for name in ("label", "label_before_env_fix", "base_label"):
+                arrays[name] = arrays[name].astype(str)
+            with open(tmp, "wb") as f:
+                np.savez_compressed(f, **arrays)
+        os.replace(tmp, self.path)
+        os.remove(self.journal)
+
+
+def rehydrate(record: Dict[str, Any], source_df: pd.DataFrame) -> Dict[str, Any]:
+    meta_data = record["meta_data"]
+    rows = meta_data.get("rows")
+    if not meta_data.get("lean") or rows is None:
+        return record
+
+    for key, name in (("window_df", "window"), ("window_up", "up"), ("window_down", "down")):
+        start, end = rows[name]
+        meta_data[key] = source_df.iloc[start:end].to_dict(orient="records")
+    meta_data["lean"] = False
+    return record
+
+
+def load_records(output_jsonl: str,
+                 source_csv: Optional[str] = None,
+                 rehydrate_rows: bool = True) -> Iterator[Dict[str, Any]]:
+    source_df: Optional[pd.DataFrame] = None
+    for line in iter_lines(output_jsonl):
+        record = json.loads(line)
+        meta_data = record["meta_data"]
+        if rehydrate_rows and meta_data.get("lean"):
+            if source_df is None:
+                path = source_csv or meta_data.get("source_csv")
+                if path is None:
+                    raise ValueError("Lean records need the source CSV to rehydrate rows")
+                source_df = pd.read_csv(path)
+            record = rehydrate(record, source_df)
+        yield record
@@ -0,0 +1,106 @@
+# routing.py
+# Adaptive inference routing: rows the base classifier is confident about are
+# accepted directly, only the ambiguous stretch of a window goes to the agents.
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+PROB_PREFIX = "Prob_"
+CONFIDENCE_COLUMN = "Predicted_Confidence"
+
+
+def find_prob_columns(df: pd.DataFrame) -> List[str]:
+    return [c for c in df.columns if str(c).startswith(PROB_PREFIX)]
+
+
+def row_confidence(window_df: pd.DataFrame,
+                   prob_columns: Optional[List[str]] = None,
+                   mode: str = "margin") -> Optional[np.ndarray]:
+    if prob_columns is None:
+        prob_columns = find_prob_columns(window_df)
+
+    if prob_columns:
+        probs = window_df[prob_columns].to_numpy(dtype=float)
+        if probs.shape[1] == 1:
+            return probs[:, 0]
+        top2 = np.sort(probs, axis=1)[:, -2:]
+        if mode == "max":
+            return top2[:, 1]
+        return top2[:, 1] - top2[:, 0]
+
+    if CONFIDENCE_COLUMN in window_df.columns:
+        return window_df[CONFIDENCE_COLUMN].to_numpy(dtype=float)
+
+    return None
+
+
+def route_window(window_df: pd.DataFrame,
+                 threshold: float,
+                 prob_columns: Optional[List[str]] = None,
+                 mode: str = "margin",
+                 context_rows: int = 2) -> Dict[str, Any]:
+    n = len(window_df)
+    confidence = row_confidence(window_df, prob_columns, mode)
+
+    if confidence is None:
+        # no base-classifier scores available: everything goes to the agents
+        confident = np.zeros(n, dtype=bool)
+        confidence_list: List[Optional[float]] = [None] * n
+    else:
+        confidence = np.nan_to_num(confidence, nan=0.0)
+        confident = confidence >= threshold
+        confidence_list = [float(x) for x in confidence]
+
+    ambiguous = np.flatnonzero(~confident)
+    if len(ambiguous) == 0:
+        llm_span = None
+    else:
+        start = max(0, int(ambiguous[0]) - context_rows)
+        end = min(n, int(ambiguous[-1]) + 1 + context_rows)
+        llm_span = [start, end]
+
+    return {
+        "threshold": threshold,
+        "mode": mode,
+        "confidence": confidence_list,
+        "confident": [bool(x) for x in confident],
+        "num_confident": int(confident.sum()),
+        "llm_span": llm_span,
+    }
+
+
+def base_labels(window_df: pd.DataFrame) -> List[str]:
+    if "Predicted_Facies" not in window_df.columns:
+        return ["UNKNOWN"] * len(window_df)
+    return [str(x) for x in window_df["Predicted_Facies"].tolist()]
+
+
+def routed_rows(routing: Optional[Dict[str, Any]], n: int) -> np.ndarray:
+    # 最终标签取自 agent 的行：llm_span 内基分类器不自信的行；上下文行只给模型看，不改写
+    if routing is None:
+        return np.ones(n, dtype=bool)
+    mask = np.zeros(n, dtype=bool)
+    if routing.get("llm_span") is None:
+        return mask
+    start, end = routing["llm_span"]
+    mask[start:end] = True
+    confident = routing.get("confident")
+    if confident is not None:
+        mask &= ~np.asarray(confident, dtype=bool)
+    return mask
+
+
+def merge_routed_labels(window_df: pd.DataFrame,
+                        llm_span: Optional[List[int]],
+                        llm_labels: List[str],
+                        confident: Optional[List[bool]] = None) -> List[str]:
+    labels = base_labels(window_df)
+    if llm_span is None:
+        return labels
+
+    start, end = llm_span
+    for k, label in enumerate(llm_labels[: end - start]):
+        if confident is None or not confident[start + k]:
+            labels[start + k] = label
+    return labels
@@ -0,0 +1,60 @@
+# scheduler.py
+# Tiny dependency-graph runner used inside a window: every task whose
+# dependencies are finished is started on the pool, so independent LLM calls
+# overlap instead of running back to back. Each task is called with a dict of
+# its dependencies' results.
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+Task = Tuple[Callable[[Dict[str, Any]], Any], List[str]]
+
+
+def run_dag(tasks: Dict[str, Task], max_workers: Optional[int] = None) -> Dict[str, Any]:
+    for name, (_, deps) in tasks.items():
+        for dep in deps:
+            if dep not in tasks:
+                raise ValueError(f"Task {name!r} depends on unknown task {dep!r}")
+
+    results: Dict[str, Any] = {}
+    remaining = dict(tasks)
+
+    if max_workers is None:
+        max_workers = max(1, len(tasks))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while remaining or running:
+            ready = [name for name, (_, deps) in remaining.items()
+                     if all(dep in results for dep in deps)]
+            for name in ready:
+                fn, deps = remaining.pop(name)
+                running[executor.submit(fn, {dep: results[dep] for dep in deps})] = name
+
+            if not running:
+                raise ValueError(f"Dependency cycle among tasks: {sorted(remaining)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception:
+                    for other in running:
+                        other.cancel()
+                    raise
+
+    return results
+
+
+def run_sequential(tasks: Dict[str, Task]) -> Dict[str, Any]:
+    results: Dict[str, Any] = {}
+    remaining = dict(tasks)
+    while remaining:
+        ready = [name for name, (_, deps) in remaining.items()
+                 if all(dep in results for dep in deps)]
+        if not ready:
+            raise ValueError(f"Dependency cycle among tasks: {sorted(remaining)}")
+        for name in ready:
+            fn, deps = remaining.pop(name)
+            results[name] = fn({dep: results[dep] for dep in deps})
+    return results
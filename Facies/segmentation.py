@@ -0,0 +1,88 @@
+# segmentation.py
+# Adaptive windowing. Each well is cut at the changepoints found by the trend
+# engine: the rows around a boundary form their own window of at least
+# min_rows, homogeneous stretches in between are merged into larger windows
+# capped by row count and by the estimated token size of their table.
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ingest import WellContext
+from table_format import estimate_tokens, format_table
+from trend_engine import WellTrendEngine
+
+WINDOWING_MODES = ("fixed", "adaptive")
+
+
+def rows_per_token_cap(well: WellContext, columns: Sequence[str], token_cap: Optional[int],
+                       sample_rows: int = 64) -> Optional[int]:
+    if not token_cap:
+        return None
+    cols = [c for c in columns if c in well.df.columns]
+    sample = well.df.iloc[:sample_rows]
+    if not len(sample):
+        return None
+    per_row = estimate_tokens(format_table(sample, cols)) / len(sample)
+    return max(1, int(token_cap / per_row))
+
+
+def _split(start: int, end: int, max_rows: int) -> List[Tuple[int, int]]:
+    # 均匀切分，避免最后留下一个很短的窗口
+    n = end - start
+    parts = -(-n // max_rows)
+    edges = np.linspace(start, end, parts + 1).round().astype(int)
+    return [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+
+def adaptive_windows(well: WellContext,
+                     max_rows: int = 64,
+                     min_rows: int = 8,
+                     boundary_margin: int = 3,
+                     token_cap: Optional[int] = None,
+                     columns: Sequence[str] = ()) -> List[Tuple[int, int]]:
+    n = len(well.df)
+    if n == 0:
+        return []
+    cap = rows_per_token_cap(well, columns, token_cap)
+    if cap is not None:
+        max_rows = max(1, min(max_rows, cap))
+
+    engine = well.cached("trend_engine", lambda: WellTrendEngine(well.df))
+    boundaries = engine.boundary_rows()
+
+    # 层界两侧各 boundary_margin 行组成边界带；不足 min_rows 时向两侧均质段对称加宽，
+    # 靠近井首尾时整体平移而不截短；相互重叠的边界带合并
+    width = max(2 * boundary_margin, min(min_rows, max_rows))
+    zones: List[List[int]] = []
+    for b in boundaries:
+        lo = min(max(0, int(b) - width // 2), max(0, n - width))
+        hi = min(n, lo + width)
+        if zones and lo <= zones[-1][1]:
+            zones[-1][1] = max(zones[-1][1], hi)
+        else:
+            zones.append([lo, hi])
+
+    # 边界带之间的均质段；过短的均质段并入相邻的边界带
+    segments: List[List[object]] = []
+    cursor = 0
+    for lo, hi in zones:
+        if lo > cursor:
+            segments.append(["homogeneous", cursor, lo])
+        segments.append(["boundary", lo, hi])
+        cursor = hi
+    if cursor < n:
+        segments.append(["homogeneous", cursor, n])
+
+    merged: List[List[object]] = []
+    for kind, lo, hi in segments:
+        short = kind == "homogeneous" and hi - lo < min_rows
+        if merged and (short or (merged[-1][0] == "short")) and hi - merged[-1][1] <= max_rows:
+            merged[-1][2] = hi
+            merged[-1][0] = "boundary"
+        else:
+            merged.append(["short" if short else kind, lo, hi])
+
+    windows: List[Tuple[int, int]] = []
+    for _, lo, hi in merged:
+        windows.extend(_split(lo, hi, max_rows))
+    return windows
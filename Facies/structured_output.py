@@ -0,0 +1,150 @@
+# structured_output.py
+# Incremental validation of classification answers. AnswerStream consumes the
+# {"answer": [...]} object piece by piece as tokens arrive, checks every label
+# against the nine classes and the row count of the window, and reports
+# off-schema output as soon as it appears so a streaming generation can be
+# aborted. Complete (non-streamed) answers are parsed as ordinary JSON first.
+# Rows that end up missing or invalid are re-queried on their own.
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+from prompts import LABEL_DESCRIPTIONS
+
+VALID_LABELS = list(LABEL_DESCRIPTIONS)
+_CANONICAL = {" ".join(label.lower().split()): label for label in VALID_LABELS}
+
+ANSWER_KEY = "answer"
+
+
+def normalize_label(text: str) -> Optional[str]:
+    return _CANONICAL.get(" ".join(str(text).lower().split()))
+
+
+class AnswerStream:
+    # 逐字符的小状态机，只接受 { "answer": [ "label", ... ] }
+    def __init__(self, expected_rows: int):
+        self.expected_rows = expected_rows
+        self.reset()
+
+    def reset(self) -> None:
+        self.labels: List[Optional[str]] = []
+        self.problems: List[str] = []
+        self.off_schema = False
+        self.complete = False
+        self.chars = 0
+        self._state = "start"
+        self._buf: List[str] = []
+        self._escape = False
+
+    def _fail(self, reason: str) -> bool:
+        self.off_schema = True
+        self.problems.append(reason)
+        return False
+
+    def _close_item(self) -> bool:
+        raw = "".join(self._buf)
+        self._buf = []
+        row = len(self.labels)
+        if row >= self.expected_rows:
+            return self._fail(f"more than {self.expected_rows} labels")
+        label = normalize_label(raw)
+        if label is None:
+            # 单行标签非法不影响其余行，记下后继续解析
+            self.problems.append(f"row {row}: invalid label {raw!r}")
+        self.labels.append(label)
+        return True
+
+    def feed(self, text: Optional[str]) -> bool:
+        if self.off_schema:
+            return False
+        if not text:
+            return True
+        for ch in text:
+            self.chars += 1
+            state = self._state
+            if state in ("key", "item"):
+                if self._escape:
+                    self._buf.append(ch)
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    if state == "key":
+                        key = "".join(self._buf)
+                        self._buf = []
+                        if key != ANSWER_KEY:
+                            return self._fail(f"unexpected key {key!r}")
+                        self._state = "colon"
+                    else:
+                        if not self._close_item():
+                            return False
+                        self._state = "after_item"
+                else:
+                    self._buf.append(ch)
+                continue
+            if ch.isspace():
+                continue
+            if state == "start" and ch == "{":
+                self._state = "key_open"
+            elif state == "key_open" and ch == '"':
+                self._state = "key"
+            elif state == "colon" and ch == ":":
+                self._state = "list_open"
+            elif state == "list_open" and ch == "[":
+                self._state = "first_item"
+            elif state in ("first_item", "next_item") and ch == '"':
+                self._state = "item"
+            elif state == "first_item" and ch == "]":
+                self._state = "tail"
+            elif state == "after_item" and ch == ",":
+                self._state = "next_item"
+            elif state == "after_item" and ch == "]":
+                self._state = "tail"
+            elif state == "tail" and ch == "}":
+                self._state = "done"
+                self.complete = True
+            else:
+                return self._fail(f"unexpected {ch!r} while expecting {state.replace('_', ' ')}")
+        return True
+
+    def parse(self, text: Optional[str]) -> None:
+        # 完整回答按普通 JSON 解析，键顺序、多余的键、\uXXXX 转义都不影响；
+        # 解析失败（截断等）才退回逐字符状态机，尽量保留已给出的行
+        self.reset()
+        try:
+            obj = json.loads(text or "")
+        except ValueError:
+            obj = None
+        if not isinstance(obj, dict) or not isinstance(obj.get(ANSWER_KEY), list):
+            self.feed(text)
+            return
+        self.chars = len(text)
+        for item in obj[ANSWER_KEY]:
+            self._buf = [str(item)]
+            if not self._close_item():
+                break
+        self._buf = []
+        self.complete = True
+
+    def finish(self) -> Tuple[List[Optional[str]], List[int]]:
+        if not self.complete and not self.off_schema:
+            self.problems.append("answer ended early")
+        if self.complete and len(self.labels) < self.expected_rows:
+            self.problems.append(f"{len(self.labels)} labels for {self.expected_rows} rows")
+        labels = (self.labels + [None] * self.expected_rows)[: self.expected_rows]
+        missing = [k for k, label in enumerate(labels) if label is None]
+        return labels, missing
+
+    def summary(self) -> Dict[str, Any]:
+        return {"problems": list(self.problems), "off_schema": self.off_schema, "chars": self.chars}
+
+
+_options: Dict[str, Any] = {"stream": False, "repair_rounds": 1}
+
+
+def configure_answers(stream: bool = False, repair_rounds: int = 1) -> None:
+    _options.update(stream=bool(stream), repair_rounds=max(0, int(repair_rounds)))
+
+
+def answer_options() -> Dict[str, Any]:
+    return dict(_options)
@@ -0,0 +1,155 @@
+# stub_server.py
+# Local HTTP stand-in that speaks the chat-completions protocol. Point the
+# openai backend at it (DEEPSEEK_BASE_URL=http://127.0.0.1:8000) to exercise
+# the real client, connection handling and retries with no network access.
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from backends import BackendError, StubBackend, response_chunks
+
+
+def parse_latency(spec: str):
+    # "0.5" | "constant:0.5" | "uniform:0.2:1.0" | "lognormal:2.0:0.5"
+    if not spec:
+        return None
+    parts = spec.split(":")
+    if len(parts) == 1:
+        return float(parts[0])
+    return (parts[0], *[float(x) for x in parts[1:]])
+
+
+def usage_to_json(usage) -> dict:
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "total_tokens": usage.total_tokens,
+        "prompt_cache_hit_tokens": getattr(usage, "prompt_cache_hit_tokens", 0),
+        "prompt_cache_miss_tokens": getattr(usage, "prompt_cache_miss_tokens", usage.prompt_tokens),
+        "completion_tokens_details": {
+            "reasoning_tokens": usage.completion_tokens_details.reasoning_tokens,
+        },
+    }
+
+
+def chunk_to_json(chunk, model: str) -> dict:
+    choices = [{
+        "index": c.index,
+        "delta": {k: v for k, v in (("content", c.delta.content),
+                                    ("reasoning_content", c.delta.reasoning_content)) if v is not None},
+        "finish_reason": c.finish_reason,
+    } for c in chunk.choices]
+    body = {"id": chunk.id, "object": "chat.completion.chunk", "created": int(time.time()),
+            "model": model, "choices": choices}
+    if chunk.usage is not None:
+        body["usage"] = usage_to_json(chunk.usage)
+    return body
+
+
+def response_to_json(response) -> dict:
+    message = response.choices[0].message
+    return {
+        "id": response.id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": response.model,
+        "choices": [{
+            "index": 0,
+            "message": {
+                "role": "assistant",
+                "content": message.content,
+                "reasoning_content": message.reasoning_content,
+            },
+            "finish_reason": "stop",
+        }],
+        "usage": usage_to_json(response.usage),
+    }
+
+
+def make_handler(backend: StubBackend):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # 头与正文分两次写出，关掉 Nagle 以免保活连接上每次请求多等一个延迟 ACK
+        disable_nagle_algorithm = True
+
+        def _send(self, status: int, body: dict):
+            payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _send_stream(self, chunks, model: str):
+            # SSE 流；不写 Content-Length，发完后关闭连接。客户端提前断开时直接放弃
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            try:
+                for chunk in chunks:
+                    data = json.dumps(chunk_to_json(chunk, model), ensure_ascii=False)
+                    self.wfile.write(f"data: {data}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+                return
+
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                request = json.loads(self.rfile.read(length) or b"{}")
+            except json.JSONDecodeError as e:
+                self._send(400, {"error": {"message": f"invalid JSON: {e}"}})
+                return
+
+            try:
+                response = backend.create(request)
+            except BackendError as e:
+                self._send(e.status_code or 500, {"error": {"message": str(e), "type": "stub_failure"}})
+                return
+
+            if request.get("stream"):
+                self._send_stream(response_chunks(response, backend.stream_chunk_chars), response.model)
+                return
+            self._send(200, response_to_json(response))
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+def serve(host: str = "127.0.0.1", port: int = 8000, **backend_kwargs) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), make_handler(StubBackend(**backend_kwargs)))
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline chat-completions stand-in for GeoDecider.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", default="", help="e.g. 0.5, uniform:0.2:1.0, lognormal:2.0:0.5")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--failure-status", type=int, default=429)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0,
+                        help="fraction of classification answers that go off-schema")
+    args = parser.parse_args()
+
+    httpd = serve(args.host, args.port,
+                  latency=parse_latency(args.latency),
+                  failure_rate=args.failure_rate,
+                  failure_status=args.failure_status,
+                  seed=args.seed,
+                  malformed_rate=args.malformed_rate)
+    print(f"Stub chat-completions server listening on http://{args.host}:{args.port}")
+    httpd.serve_forever()
@@ -0,0 +1,186 @@
+# table_format.py
+# One place that turns well-log windows into prompt text. Tables are written
+# as compact CSV/TSV, aligned text or a delta encoding, with per-curve
+# precision; render_window fits them into a token budget by dropping context
+# rows (farthest from the target first) before lowering precision.
+# numpy/pandas are imported on first use so that token estimation stays cheap
+# for the backends, the stub server and freshly spawned workers.
+from __future__ import annotations
+
+import math
+import re
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+TABLE_FORMATS = ("csv", "tsv", "text", "delta")
+
+DEFAULT_PRECISION = {
+    "Depth": 1,
+    "GR": 2,
+    "ILD_log10": 3,
+    "DeltaPHI": 2,
+    "PHIND": 2,
+    "PE": 2,
+    "NM_M": 0,
+    "RELPOS": 3,
+}
+FALLBACK_PRECISION = 3
+INDEX_COLUMN = "#"
+
+# 粗略的 BPE 近似：英文按每 6 个字母、数字按每 3 位、标点与制表符逐个、连续空白按段计数
+_TOKEN_RE = re.compile(r"[A-Za-z]{1,6}|\d{1,3}|\t|\s{2,}|\n|[^\sA-Za-z\d]")
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(_TOKEN_RE.findall(text)))
+
+
+_options: Dict[str, Any] = {"fmt": "csv", "precision": {}, "budget": None}
+
+
+def configure_tables(fmt: str = "csv", precision: Optional[Dict[str, int]] = None,
+                     budget: Optional[int] = None) -> None:
+    if fmt not in TABLE_FORMATS:
+        raise ValueError(f"Unknown table format {fmt!r}, expected one of {TABLE_FORMATS}")
+    _options.update(fmt=fmt, precision=dict(precision or {}), budget=budget)
+
+
+def table_options() -> Dict[str, Any]:
+    return dict(_options)
+
+
+def _digits(column: str, precision: Dict[str, int], shift: int = 0) -> int:
+    base = precision.get(column, DEFAULT_PRECISION.get(column, FALLBACK_PRECISION))
+    return max(0, base - shift)
+
+
+def _format_number(value: float, digits: int, signed: bool = False) -> str:
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    text = f"{value:+.{digits}f}" if signed else f"{value:.{digits}f}"
+    if digits and "." in text:
+        text = text.rstrip("0").rstrip(".")
+    if text in ("-0", "+0", "-0.0"):
+        text = "+0" if signed else "0"
+    return text
+
+
+def _cells(df: pd.DataFrame, columns: Sequence[str], precision: Dict[str, int],
+           shift: int, delta: bool) -> List[List[str]]:
+    import numpy as np
+    import pandas as pd
+
+    out: List[List[str]] = [[] for _ in range(len(df))]
+    for column in columns:
+        values = df[column]
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            arr = values.to_numpy(dtype=float)
+            digits = _digits(column, precision, shift)
+            if delta and len(arr) > 1:
+                # 首行给绝对值，其余行给相对上一行的差值（按显示精度取整后相减，避免误差累积）
+                rounded = np.round(arr, digits)
+                diffs = np.concatenate([[np.nan], np.diff(rounded)])
+                for k in range(len(arr)):
+                    out[k].append(_format_number(arr[k], digits) if k == 0
+                                  else _format_number(diffs[k], digits, signed=True))
+            else:
+                for k, v in enumerate(arr):
+                    out[k].append(_format_number(v, digits))
+        else:
+            for k, v in enumerate(values.tolist()):
+                out[k].append("" if v is None or (isinstance(v, float) and math.isnan(v)) else str(v))
+    return out
+
+
+def format_table(df: pd.DataFrame, columns: Optional[Sequence[str]] = None,
+                 fmt: Optional[str] = None, precision: Optional[Dict[str, int]] = None,
+                 index: bool = True, precision_shift: int = 0,
+                 row_labels: Optional[Sequence[str]] = None) -> str:
+    fmt = fmt or _options["fmt"]
+    if fmt not in TABLE_FORMATS:
+        raise ValueError(f"Unknown table format {fmt!r}, expected one of {TABLE_FORMATS}")
+    precision = {**_options["precision"], **(precision or {})}
+    columns = list(columns) if columns is not None else list(df.columns)
+
+    rows = _cells(df, columns, precision, precision_shift, delta=(fmt == "delta"))
+    header = list(columns)
+    if index:
+        # 行号从 0 开始，与输出的 answer 列表一一对应
+        header = [INDEX_COLUMN] + header
+        labels = list(row_labels) if row_labels is not None else [str(k) for k in range(len(rows))]
+        rows = [[label] + row for label, row in zip(labels, rows)]
+
+    if fmt == "text":
+        widths = [max(len(h), *(len(r[j]) for r in rows)) if rows else len(h) for j, h in enumerate(header)]
+        lines = [" ".join(h.rjust(w) for h, w in zip(header, widths))]
+        lines += [" ".join(c.rjust(w) for c, w in zip(r, widths)) for r in rows]
+        return "\n".join(lines) + "\n"
+
+    sep = "\t" if fmt == "tsv" else ","
+    lines = [sep.join(header)] + [sep.join(r) for r in rows]
+    text = "\n".join(lines) + "\n"
+    if fmt == "delta":
+        text = ("(numeric columns: first row absolute, later rows are differences from the row above)\n"
+                + text)
+    return text
+
+
+def render_window(window_df: pd.DataFrame,
+                  window_up: Optional[pd.DataFrame] = None,
+                  window_down: Optional[pd.DataFrame] = None,
+                  columns: Optional[Sequence[str]] = None,
+                  fmt: Optional[str] = None,
+                  precision: Optional[Dict[str, int]] = None,
+                  budget: Optional[int] = None,
+                  overhead_tokens: int = 0,
+                  index: bool = True,
+                  mark_context: bool = False) -> Tuple[str, Dict[str, Any]]:
+    # 上下文行与目标行拼成一张表；超出预算时先从最远处删上下文行，再逐位降低精度。
+    # mark_context 时目标行仍从 0 编号（与 answer 对应），上下文行记为 c-k / c+k
+    import pandas as pd
+
+    up = window_up if window_up is not None else pd.DataFrame()
+    down = window_down if window_down is not None else pd.DataFrame()
+    budget = budget if budget is not None else _options["budget"]
+    n_up, n_down = len(up), len(down)
+    shift = 0
+
+    def render():
+        parts = [p for p in (up.iloc[len(up) - n_up:], window_df, down.iloc[:n_down]) if len(p)]
+        table = pd.concat(parts) if len(parts) > 1 else window_df
+        if not mark_context:
+            return format_table(table, columns, fmt, precision, index, shift)
+        labels = ([f"c-{n_up - k}" for k in range(n_up)] + [str(k) for k in range(len(window_df))]
+                  + [f"c+{k + 1}" for k in range(n_down)])
+        text = format_table(table, columns, fmt, precision, index, shift, labels)
+        if n_up or n_down:
+            text = (f"(rows c-1, c-2, ... above and c+1, c+2, ... below are context only; "
+                    f"label rows 0-{len(window_df) - 1})\n" + text)
+        return text
+
+    text = render()
+    tokens = estimate_tokens(text) + overhead_tokens
+    while budget is not None and tokens > budget:
+        if n_up or n_down:
+            if n_up >= n_down:
+                n_up -= 1
+            else:
+                n_down -= 1
+        elif shift < 3:
+            shift += 1
+        else:
+            break
+        text = render()
+        tokens = estimate_tokens(text) + overhead_tokens
+
+    info = {
+        "tokens": tokens,
+        "context_rows_dropped": (len(up) - n_up) + (len(down) - n_down),
+        "precision_reduced_by": shift,
+        "over_budget": budget is not None and tokens > budget,
+    }
+    if info["over_budget"]:
+        print(f"Warning: prompt table needs ~{tokens} tokens, over the budget of {budget}.")
+    return text, info
@@ -1,18 +1,13 @@
 # tool_call.py
-from openai import OpenAI
+from llm import complete
 import os
 import json
 
 extra_body = {"enable_thinking": True}
 
-client = OpenAI(
-    api_key='sk-xxx',
-    base_url="https://api.deepseek.com",
-)
 
-
-def get_tool_call(content: str):
-    response = client.chat.completions.create(
+def get_tool_call(content: str, stats=None):
+    request = dict(
         model="deepseek-reasoner",
         messages=[
             {
@@ -46,8 +41,7 @@ Return ONLY valid JSON in the following format:
         response_format={"type": "json_object"},
     )
 
-    think = response.choices[0].message.reasoning_content
-    answer = response.choices[0].message.content  # JSON string
+    think, answer = complete(request, stats)  # answer: JSON string
     return think, answer
 
 
@@ -69,7 +63,7 @@ Here are the tools you can use:
    - analyzes trends in well-log data (including up/down/target windows) to identify patterns and vertical continuity.
 
 5. neighbor_finding_tool
-   - finds similar well-log cases from a database using a k-nearest-neighbor approach (currently a placeholder).
+   - finds similar well-log cases from a database using a k-nearest-neighbor approach and reports the facies of the closest labelled samples.
 
 Selection guidelines:
 - Use a single tool when the pattern is simple and one perspective is clearly sufficient.
@@ -96,9 +90,9 @@ Return ONLY the JSON object described above.
     return prompt
 
 
-def get_tool_selection(table_str: str):
+def get_tool_selection(table_str: str, stats=None):
     planner_prompt = build_tool_select_prompt(table_str)
-    think, answer = get_tool_call(planner_prompt)
+    think, answer = get_tool_call(planner_prompt, stats)
     tools_json = json.loads(answer)
     tools = tools_json.get("tools", [])
     tool_list = [t["name"] for t in tools]
@@ -1,6 +1,10 @@
 # tools.py
+from functools import lru_cache
 from prompts import FEATURE_DESCRIPTIONS, LABEL_DESCRIPTIONS, CLASSIFICATION_SUGGESTIONS, build_trend_prompt
 from api import get_result_trend
+from metrics import stage_timer
+from trend_engine import WellTrendEngine
+from neighbors import format_evidence, get_neighbor_index, neighbor_k, well_features
 import pandas as pd
 
 
@@ -9,7 +13,10 @@ class ExpertFeatureDescriptionTool:
         self.name = "expert_feature_description_tool"
         self.description = "Provide detailed descriptions of log features."
 
-    def run(self) -> str:
+    # 静态知识文本只生成一次，保证各次调用的提示前缀逐字节一致
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def run() -> str:
         text = 'Here are the descriptions of various features:\n'
         for key, desc in FEATURE_DESCRIPTIONS.items():
             text += f"**{key}**: {desc}\n"
@@ -20,7 +27,9 @@ class ExpertLabelDescriptionTool:
         self.name = "expert_label_description_tool"
         self.description = "Provide detailed descriptions of lithofacies labels."
 
-    def run(self) -> str:
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def run() -> str:
         text = 'Here are the descriptions of various labels:\n'
         for key, desc in LABEL_DESCRIPTIONS.items():
             text += f"**{key}**: {desc}\n"
@@ -32,7 +41,9 @@ class ClassificationSuggestionsTool:
         self.name = "expert_classification_suggestions_tool"
         self.description = "Provide heuristic suggestions for facies classification."
 
-    def run(self) -> str:
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def run() -> str:
         text = 'Here are some suggestions for classification tasks:\n\n'
         for label, suggestion in CLASSIFICATION_SUGGESTIONS.items():
             text += f"### {label}\n{suggestion}\n\n"
@@ -60,23 +71,30 @@ Interpret trends holistically rather than relying on single-curve thresholds.
 
 
 class TrendAnalysisTool:
-    def __init__(self):
+    def __init__(self, mode: str = "llm"):
+        if mode not in ("llm", "local"):
+            raise ValueError(f"Unknown trend mode {mode!r}")
         self.name = "trend_analysis_tool"
         self.description = "Analyze up-target-down window trends in well logs."
+        self.mode = mode
 
     def run(self, meta_data):
+        if self.mode == "local":
+            return self.run_local(meta_data)
+
         window_up = meta_data.get("window_up", pd.DataFrame())
         window_df = meta_data["window_df"]
         window_down = meta_data.get("window_down", pd.DataFrame())
         target_columns = meta_data["target_columns"]
 
-        full_window = pd.concat([window_up, window_df, window_down])
-
         cols = [c for c in target_columns if c != "Predicted_Facies"]
-        full_window = full_window[cols]
 
-        prompt = build_trend_prompt(full_window)
-        think, answer = get_result_trend(prompt)
+        def select(df):
+            return df[cols] if len(df) else df
+
+        prompt = build_trend_prompt(window_df[cols], select(window_up), select(window_down))
+        with stage_timer(meta_data, "trend_analysis") as stats:
+            think, answer = get_result_trend(prompt, stats)
 
         meta_data["trend_analysis_prompt"] = prompt
         meta_data["trend_analysis_think"] = think
@@ -84,11 +102,60 @@ class TrendAnalysisTool:
 
         return meta_data
 
+    def run_local(self, meta_data):
+        # 本地确定性计算，不调用推理模型；整口井的统计量只算一次
+        with stage_timer(meta_data, "trend_analysis"):
+            well = meta_data.get("well")
+            if well is not None:
+                engine = well.cached("trend_engine", lambda: WellTrendEngine(well.df))
+            else:
+                engine = WellTrendEngine(pd.concat([meta_data.get("window_up", pd.DataFrame()),
+                                                    meta_data["window_df"],
+                                                    meta_data.get("window_down", pd.DataFrame())]))
+            window_df = meta_data["window_df"]
+            target = (int(window_df.index[0]), int(window_df.index[-1]) + 1)
+            up = meta_data.get("window_up", pd.DataFrame())
+            down = meta_data.get("window_down", pd.DataFrame())
+            context = (int(up.index[0]) if len(up) else target[0],
+                       int(down.index[-1]) + 1 if len(down) else target[1])
+            answer = engine.describe(target, context)
+
+        meta_data["trend_analysis_prompt"] = ""
+        meta_data["trend_analysis_think"] = ""
+        meta_data["trend_analysis_answer"] = answer
+        meta_data["trend_analysis_mode"] = "local"
+        return meta_data
+
 
 class NeighborFindTool:
-    def __init__(self):
+    def __init__(self, k: int = None):
         self.name = "neighbor_finding_tool"
-        self.description = "Placeholder tool to find nearest-neighbor wells (not yet implemented)."
+        self.description = "Retrieve the facies of the most similar labelled samples from historical wells."
+        self.k = k
 
     def run(self, meta_data):
+        index = get_neighbor_index()
+        if index is None:
+            # 未配置索引时不提供近邻证据
+            return meta_data
+
+        with stage_timer(meta_data, "tool:neighbor_find"):
+            well = meta_data.get("well")
+            window_df = meta_data["window_df"]
+            if well is not None:
+                source, well_name = well.df, well.name
+                raw = well.cached("neighbor_features",
+                                  lambda: well_features(well.df, index.curves, index.trend_window))
+            else:
+                source = pd.concat([meta_data.get("window_up", pd.DataFrame()),
+                                    window_df,
+                                    meta_data.get("window_down", pd.DataFrame())])
+                well_name, raw = None, None
+            target = (int(window_df.index[0]), int(window_df.index[-1]) + 1)
+            result = index.query_window(source, target, self.k or neighbor_k(), well_name, raw)
+            depths = (window_df["Depth"].tolist() if "Depth" in window_df.columns
+                      else list(range(target[0], target[1])))
+            evidence = format_evidence(result, depths, index.labels)
+
+        meta_data["neighbor_evidence"] = evidence
         return meta_data
@@ -0,0 +1,218 @@
+# trend_engine.py
+# Deterministic, vectorized trend analysis. Rolling statistics, changepoints
+# and depth gradients are computed once for a whole well; each window then
+# slices those arrays and renders the same "Detailed Feature Analysis" layout
+# that build_trend_prompt asks the reasoning model for.
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+TREND_CURVES = ["GR", "ILD_log10", "DeltaPHI", "PHIND", "PE", "NM_M", "RELPOS"]
+
+
+def _fill(values: np.ndarray) -> np.ndarray:
+    # 缺失值用前后值填补，整列缺失则置 0
+    df = pd.DataFrame(values)
+    return df.ffill().bfill().fillna(0.0).to_numpy(dtype=float)
+
+
+def _rolling(x: np.ndarray, window: int):
+    # 居中滑动均值/标准差，基于累积和，一次算完整口井
+    n = x.shape[0]
+    half = window // 2
+    pad = np.pad(x, ((half, window - 1 - half), (0, 0)), mode="edge")
+    c1 = np.vstack([np.zeros((1, x.shape[1])), np.cumsum(pad, axis=0)])
+    c2 = np.vstack([np.zeros((1, x.shape[1])), np.cumsum(pad * pad, axis=0)])
+    s1 = c1[window:window + n] - c1[:n]
+    s2 = c2[window:window + n] - c2[:n]
+    mean = s1 / window
+    var = np.maximum(s2 / window - mean * mean, 0.0)
+    return mean, np.sqrt(var)
+
+
+class WellTrendEngine:
+    def __init__(self, well_df: pd.DataFrame,
+                 curves: Sequence[str] = TREND_CURVES,
+                 rolling_window: int = 5,
+                 boundary_z: float = 3.0):
+        self.curves = [c for c in curves if c in well_df.columns]
+        self.rows = well_df.index.to_numpy()
+        self._pos = {int(r): k for k, r in enumerate(self.rows)}
+
+        self.values = _fill(well_df[self.curves].to_numpy(dtype=float))
+        if "Depth" in well_df.columns:
+            self.depth = _fill(well_df[["Depth"]].to_numpy(dtype=float))[:, 0]
+        else:
+            self.depth = np.arange(len(well_df), dtype=float)
+
+        # 居中滑动标准差：窗口内的局部起伏，与上下文整体起伏对比
+        _, self.roll_std = _rolling(self.values, rolling_window)
+
+        # 变点：一阶差分的稳健 z 分数（中位数/MAD）超过阈值
+        diff = np.diff(self.values, axis=0, prepend=self.values[:1])
+        med = np.median(diff, axis=0)
+        mad = np.median(np.abs(diff - med), axis=0) * 1.4826
+        scale = np.where(mad > 0, mad, np.maximum(np.std(diff, axis=0), 1e-9))
+        self.jump_z = np.abs(diff - med) / scale
+        self.boundary = self.jump_z >= boundary_z
+        if "NM_M" in self.curves:
+            k = self.curves.index("NM_M")
+            self.boundary[:, k] = diff[:, k] != 0
+        self.boundary[0, :] = False
+
+    def positions(self, start_row: int, end_row: int) -> slice:
+        return slice(self._pos[start_row], self._pos[end_row - 1] + 1)
+
+    def boundary_rows(self, min_curves: int = 2) -> np.ndarray:
+        # 多条曲线同时跳变或 NM_M 改变的位置视为层界
+        strong = self.boundary.sum(axis=1) >= min_curves
+        if "NM_M" in self.curves:
+            strong |= self.boundary[:, self.curves.index("NM_M")]
+        return np.flatnonzero(strong)
+
+    def segment_stats(self, target: slice, context: slice) -> Dict[str, np.ndarray]:
+        x = self.values[target]
+        ctx = self.values[context]
+        d = self.depth[target]
+        n = x.shape[0]
+
+        t = d - d.mean()
+        denom = float((t * t).sum()) or 1.0
+        slope = (t[:, None] * (x - x.mean(axis=0))).sum(axis=0) / denom
+
+        ctx_mean = ctx.mean(axis=0)
+        ctx_std = ctx.std(axis=0)
+        ctx_std = np.where(ctx_std > 1e-9, ctx_std, 1.0)
+        seg_std = x.std(axis=0)
+
+        dx = np.diff(x, axis=0) if n > 1 else np.zeros((1, x.shape[1]))
+        signs = np.sign(dx)
+        flips = (signs[1:] * signs[:-1] < 0).sum(axis=0) if n > 2 else np.zeros(x.shape[1])
+        flip_rate = flips / max(n - 2, 1)
+
+        # 二次拟合的曲率判断凸形
+        if n >= 3:
+            coeffs = np.polyfit(t, x, 2)
+            curvature = coeffs[0]
+        else:
+            curvature = np.zeros(x.shape[1])
+
+        return {
+            "slope": slope,
+            "change": slope * (d[-1] - d[0] if n > 1 else 0.0),
+            "level_z": (x.mean(axis=0) - ctx_mean) / ctx_std,
+            "rel_std": seg_std / ctx_std,
+            "flip_rate": flip_rate,
+            "curvature": curvature,
+            "min": x.min(axis=0),
+            "max": x.max(axis=0),
+            "mean": x.mean(axis=0),
+            "local_std": self.roll_std[target].mean(axis=0) / ctx_std,
+            "max_jump_z": self.jump_z[target].max(axis=0),
+            "boundary": self.boundary[target],
+            "depth": d,
+            "ctx_std": ctx_std,
+        }
+
+    def correlations(self, context: slice) -> np.ndarray:
+        x = self.values[context]
+        std = x.std(axis=0)
+        ok = std > 1e-9
+        corr = np.full((x.shape[1], x.shape[1]), np.nan)
+        if ok.sum() >= 2:
+            corr[np.ix_(ok, ok)] = np.corrcoef(x[:, ok], rowvar=False)
+        return corr
+
+    def describe(self, target_rows: Sequence[int], context_rows: Optional[Sequence[int]] = None) -> str:
+        start, end = target_rows
+        target = self.positions(start, end)
+        context = self.positions(*context_rows) if context_rows else target
+        s = self.segment_stats(target, context)
+        corr = self.correlations(context)
+        return render_trend_text(self.curves, s, corr)
+
+
+def _trend_word(change: float, ctx_std: float, flip_rate: float, rel_std: float) -> str:
+    ratio = change / ctx_std
+    if flip_rate > 0.6 and rel_std > 0.5:
+        return "fluctuating"
+    if ratio > 0.75:
+        return "increasing"
+    if ratio < -0.75:
+        return "decreasing"
+    if rel_std < 0.35:
+        return "stable"
+    return "slightly varying around a constant level"
+
+
+def _shape_word(curvature: float, flip_rate: float, ctx_std: float, span: float) -> str:
+    if flip_rate > 0.6:
+        return "sawtooth"
+    bend = curvature * (span / 2) ** 2 / ctx_std if span > 0 else 0.0
+    if bend > 0.5:
+        return "left convex (concave-up, minimum inside the segment)"
+    if bend < -0.5:
+        return "right convex (concave-down, maximum inside the segment)"
+    return "smooth"
+
+
+def _level_word(z: float) -> str:
+    if z > 1.0:
+        return "high"
+    if z > 0.3:
+        return "moderately high"
+    if z < -1.0:
+        return "low"
+    if z < -0.3:
+        return "moderately low"
+    return "average"
+
+
+def render_trend_text(curves: List[str], s: Dict[str, np.ndarray], corr: np.ndarray) -> str:
+    depth = s["depth"]
+    span = float(depth[-1] - depth[0]) if len(depth) > 1 else 0.0
+    boundary_depths = [float(depth[k]) for k in np.flatnonzero(s["boundary"].sum(axis=1) >= 2)]
+    trends = {c: _trend_word(s["change"][k], s["ctx_std"][k], s["flip_rate"][k], s["rel_std"][k])
+              for k, c in enumerate(curves)}
+
+    stable = [c for c in curves if trends[c] == "stable"]
+    moving = [c for c in curves if trends[c] in ("increasing", "decreasing", "fluctuating")]
+    lines = ["**Overall Trend Overview:**"]
+    lines.append(
+        f"Target segment {depth[0]:.1f}–{depth[-1]:.1f} ({len(depth)} samples). "
+        + (f"Stable curves: {', '.join(stable)}. " if stable else "")
+        + (f"Changing curves: {', '.join(f'{c} ({trends[c]})' for c in moving)}. " if moving else "")
+        + (f"Boundaries at depth {', '.join(f'{d:.1f}' for d in boundary_depths)}."
+           if boundary_depths else "No multi-curve boundary inside the segment; continuous with its context.")
+    )
+
+    lines.append("")
+    lines.append("**Detailed Feature Analysis:**")
+    for k, c in enumerate(curves):
+        jumps = [float(depth[j]) for j in np.flatnonzero(s["boundary"][:, k])]
+        text = (
+            f"{trends[c]} (slope {s['slope'][k]:+.3g} per depth unit, range {s['min'][k]:.3g}–{s['max'][k]:.3g}, "
+            f"local std {s['local_std'][k]:.2f}× the context); "
+            f"shape {_shape_word(s['curvature'][k], s['flip_rate'][k], s['ctx_std'][k], span)}; "
+            f"level {_level_word(s['level_z'][k])} relative to the window baseline "
+            f"(z={s['level_z'][k]:+.2f}); "
+            + (f"mutation points at {', '.join(f'{d:.1f}' for d in jumps)} " if jumps else "no abrupt jumps ")
+            + f"(max jump z={s['max_jump_z'][k]:.1f}); "
+            + ("regular oscillation." if s["flip_rate"][k] > 0.6 else "no periodic fluctuation.")
+        )
+        lines.append(f"- {c} Trend: {text}")
+
+    pairs = []
+    for i in range(len(curves)):
+        for j in range(i + 1, len(curves)):
+            r = corr[i, j]
+            if np.isfinite(r) and abs(r) >= 0.6:
+                pairs.append((abs(r), f"{curves[i]}–{curves[j]} {'positive' if r > 0 else 'negative'} (r={r:+.2f})"))
+    lines.append("")
+    lines.append("**Inter-feature Correlation:**")
+    if pairs:
+        lines.append("; ".join(p for _, p in sorted(pairs, reverse=True)) + ".")
+    else:
+        lines.append("No strong correlation (|r| ≥ 0.6) between curves in this window.")
+    return "\n".join(lines) + "\n"